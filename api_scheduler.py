@@ -0,0 +1,325 @@
+"""
+Shared scheduler for OpenAI API requests.
+Enforce requests/min and tokens/min limits per model, adapt the number of in-flight requests (AIMD),
+retry transient errors with exponential backoff and jitter, and admit interactive requests before bulk ones.
+Interactive requests also take priority across processes on the same machine, e.g., ground.py over a running exp_full.py:
+a process with interactive requests holds a lock on a marker file, and bulk requests of every process wait while any marker is locked.
+"""
+import os
+import glob
+import time
+import fcntl
+import tempfile
+import random
+import heapq
+import itertools
+import threading
+import asyncio
+import contextvars
+import logging
+from contextlib import contextmanager
+import openai
+
+
+PRIORITY_INTERACTIVE = 0  # e.g., ground.ground on the robot
+PRIORITY_BULK = 1  # e.g., exp_full.py, exp_modular.py
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+POLL_INTERVAL = 0.05  # sec between admission checks of a waiting request
+PRIORITY_DPATH = os.getenv("API_PRIORITY_DPATH", os.path.join(tempfile.gettempdir(), "ground_api_priority"))  # interactive markers of processes sharing the API key
+
+_priority = contextvars.ContextVar("api_priority", default=PRIORITY_BULK)
+_scheduler = None
+
+
+class InteractiveMarker:
+    """
+    Cross-process signal that a process is issuing interactive requests: an exclusive lock on a marker file named by its pid.
+    The lock is released by the OS if the process dies, so markers left behind by crashed processes are ignored.
+    """
+    def __init__(self, dpath=PRIORITY_DPATH):
+        self.dpath = dpath
+        self.lock = threading.Lock()
+        self.nactive = 0  # interactive contexts open in this process
+        self.marker_file = None
+        self.checked, self.is_active = 0, False
+
+    def enter(self):
+        with self.lock:
+            self.nactive += 1
+            if self.nactive == 1:
+                os.makedirs(self.dpath, exist_ok=True)
+                self.marker_file = open(os.path.join(self.dpath, f"interactive_{os.getpid()}.lock"), 'a')
+                fcntl.flock(self.marker_file, fcntl.LOCK_EX)
+
+    def exit(self):
+        with self.lock:
+            self.nactive -= 1
+            if self.nactive == 0:
+                os.remove(self.marker_file.name)
+                self.marker_file.close()  # releases lock
+                self.marker_file = None
+
+    def active(self):
+        """
+        Whether any process, including this one, holds an interactive marker. Checked at most once per POLL_INTERVAL.
+        """
+        now = time.monotonic()
+        if now - self.checked >= POLL_INTERVAL:
+            self.checked, self.is_active = now, any(self.locked(fpath) for fpath in glob.glob(os.path.join(self.dpath, "interactive_*.lock")))
+        return self.is_active
+
+    @staticmethod
+    def locked(fpath):
+        try:
+            with open(fpath, 'r') as marker_file:
+                try:
+                    fcntl.flock(marker_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return True
+                return False
+        except FileNotFoundError:  # removed by its process meanwhile
+            return False
+
+
+_interactive_marker = InteractiveMarker()
+
+
+@contextmanager
+def api_priority(priority):
+    """
+    Run all API requests issued within the context, including from async tasks it creates, in the given priority lane.
+    Interactive lane also holds back bulk requests of other processes until the context exits.
+    """
+    token = _priority.set(priority)
+    if priority == PRIORITY_INTERACTIVE:
+        _interactive_marker.enter()
+    try:
+        yield
+    finally:
+        if priority == PRIORITY_INTERACTIVE:
+            _interactive_marker.exit()
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at capacity per minute.
+    """
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)  # a request larger than capacity waits for a full bucket
+        return 0 if self.level >= amount else (amount - self.level) * 60 / self.capacity
+
+    def consume(self, amount):
+        self.level -= amount
+
+    def sync(self, limit, remaining):
+        """
+        Align bucket with rate limit headers, which also reflect usage by other processes sharing the API key.
+        """
+        self.refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+
+class APIScheduler:
+    def __init__(self, rpm=500, tpm=300000, max_concurrency=16, min_concurrency=1, max_retries=6, backoff_base=1.0, backoff_max=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.lock = threading.Lock()
+        self.buckets = {}  # model -> requests and tokens buckets
+        self.concurrency = float(max_concurrency)  # adaptive limit on in-flight requests
+        self.inflight = 0
+        self.waiting = {}  # model -> heap of its waiting requests ordered by priority then arrival
+        self.counter = itertools.count()
+
+    def get_buckets(self, model):
+        if model not in self.buckets:
+            self.buckets[model] = {"requests": TokenBucket(self.rpm), "tokens": TokenBucket(self.tpm)}
+        return self.buckets[model]
+
+    def set_max_concurrency(self, max_concurrency):
+        with self.lock:
+            self.max_concurrency = max_concurrency
+            self.concurrency = min(self.concurrency, max_concurrency)
+
+    def enqueue(self, priority, model, est_tokens):
+        ticket = (priority, next(self.counter), model, est_tokens)
+        with self.lock:
+            heapq.heappush(self.waiting.setdefault(model, []), ticket)
+        return ticket
+
+    def dequeue(self, ticket):
+        with self.lock:
+            waiting = self.waiting.get(ticket[2], [])
+            if ticket in waiting:
+                waiting.remove(ticket)
+                heapq.heapify(waiting)
+
+    def rate_wait(self, model, est_tokens):
+        """
+        Seconds until requests and tokens buckets of model allow a request.
+        """
+        buckets = self.get_buckets(model)
+        return max(buckets["requests"].wait_time(1), buckets["tokens"].wait_time(est_tokens))
+
+    def try_admit(self, ticket):
+        """
+        Admit the request if it is next in line for its model and limits allow, otherwise return seconds to wait.
+        Requests of a model waiting on its rate limits do not hold back requests of other models,
+        but among models whose limits allow a request, in-flight slots go by priority then arrival.
+        """
+        with self.lock:
+            priority, _, model, est_tokens = ticket
+            if self.waiting[model][0] != ticket or self.inflight >= int(self.concurrency):
+                return POLL_INTERVAL
+            if priority > PRIORITY_INTERACTIVE and _interactive_marker.active():  # interactive requests in some process
+                return POLL_INTERVAL
+            wait = self.rate_wait(model, est_tokens)
+            if wait > 0:
+                return wait
+            if any(waiting[0] < ticket and self.rate_wait(waiting[0][2], waiting[0][3]) == 0 for waiting in self.waiting.values() if waiting):
+                return POLL_INTERVAL  # earlier request of another model goes first
+            heapq.heappop(self.waiting[model])
+            buckets = self.get_buckets(model)
+            buckets["requests"].consume(1)
+            buckets["tokens"].consume(est_tokens)
+            self.inflight += 1
+            return 0
+
+    def acquire(self, model, est_tokens, priority):
+        ticket = self.enqueue(priority, model, est_tokens)
+        try:
+            while (wait := self.try_admit(ticket)) > 0:
+                time.sleep(min(wait, POLL_INTERVAL))
+        except BaseException:
+            self.dequeue(ticket)
+            raise
+
+    async def aacquire(self, model, est_tokens, priority):
+        ticket = self.enqueue(priority, model, est_tokens)
+        try:
+            while (wait := self.try_admit(ticket)) > 0:
+                await asyncio.sleep(min(wait, POLL_INTERVAL))
+        except BaseException:
+            self.dequeue(ticket)
+            raise
+
+    def release(self, throttled=False):
+        """
+        Free an in-flight slot. Additive increase of concurrency on success, multiplicative decrease on throttling.
+        """
+        with self.lock:
+            self.inflight -= 1
+            if throttled:
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def observe(self, raw_response, model, est_tokens):
+        """
+        Update buckets from rate limit headers and actual token usage, then return the parsed response.
+        """
+        headers = raw_response.headers
+        response = raw_response.parse()
+        usage = getattr(response, "usage", None)
+        with self.lock:
+            buckets = self.get_buckets(model)
+            if usage is not None:
+                buckets["tokens"].consume(usage.total_tokens - est_tokens)
+            buckets["requests"].sync(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"))
+            buckets["tokens"].sync(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"))
+        return response
+
+    def backoff(self, ntries, error):
+        """
+        Exponential backoff with full jitter. Honor server's retry-after if provided.
+        """
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, self.backoff_base)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** ntries))
+
+    def call(self, send, model, est_tokens):
+        """
+        Send a request returning a raw response, e.g., client.chat.completions.with_raw_response.create.
+        Retry transient errors up to max_retries times then raise. Other errors are raised immediately.
+        """
+        priority = _priority.get()
+        for ntries in range(self.max_retries + 1):
+            self.acquire(model, est_tokens, priority)
+            try:
+                raw_response = send()
+            except RETRYABLE_ERRORS as e:
+                self.release(throttled=isinstance(e, openai.RateLimitError))
+                if ntries == self.max_retries:
+                    raise
+                delay = self.backoff(ntries, e)
+                logging.info(f"{ntries}: {type(e).__name__} from {model}. retry in {delay:.1f} sec...")
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release()
+            return self.observe(raw_response, model, est_tokens)
+
+    async def acall(self, send, model, est_tokens):
+        """
+        Async version of call. send is a coroutine function.
+        """
+        priority = _priority.get()
+        for ntries in range(self.max_retries + 1):
+            await self.aacquire(model, est_tokens, priority)
+            try:
+                raw_response = await send()
+            except RETRYABLE_ERRORS as e:
+                self.release(throttled=isinstance(e, openai.RateLimitError))
+                if ntries == self.max_retries:
+                    raise
+                delay = self.backoff(ntries, e)
+                logging.info(f"{ntries}: {type(e).__name__} from {model}. retry in {delay:.1f} sec...")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release()
+            return self.observe(raw_response, model, est_tokens)
+
+
+def get_scheduler():
+    """
+    Scheduler shared by all API requests in this process. Limits are configured by environment variables.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = APIScheduler(
+            rpm=int(os.getenv("OPENAI_RPM", 500)),
+            tpm=int(os.getenv("OPENAI_TPM", 300000)),
+            max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", 16)),
+            max_retries=int(os.getenv("OPENAI_MAX_RETRIES", 6)),
+        )
+    return _scheduler
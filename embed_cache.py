@@ -0,0 +1,176 @@
+"""
+Persistent embedding cache shared by REG, RAG and relation matching across locations and concurrent processes.
+Key is a hash of embedding model, dimension and normalized input text, so a text is embedded at most once per model.
+Embeddings are stored as float16 bytes. Least recently used entries are evicted beyond max entries or size.
+Access times of hits are written in batches, so lookups by parallel workers do not contend for the write lock.
+Run this file to print cache stats or invalidate embeddings, e.g., of a model whose outputs changed.
+"""
+import os
+import time
+import atexit
+import argparse
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+import numpy as np
+
+
+EMBED_CACHE_FPATH = os.getenv("EMBED_CACHE_FPATH", os.path.join(os.path.expanduser("~"), "ground", "data", "embed_cache.sqlite"))
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", 200000))
+EMBED_CACHE_MAX_MB = int(os.getenv("EMBED_CACHE_MAX_MB", 2048))
+EVICT_EVERY = 1000  # check cache size every this many insertions
+TOUCH_EVERY = 256  # write access times of this many hits at once
+
+_embed_cache = None
+
+
+def normalize_text(txt):
+    """
+    Unicode NFC form with whitespace collapsed, so texts that only differ in spacing share an embedding.
+    """
+    return " ".join(unicodedata.normalize("NFC", txt).split())
+
+
+class EmbedCache:
+    def __init__(self, db_fpath, max_entries=EMBED_CACHE_MAX_ENTRIES, max_bytes=EMBED_CACHE_MAX_MB * 2**20, dtype=np.float16):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.nhits, self.nmisses, self.nputs, self.nevicted = 0, 0, 0, 0
+        self.touched = {}  # key to access time of hits not written yet
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_fpath)), exist_ok=True)
+        self.conn = sqlite3.connect(db_fpath, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # readers do not block writer from other processes
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeds (key TEXT PRIMARY KEY, model TEXT, dim INTEGER, embed BLOB, used REAL DEFAULT 0)")
+        if "used" not in [column[1] for column in self.conn.execute("PRAGMA table_info(embeds)")]:
+            self.conn.execute("ALTER TABLE embeds ADD COLUMN used REAL DEFAULT 0")  # cache created before eviction
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeds_used ON embeds (used)")
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(model, dim, txt):
+        return hashlib.sha256(f"{model}\n{dim}\n{txt}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def decode(blob, dim):
+        """
+        float32 embedding from bytes, stored as float16, or as float32 by caches created before float16 storage.
+        """
+        return np.frombuffer(blob, dtype=np.float16 if len(blob) == 2 * dim else np.float32).astype(np.float32).tolist()
+
+    def get_many(self, model, dim, txts):
+        """
+        Look up embeddings of normalized texts and mark them recently used. Missing ones are None.
+        """
+        keys = [self.make_key(model, dim, txt) for txt in txts]
+        key2embed = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):  # stay below max number of SQL variables
+                keys_batch = keys[start: start + 500]
+                placeholders = ",".join("?" * len(keys_batch))
+                key2embed.update(self.conn.execute(f"SELECT key, embed FROM embeds WHERE key IN ({placeholders})", keys_batch).fetchall())
+            self.touched.update(dict.fromkeys(key2embed, time.time()))
+            if len(self.touched) >= TOUCH_EVERY:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.write_touched()
+                self.conn.execute("COMMIT")
+            nhits = sum(key in key2embed for key in keys)
+            self.nhits += nhits
+            self.nmisses += len(keys) - nhits
+        return [self.decode(key2embed[key], dim) if key in key2embed else None for key in keys]
+
+    def put_many(self, model, dim, txts, embeds):
+        now = time.time()
+        rows = [(self.make_key(model, dim, txt), model, dim, np.asarray(embed, dtype=self.dtype).tobytes(), now) for txt, embed in zip(txts, embeds)]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.write_touched()
+            self.conn.executemany("INSERT OR REPLACE INTO embeds VALUES (?, ?, ?, ?, ?)", rows)
+            if self.nputs // EVICT_EVERY != (self.nputs + len(rows)) // EVICT_EVERY:
+                self.evict()
+            self.conn.execute("COMMIT")
+            self.nputs += len(rows)
+
+    def write_touched(self):
+        """
+        Write access times of hits since last write, within a transaction held by caller.
+        """
+        if self.touched:
+            self.conn.executemany("UPDATE embeds SET used = ? WHERE key = ?", [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+
+    def flush(self):
+        with self.lock:
+            if self.touched:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.write_touched()
+                self.conn.execute("COMMIT")
+
+    def evict(self):
+        """
+        Evict least recently used embeddings until cache is within 90% of both its entries and size limits.
+        """
+        nentries, nbytes = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(embed)), 0) FROM embeds").fetchone()
+        if nentries > self.max_entries or nbytes > self.max_bytes:
+            self.nevicted += self.conn.execute("""
+                DELETE FROM embeds WHERE key IN (
+                    SELECT key FROM (SELECT key, ROW_NUMBER() OVER win AS rank, SUM(LENGTH(embed)) OVER win AS cum_nbytes
+                                     FROM embeds WINDOW win AS (ORDER BY used DESC ROWS UNBOUNDED PRECEDING))
+                    WHERE rank > ? OR cum_nbytes > ?
+                )
+            """, (int(self.max_entries * 0.9), int(self.max_bytes * 0.9))).rowcount
+
+    def invalidate(self, model=None):
+        """
+        Delete cached embeddings of a model, or all of them.
+        """
+        with self.lock:
+            self.touched = {}
+            if model:
+                return self.conn.execute("DELETE FROM embeds WHERE model = ?", (model,)).rowcount
+            return self.conn.execute("DELETE FROM embeds").rowcount
+
+    def get_or_embed(self, model, dim, txts, embed_new):
+        """
+        Embeddings of normalized texts in order. Missing unique texts are embedded in one call of embed_new(txts) then cached.
+        """
+        embeds = self.get_many(model, dim, txts)
+        txts_new = list(dict.fromkeys(txt for txt, embed in zip(txts, embeds) if embed is None))
+        if txts_new:
+            txt2embed = dict(zip(txts_new, embed_new(txts_new)))
+            self.put_many(model, dim, txts_new, txt2embed.values())
+            embeds = [txt2embed[txt] if embed is None else embed for txt, embed in zip(txts, embeds)]
+        return embeds
+
+    def stats(self):
+        with self.lock:
+            nentries, nbytes = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(embed)), 0) FROM embeds").fetchone()
+        nlookups = self.nhits + self.nmisses
+        return {"hits": self.nhits, "misses": self.nmisses, "hit_rate": self.nhits / nlookups if nlookups else 0.0,
+                "puts": self.nputs, "evicted": self.nevicted, "entries": nentries, "mb": nbytes / 2**20}
+
+
+def get_embed_cache():
+    """
+    Embedding cache shared by all embedding backends in this process. Disabled if EMBED_CACHE=0.
+    """
+    global _embed_cache
+    if _embed_cache is None and os.getenv("EMBED_CACHE", "1") != "0":
+        _embed_cache = EmbedCache(EMBED_CACHE_FPATH)
+    return _embed_cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invalidate", action="store_true", help="delete cached embeddings of --model, or all of them.")
+    parser.add_argument("--model", type=str, default=None, help="embedding model, e.g., text-embedding-3-large.")
+    args = parser.parse_args()
+
+    embed_cache = EmbedCache(EMBED_CACHE_FPATH)
+    if args.invalidate:
+        print(f"Deleted {embed_cache.invalidate(args.model)} embeddings from {EMBED_CACHE_FPATH}")
+    print(embed_cache.stats())
@@ -0,0 +1,83 @@
+"""
+Compact form of unit-norm landmark embeddings for REG.
+Reduce dimension by Matryoshka-style truncation, which text-embedding-3 models are trained to support,
+or by a PCA projection fitted on the landmarks of a map. Then quantize to float16, or to int8 with a per-vector scale.
+"""
+import numpy as np
+
+from embed_store import l2_normalize
+
+
+SCORE_BLOCK_SIZE = 4096  # landmark rows upcast to float32 at a time when scoring
+PCA_FIT_SIZE = 20000  # landmarks sampled to fit PCA projection
+
+
+class EmbedCodec:
+    def __init__(self, dim=None, reduce="truncate", dtype="float32"):
+        if reduce not in ["truncate", "pca"]:
+            raise ValueError(f"ERROR: dimension reduction {reduce} not recognized")
+        if dtype not in ["float32", "float16", "int8"]:
+            raise ValueError(f"ERROR: embedding dtype {dtype} not recognized")
+        self.dim = dim
+        self.reduce = reduce
+        self.dtype = dtype
+        self.mean, self.components = None, None  # PCA projection
+
+    @property
+    def name(self):
+        return f"{self.reduce}{self.dim}_{self.dtype}" if self.dim else self.dtype
+
+    def fit(self, embeds):
+        """
+        Fit PCA projection on embeddings of a map if needed. Dimension is at most the number of landmarks.
+        """
+        if self.reduce == "pca" and self.dim:
+            embeds = np.asarray(embeds[::max(1, len(embeds) // PCA_FIT_SIZE)], dtype=np.float32)
+            self.mean = embeds.mean(axis=0)
+            _, _, vt = np.linalg.svd(embeds - self.mean, full_matrices=False)
+            self.components = np.ascontiguousarray(vt[:self.dim])
+        return self
+
+    def project(self, embeds):
+        embeds = np.atleast_2d(np.asarray(embeds, dtype=np.float32))
+        if self.dim and self.reduce == "pca":
+            embeds = (embeds - self.mean) @ self.components.T
+        elif self.dim:
+            embeds = embeds[:, :self.dim]
+        return l2_normalize(embeds)
+
+    def encode(self, embeds):
+        """
+        :return: codes, and per-vector scales that map int8 codes back to unit norm (None for float dtypes)
+        """
+        embeds = self.project(embeds)
+        if self.dtype == "int8":
+            max_abs = np.abs(embeds).max(axis=1, keepdims=True)
+            quant_scales = np.divide(127, max_abs, out=np.zeros_like(max_abs), where=max_abs > 0)  # zero rows stay zero codes
+            codes = np.round(embeds * quant_scales).astype(np.int8)
+            scales = 1 / np.maximum(np.linalg.norm(codes.astype(np.float32), axis=1), 1)
+            return codes, scales.astype(np.float32)
+        return embeds.astype(self.dtype), None
+
+    def score(self, query_embeds, codes, scales):
+        """
+        Cosine similarities of full-dimension query embeddings to encoded landmarks.
+        Codes are upcast block by block, so the float32 landmark matrix is never materialized.
+        """
+        queries = self.project(query_embeds)
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK_SIZE):
+            block = codes[start: start + SCORE_BLOCK_SIZE].astype(np.float32, copy=False)
+            scores[:, start: start + SCORE_BLOCK_SIZE] = queries @ block.T
+        if scales is not None:
+            scores *= scales
+        return scores
+
+
+def get_codec(dim=None, reduce="truncate", dtype="float32"):
+    """
+    Codec of compact embedding mode, or None to keep full float32 embeddings.
+    """
+    if not dim and dtype == "float32":
+        return None
+    return EmbedCodec(dim, reduce, dtype)
@@ -0,0 +1,222 @@
+"""
+Per-map store of landmark embeddings shared by REG workers.
+embeds.npy: float32 matrix of unit-norm embeddings, one row per image or landmark, memory-mapped read-only.
+index.json: id, modality and content hash of each row. Rewrites group rows by modality so each modality is a contiguous slice.
+Rows are never overwritten in place: rows of changed and deleted landmarks are tombstoned (modality None) and changed ones appended,
+so workers that mapped the store keep the contents they loaded until they reload it.
+store.lock: processes sharing a map hold it shared to load the store and exclusive to update it.
+"""
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+
+from utils import load_from_file, save_to_file
+
+
+MODALITIES = ["image", "text"]  # row order in store
+COMPACT_RATIO = 0.25  # rewrite store when this fraction of rows are tombstones
+
+
+def l2_normalize(embeds):
+    """
+    Normalize vectors, i.e., last axis, to unit length so cosine similarity is a dot product.
+    """
+    embeds = np.ascontiguousarray(embeds, dtype=np.float32)
+    norms = np.linalg.norm(embeds, axis=-1, keepdims=True)
+    return embeds / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def content_hash(content):
+    """
+    Hash of raw bytes, e.g., an image file, or of a JSON-serializable description.
+    """
+    if not isinstance(content, bytes):
+        content = json.dumps(content, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_hash(fpath):
+    with open(fpath, 'rb') as rfile:
+        return content_hash(rfile.read())
+
+
+@contextmanager
+def file_lock(lock_fpath, exclusive=True):
+    """
+    Inter-process lock on a lock file, e.g., so concurrent experiments on a map do not interleave reads and writes of shared files.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(lock_fpath)), exist_ok=True)
+    with open(lock_fpath, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def append_rows(npy_fpath, rows):
+    """
+    Append rows to a 2D .npy file in place and grow the shape in its header, which numpy pads for growth.
+    :return: False if header has no room for the new shape
+    """
+    with open(npy_fpath, 'r+b') as rwfile:
+        version = np.lib.format.read_magic(rwfile)
+        header_start = rwfile.tell()
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(rwfile)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(rwfile)
+        data_start = rwfile.tell()
+        len_size = 2 if version == (1, 0) else 4
+
+        header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": fortran_order, "shape": (shape[0] + len(rows), shape[1])}
+        header = ("{" + "".join(f"'{key}': {repr(value)}, " for key, value in header.items()) + "}").encode("latin1")
+        header_size = data_start - header_start - len_size
+        if fortran_order or len(header) + 1 > header_size:
+            return False
+
+        rwfile.seek(0, os.SEEK_END)
+        rwfile.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())  # data before header so a crash keeps old shape
+        rwfile.seek(header_start + len_size)
+        rwfile.write(header.ljust(header_size - 1) + b"\n")
+    return True
+
+
+class EmbedStore:
+    def __init__(self, store_dpath):
+        self.store_dpath = store_dpath
+        self.embeds_fpath = os.path.join(store_dpath, "embeds.npy")
+        self.index_fpath = os.path.join(store_dpath, "index.json")
+        self.lock_fpath = os.path.join(store_dpath, "store.lock")
+        with file_lock(self.lock_fpath, exclusive=False):
+            self.load()
+
+    def load(self):
+        self.ids, self.modalities, self.hashes = [], [], []
+        self.embeds = np.zeros((0, 0), dtype=np.float32)
+        if os.path.isfile(self.index_fpath) and os.path.isfile(self.embeds_fpath):
+            index = load_from_file(self.index_fpath)
+            embeds = np.load(self.embeds_fpath, mmap_mode='r')
+            if len(index["ids"]) == embeds.shape[0]:  # otherwise interrupted while writing, rebuild
+                self.ids, self.modalities, self.hashes = index["ids"], index["modalities"], index["hashes"]
+                self.embeds = embeds
+        self.offsets = {(modality, lmk_id): row for row, (modality, lmk_id) in enumerate(zip(self.modalities, self.ids)) if modality}
+        self.ndeleted = self.modalities.count(None)  # tombstones of changed and deleted landmarks until compaction
+
+    def lookup(self, modality, lmk_id, lmk_hash):
+        """
+        Row of stored embedding if its content is unchanged, otherwise None.
+        """
+        row = self.offsets.get((modality, lmk_id))
+        return row if row is not None and self.hashes[row] == lmk_hash else None
+
+    def modality_rows(self, modality):
+        return [row for row, row_modality in enumerate(self.modalities) if row_modality == modality]
+
+    def view(self, modalities):
+        """
+        Ids, modalities and embeddings of given modalities. Zero-copy slice of memory-mapped matrix if their rows are contiguous,
+        in which case ids and modalities of tombstoned rows in between are None and their embeddings are stale.
+        """
+        rows = [row for row, modality in enumerate(self.modalities) if modality in modalities]
+        if not rows:
+            return [], [], self.embeds[:0]
+        start, stop = rows[0], rows[-1] + 1
+        if all(modality in modalities or modality is None for modality in self.modalities[start: stop]):
+            return [lmk_id if modality else None for lmk_id, modality in zip(self.ids[start: stop], self.modalities[start: stop])], \
+                self.modalities[start: stop], self.embeds[start: stop]
+        return [self.ids[row] for row in rows], [self.modalities[row] for row in rows], np.asarray(self.embeds[rows])  # modalities interleaved by patches
+
+    def fingerprint(self, modalities):
+        """
+        Hash of ids, contents and row positions of landmarks of given modalities, e.g., to key indices built on them.
+        Indices refer to rows, so compaction that moves rows changes the fingerprint even if landmarks are unchanged.
+        """
+        lmks = [f"{row}\t{lmk_id}\t{lmk_hash}" for row, (lmk_id, modality, lmk_hash) in enumerate(zip(self.ids, self.modalities, self.hashes))
+                if modality in modalities]
+        return content_hash("\n".join([str(len(self.ids))] + lmks).encode("utf-8"))
+
+    def sync(self, modality, lmk_ids, lmk_hashes, embed_new, compact=False):
+        """
+        Bring rows of a modality up to date with current landmarks and their content hashes.
+        Embed added and changed landmarks in one batch by embed_new(idxs). Patch store by appending rows,
+        or rewrite it compacted if compact, store is new, or tombstones exceed COMPACT_RATIO of rows.
+        Hold the store lock throughout, so concurrent processes update the store one at a time and each sees the others' updates.
+        :return: numbers of added, changed and deleted landmarks
+        """
+        with file_lock(self.lock_fpath):
+            self.load()  # another process may have updated store since it was loaded
+            lmk_ids_current = set(lmk_ids)
+            idxs_new = [idx for idx, (lmk_id, lmk_hash) in enumerate(zip(lmk_ids, lmk_hashes)) if self.lookup(modality, lmk_id, lmk_hash) is None]
+            rows_deleted = [row for row in self.modality_rows(modality) if self.ids[row] not in lmk_ids_current]
+            nchanged = sum((modality, lmk_ids[idx]) in self.offsets for idx in idxs_new)
+            delta = {"added": len(idxs_new) - nchanged, "changed": nchanged, "deleted": len(rows_deleted)}
+            if not idxs_new and not rows_deleted and not (compact and self.ndeleted):
+                return delta
+
+            embeds_new = l2_normalize(embed_new(idxs_new)) if idxs_new else None
+            same_dim = embeds_new is None or embeds_new.shape[1] == self.embeds.shape[1]
+            if compact or not self.ids or not same_dim or self.ndeleted + nchanged + len(rows_deleted) > COMPACT_RATIO * len(self.ids) \
+                    or not self.patch(modality, lmk_ids, lmk_hashes, idxs_new, embeds_new, rows_deleted):
+                idx2embed = dict(zip(idxs_new, embeds_new)) if idxs_new else {}
+                embeds = [idx2embed[idx] if idx in idx2embed else self.embeds[self.offsets[(modality, lmk_id)]] for idx, lmk_id in enumerate(lmk_ids)]
+                self.rewrite(modality, lmk_ids, lmk_hashes, embeds)
+            return delta
+
+    def patch(self, modality, lmk_ids, lmk_hashes, idxs_new, embeds_new, rows_deleted):
+        """
+        Copy on write: append rows of added and changed landmarks, and tombstone old rows of changed and deleted ones in the index.
+        Rows already in the matrix are not modified, so workers that mapped the store score the contents they loaded
+        and pick up the new index and rows when they next load it.
+        :return: False if rows could not be appended in place
+        """
+        ids, modalities, hashes = list(self.ids), list(self.modalities), list(self.hashes)
+        rows_changed = [self.offsets[(modality, lmk_ids[idx])] for idx in idxs_new if (modality, lmk_ids[idx]) in self.offsets]
+        if idxs_new:
+            if not append_rows(self.embeds_fpath, embeds_new):
+                return False
+            ids += [lmk_ids[idx] for idx in idxs_new]
+            modalities += [modality] * len(idxs_new)
+            hashes += [lmk_hashes[idx] for idx in idxs_new]
+        for row in rows_changed + rows_deleted:
+            modalities[row], hashes[row] = None, None
+
+        self.save_index(ids, modalities, hashes)
+        self.load()
+        return True
+
+    def rewrite(self, modality, lmk_ids, lmk_hashes, embeds):
+        """
+        Replace all rows of a modality, keep rows of other modalities and drop deleted ones, then rewrite and remap the store.
+        Rows are grouped by modality. New matrix is written next to the old one then renamed, so workers that mapped the old one are unaffected.
+        """
+        ids, modalities, hashes, rows = [], [], [], []
+        for row_modality in MODALITIES:
+            if row_modality == modality:
+                ids += lmk_ids
+                modalities += [modality] * len(lmk_ids)
+                hashes += lmk_hashes
+                if lmk_ids:
+                    rows.append(np.asarray(embeds, dtype=np.float32))
+            else:
+                modality_rows = self.modality_rows(row_modality)
+                ids += [self.ids[row] for row in modality_rows]
+                modalities += [row_modality] * len(modality_rows)
+                hashes += [self.hashes[row] for row in modality_rows]
+                rows.append(np.asarray(self.embeds[modality_rows]))
+        rows = [embeds for embeds in rows if len(embeds)]
+
+        os.makedirs(self.store_dpath, exist_ok=True)
+        embeds_tmp_fpath = os.path.join(self.store_dpath, f"embeds_{os.getpid()}.tmp.npy")
+        np.save(embeds_tmp_fpath, np.concatenate(rows) if rows else np.zeros((0, 0), dtype=np.float32))
+        os.replace(embeds_tmp_fpath, self.embeds_fpath)
+        self.save_index(ids, modalities, hashes)
+        self.load()
+
+    def save_index(self, ids, modalities, hashes):
+        index_tmp_fpath = os.path.join(self.store_dpath, f"index_{os.getpid()}.tmp.json")
+        save_to_file({"ids": ids, "modalities": modalities, "hashes": hashes}, index_tmp_fpath)
+        os.replace(index_tmp_fpath, self.index_fpath)
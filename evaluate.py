@@ -1,10 +1,11 @@
+import os
 import logging
 from collections import defaultdict
 import string
 import spot
 
 from srer import PROPS
-from utils import load_from_file
+from utils import load_from_file, stats_fpath
 
 
 def eval_srer(true_results_fpath, srer_out_fpath):
@@ -135,6 +136,9 @@ def eval_reg(true_results_fpath, topk, reg_out_fpath):
 
     len2acc = {nprops: ncorrects / len2total[nprops] for nprops, ncorrects in len2ncorrects.items()}
     logging.info(f"REG length vs. acc: {len2acc}")
+    reg_stats_fpath = stats_fpath(reg_out_fpath)
+    if os.path.isfile(reg_stats_fpath):  # memory and compute of landmark index that produced these groundings
+        logging.info(f"REG index stats: {load_from_file(reg_stats_fpath)}")
     len2acc = {nprops: (ncorrects, len2total[nprops]) for nprops, ncorrects in len2ncorrects.items()}
     return len2acc
 
@@ -8,10 +8,15 @@ from shutil import copy2
 import spot
 
 from srer import PROPS, run_exp_srer
-from reg import run_exp_reg
+from reg import ABLATIONS, run_exp_reg, run_exp_reg_ablations
+from embed_codec import get_codec
+from ann_index import IVF_NPROBE
 from spg import run_exp_spg
 from lt import run_exp_lt
 from evaluate import eval_srer, eval_reg, eval_spg, eval_lt
+from response_cache import get_cache
+from embed_cache import get_embed_cache
+from openai_models import import_legacy_embeds
 from utils import load_from_file, copy_lt_outs
 
 
@@ -107,11 +112,18 @@ def eval_full_system(true_results_fpath, lt_out_fpath):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--loc", type=str, default="providence", choices=["providence", "auckland", "boston", "san_francisco"], help="env name.")
-    parser.add_argument("--ablate", type=str, default="both", choices=["both", "image", "text", None], help="ablate out a modality.")
+    parser.add_argument("--ablate", type=str, default="both", choices=["both", "image", "text", "all", None], help="ablate out a modality, or all: every ablation in one pass.")
     parser.add_argument("--nsamples", type=int, default=None, help="number of sample utts per LTL formula or None for all")
     parser.add_argument("--seed", type=int, default=0, help="seed to random sampler.")  # 0, 1, 2, 42, 111
     parser.add_argument("--topk", type=int, default=10, help="top k most likely landmarks grounded by REG.")
+    parser.add_argument("--embed_backend", type=str, default="openai", choices=["openai", "local"], help="embedding backend for REG, RAG and relation matching.")
+    parser.add_argument("--embed_dim", type=int, default=None, help="reduce REG landmark and query embeddings to this dimension or None for full.")
+    parser.add_argument("--embed_reduce", type=str, default="truncate", choices=["truncate", "pca"], help="Matryoshka truncation or PCA fitted per map.")
+    parser.add_argument("--embed_dtype", type=str, default="float32", choices=["float32", "float16", "int8"], help="storage and scoring dtype of REG landmark embeddings.")
+    parser.add_argument("--reg_index", type=str, default="exact", choices=["exact", "ivf"], help="exact or approximate (IVF, probed cells set by REG_IVF_NPROBE) REG landmark search.")
     args = parser.parse_args()
+    codec = get_codec(args.embed_dim, args.embed_reduce, args.embed_dtype)
+    reg_id = "_".join(([codec.name] if codec else []) + ([f"ivf_nprobe{IVF_NPROBE}"] if args.reg_index == "ivf" else []))  # REG index variant
     loc_id = f"{args.loc}_n{args.nsamples}_seed{args.seed}" if args.nsamples else f"{args.loc}_all_seed{args.seed}"
 
     data_dpath = os.path.join(os.path.expanduser("~"), "ground", "data")
@@ -119,9 +131,7 @@ if __name__ == "__main__":
     osm_fpath = os.path.join(data_dpath, "osm_ablate" if args.ablate else "osm", f"{args.loc}.json")
     utts_fpath = os.path.join(data_dpath, "dataset", f"{args.loc}_ablate" if args.ablate else f"{args.loc}", f"{loc_id}_utts.txt")
     model_fpath = os.path.join(os.path.expanduser("~"), "ground", "models", "checkpoint-best")
-    rel_embeds_fpath = os.path.join(data_dpath, f"known_rel_embeds.json")
-    reg_in_cache_fpath = os.path.join(data_dpath, f"reg_in_cache_{args.loc}.pkl")
-    results_dpath = os.path.join(os.path.expanduser("~"), "ground", f"results_full_ablate_{args.ablate}" if args.ablate else "results_full", loc_id)
+    results_dpath = os.path.join(os.path.expanduser("~"), "ground", f"results_full_ablate_{args.ablate}" if args.ablate else "results_full", f"{loc_id}_{reg_id}" if reg_id else loc_id)
     os.makedirs(results_dpath, exist_ok=True)
     srer_out_fname = "srer_outs.json"
     srer_out_fpath = os.path.join(results_dpath, srer_out_fname)
@@ -129,6 +139,7 @@ if __name__ == "__main__":
     spg_out_fpath = os.path.join(results_dpath, srer_out_fname.replace("srer", "spg"))
     lt_out_fpath = os.path.join(results_dpath, srer_out_fname.replace("srer", "lt"))
     true_results_fpath = os.path.join(data_dpath, "dataset", f"{args.loc}_ablate" if args.ablate else args.loc, f"{loc_id}_true_results.json")
+    res_fpath = os.path.join(data_dpath, "dataset", f"{args.loc}_ablate" if args.ablate else args.loc, f"{args.loc}_res.json")  # landmark aliases
 
     logging.basicConfig(level=logging.INFO,
                         format='%(message)s',
@@ -139,48 +150,89 @@ if __name__ == "__main__":
     )
     logging.info(f"***** Full System Evaluation Ablate {args.ablate}: {loc_id}\n" if args.ablate else f"***** Full System Evaluation: {loc_id}\n")
     logging.info(f"{graph_dpath}\n{osm_fpath}\n{utts_fpath}\n{true_results_fpath}\n{results_dpath}\n")
+    import_legacy_embeds(data_dpath, args.loc, args.embed_backend)
 
-    # Spatial Referring Expression Recognition (SRER)
-    # srer_out_fpath_modular = os.path.join(os.path.expanduser("~"), "ground", f"results_modular_ablate_{args.ablate}", loc_id, srer_out_fname)
-    srer_out_fpath_ablate_txt = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_text", loc_id, srer_out_fname)
-    srer_out_fpath_ablate_img = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_image", loc_id, srer_out_fname)
-    srer_out_fpath_ablate_both = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_both", loc_id, srer_out_fname)
-    # if not os.path.isfile(srer_out_fpath) and os.path.isfile(srer_out_fpath_modular):  # same SRER output for exp_full and  exp_modular
-    #     copy2(srer_out_fpath_modular, srer_out_fpath)
-    # elif not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_txt):  # same SRER output for ablate text and ablate image
-    if not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_txt):  # same SRER output for ablate text and ablate image
-        copy2(srer_out_fpath_ablate_txt, srer_out_fpath)
-    elif not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_img):
-        copy2(srer_out_fpath_ablate_img, srer_out_fpath)
-    elif not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_both):
-        copy2(srer_out_fpath_ablate_both, srer_out_fpath)
-    else:
+    if args.ablate == "all":  # run SRER, REG and LT once for every ablation, write outputs of each to its usual results folder
+        ablate2out_fpath = {}
+        for ablate in ABLATIONS:
+            ablate_results_dpath = results_dpath.replace("results_full_ablate_all", f"results_full_ablate_{ablate}")
+            os.makedirs(ablate_results_dpath, exist_ok=True)
+            ablate2out_fpath[ablate] = {module: os.path.join(ablate_results_dpath, srer_out_fname.replace("srer", module)) for module in ["srer", "reg", "spg", "lt"]}
+
+        # Spatial Referring Expression Recognition (SRER), same outputs for every ablation
         run_exp_srer(utts_fpath, srer_out_fpath)
-    eval_srer(true_results_fpath, srer_out_fpath)
-
-    # Referring Expression Grounding (REG)
-    run_exp_reg(srer_out_fpath, graph_dpath, osm_fpath, args.topk, args.ablate, reg_out_fpath, reg_in_cache_fpath)
-    eval_reg(true_results_fpath, args.topk, reg_out_fpath)
-
-    # Spatial Predicate Grounding (SPG)
-    run_exp_spg(reg_out_fpath, graph_dpath, osm_fpath, args.topk, rel_embeds_fpath, spg_out_fpath)
-    eval_spg(true_results_fpath, args.topk, spg_out_fpath)
-
-    # Lifted Translation (LT)
-    lt_out_fname = os.path.basename(lt_out_fpath)  # lt_outs.json
-    lt_out_fpath_ablate_txt = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_text", loc_id, lt_out_fname)
-    lt_out_fpath_ablate_img = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_image", loc_id, lt_out_fname)
-    lt_out_fpath_ablate_both = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_both", loc_id, lt_out_fname)
-    if not os.path.isfile(lt_out_fpath) and args.ablate and os.path.isfile(lt_out_fpath_ablate_txt):  # same LT output for ablate text and ablate image
-        copy_lt_outs(lt_out_fpath_ablate_txt, lt_out_fpath, spg_out_fpath)
-    elif not os.path.isfile(lt_out_fpath) and args.ablate and os.path.isfile(lt_out_fpath_ablate_img):
-        copy_lt_outs(lt_out_fpath_ablate_img, lt_out_fpath, spg_out_fpath)
-    elif not os.path.isfile(lt_out_fpath) and args.ablate and os.path.isfile(lt_out_fpath_ablate_both):
-        copy_lt_outs(lt_out_fpath_ablate_both, lt_out_fpath, spg_out_fpath)
+        eval_srer(true_results_fpath, srer_out_fpath)
+        for out_fpaths in ablate2out_fpath.values():
+            if not os.path.isfile(out_fpaths["srer"]):
+                copy2(srer_out_fpath, out_fpaths["srer"])
+
+        # Referring Expression Grounding (REG), one pass scoring each query once for every ablation
+        run_exp_reg_ablations(srer_out_fpath, graph_dpath, osm_fpath, args.topk, {ablate: out_fpaths["reg"] for ablate, out_fpaths in ablate2out_fpath.items()},
+                              args.embed_backend, codec, args.reg_index, res_fpath)
+
+        # Lifted Translation (LT) does not depend on groundings, so translate once and share across ablations
+        run_exp_lt(srer_out_fpath, model_fpath, lt_out_fpath)
+
+        for ablate, out_fpaths in ablate2out_fpath.items():
+            logging.info(f"***** Ablate {ablate}")
+            eval_reg(true_results_fpath, args.topk, out_fpaths["reg"])
+
+            # Spatial Predicate Grounding (SPG)
+            run_exp_spg(out_fpaths["reg"], graph_dpath, osm_fpath, args.topk, out_fpaths["spg"], args.embed_backend)
+            eval_spg(true_results_fpath, args.topk, out_fpaths["spg"])
+
+            if not os.path.isfile(out_fpaths["lt"]):
+                copy_lt_outs(lt_out_fpath, out_fpaths["lt"], out_fpaths["spg"])
+            eval_lt(true_results_fpath, out_fpaths["lt"])
+            eval_full_system(true_results_fpath, out_fpaths["lt"])
+
     else:
-        run_exp_lt(spg_out_fpath, model_fpath, lt_out_fpath)
+        # Spatial Referring Expression Recognition (SRER)
+        # srer_out_fpath_modular = os.path.join(os.path.expanduser("~"), "ground", f"results_modular_ablate_{args.ablate}", loc_id, srer_out_fname)
+        srer_out_fpath_ablate_txt = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_text", loc_id, srer_out_fname)
+        srer_out_fpath_ablate_img = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_image", loc_id, srer_out_fname)
+        srer_out_fpath_ablate_both = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_both", loc_id, srer_out_fname)
+        # if not os.path.isfile(srer_out_fpath) and os.path.isfile(srer_out_fpath_modular):  # same SRER output for exp_full and  exp_modular
+        #     copy2(srer_out_fpath_modular, srer_out_fpath)
+        # elif not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_txt):  # same SRER output for ablate text and ablate image
+        if not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_txt):  # same SRER output for ablate text and ablate image
+            copy2(srer_out_fpath_ablate_txt, srer_out_fpath)
+        elif not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_img):
+            copy2(srer_out_fpath_ablate_img, srer_out_fpath)
+        elif not os.path.isfile(srer_out_fpath) and args.ablate and os.path.isfile(srer_out_fpath_ablate_both):
+            copy2(srer_out_fpath_ablate_both, srer_out_fpath)
+        else:
+            run_exp_srer(utts_fpath, srer_out_fpath)
+        eval_srer(true_results_fpath, srer_out_fpath)
+
+        # Referring Expression Grounding (REG)
+        run_exp_reg(srer_out_fpath, graph_dpath, osm_fpath, args.topk, args.ablate, reg_out_fpath, args.embed_backend, codec, args.reg_index, res_fpath)
+        eval_reg(true_results_fpath, args.topk, reg_out_fpath)
+
+        # Spatial Predicate Grounding (SPG)
+        run_exp_spg(reg_out_fpath, graph_dpath, osm_fpath, args.topk, spg_out_fpath, args.embed_backend)
+        eval_spg(true_results_fpath, args.topk, spg_out_fpath)
+
+        # Lifted Translation (LT)
+        lt_out_fname = os.path.basename(lt_out_fpath)  # lt_outs.json
+        lt_out_fpath_ablate_txt = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_text", loc_id, lt_out_fname)
+        lt_out_fpath_ablate_img = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_image", loc_id, lt_out_fname)
+        lt_out_fpath_ablate_both = os.path.join(os.path.expanduser("~"), "ground", "results_full_ablate_both", loc_id, lt_out_fname)
+        if not os.path.isfile(lt_out_fpath) and args.ablate and os.path.isfile(lt_out_fpath_ablate_txt):  # same LT output for ablate text and ablate image
+            copy_lt_outs(lt_out_fpath_ablate_txt, lt_out_fpath, spg_out_fpath)
+        elif not os.path.isfile(lt_out_fpath) and args.ablate and os.path.isfile(lt_out_fpath_ablate_img):
+            copy_lt_outs(lt_out_fpath_ablate_img, lt_out_fpath, spg_out_fpath)
+        elif not os.path.isfile(lt_out_fpath) and args.ablate and os.path.isfile(lt_out_fpath_ablate_both):
+            copy_lt_outs(lt_out_fpath_ablate_both, lt_out_fpath, spg_out_fpath)
+        else:
+            run_exp_lt(spg_out_fpath, model_fpath, lt_out_fpath)
+
+        eval_lt(true_results_fpath, lt_out_fpath)
 
-    eval_lt(true_results_fpath, lt_out_fpath)
+        # Full system evaluation
+        eval_full_system(true_results_fpath, lt_out_fpath)
 
-    # Full system evaluation
-    eval_full_system(true_results_fpath, lt_out_fpath)
+    if get_cache():
+        logging.info(f"LLM response cache: {get_cache().stats()}")
+    if get_embed_cache():
+        logging.info(f"Embedding cache: {get_embed_cache().stats()}")
@@ -8,10 +8,15 @@ from shutil import copy2
 
 from srer import run_exp_srer
 from reg import run_exp_reg
+from embed_codec import get_codec
+from ann_index import IVF_NPROBE
 from spg import run_exp_spg
 from lt import run_exp_lt
 from lt_rag import run_exp_lt_rag
 from evaluate import eval_srer, eval_reg, eval_spg, eval_lt
+from response_cache import get_cache
+from embed_cache import get_embed_cache
+from openai_models import import_legacy_embeds
 
 
 if __name__ == "__main__":
@@ -24,7 +29,14 @@ if __name__ == "__main__":
     parser.add_argument("--topk", type=int, default=10, help="top k most likely landmarks grounded by REG.")
     parser.add_argument("--lt", type=str, default="t5", choices=["t5", "rag"], help="lifted translation model.")
     parser.add_argument("--nexamples", type=int, default=2, help="number of in-context examples if use RAG lifted translation model.")
+    parser.add_argument("--embed_backend", type=str, default="openai", choices=["openai", "local"], help="embedding backend for REG, RAG and relation matching.")
+    parser.add_argument("--embed_dim", type=int, default=None, help="reduce REG landmark and query embeddings to this dimension or None for full.")
+    parser.add_argument("--embed_reduce", type=str, default="truncate", choices=["truncate", "pca"], help="Matryoshka truncation or PCA fitted per map.")
+    parser.add_argument("--embed_dtype", type=str, default="float32", choices=["float32", "float16", "int8"], help="storage and scoring dtype of REG landmark embeddings.")
+    parser.add_argument("--reg_index", type=str, default="exact", choices=["exact", "ivf"], help="exact or approximate (IVF, probed cells set by REG_IVF_NPROBE) REG landmark search.")
     args = parser.parse_args()
+    codec = get_codec(args.embed_dim, args.embed_reduce, args.embed_dtype)
+    reg_id = "_".join(([codec.name] if codec else []) + ([f"ivf_nprobe{IVF_NPROBE}"] if args.reg_index == "ivf" else []))  # REG index variant
     loc_id = f"{args.loc}_n{args.nsamples}_seed{args.seed}" if args.nsamples else f"{args.loc}_all_seed{args.seed}"
     lt_id = f"lt-{args.lt}{args.nexamples}" if args.lt == "rag" else f"{args.lt}"
 
@@ -33,9 +45,7 @@ if __name__ == "__main__":
     osm_fpath = os.path.join(data_dpath, "osm_ablate" if args.ablate else "osm", f"{args.loc}.json")
     utts_fpath = os.path.join(data_dpath, "dataset", f"{args.loc}_ablate" if args.ablate else f"{args.loc}", f"{loc_id}_utts.txt")
     model_fpath = os.path.join(os.path.expanduser("~"), "ground", "models", "checkpoint-best")
-    rel_embeds_fpath = os.path.join(data_dpath, f"known_rel_embeds.json")
-    reg_in_cache_fpath = os.path.join(data_dpath, f"reg_in_cache_{args.loc}.pkl")
-    results_dpath = os.path.join(os.path.expanduser("~"), "ground", f"results_modular_ablate_{args.ablate}" if args.ablate else "results_modular", loc_id)
+    results_dpath = os.path.join(os.path.expanduser("~"), "ground", f"results_modular_ablate_{args.ablate}" if args.ablate else "results_modular", f"{loc_id}_{reg_id}" if reg_id else loc_id)
     os.makedirs(results_dpath, exist_ok=True)
     srer_out_fname = "srer_outs.json"
     srer_out_fpath = os.path.join(results_dpath, srer_out_fname)
@@ -43,6 +53,7 @@ if __name__ == "__main__":
     spg_out_fpath = os.path.join(results_dpath, srer_out_fname.replace("srer", "spg"))
     lt_out_fpath = os.path.join(results_dpath, srer_out_fname.replace("srer", f"lt-{lt_id}"))
     true_results_fpath = os.path.join(data_dpath, "dataset",f"{args.loc}_ablate" if args.ablate else f"{args.loc}", f"{loc_id}_true_results.json")
+    res_fpath = os.path.join(data_dpath, "dataset", f"{args.loc}_ablate" if args.ablate else args.loc, f"{args.loc}_res.json")  # landmark aliases
     ltl_fpath = os.path.join(data_dpath, "dataset", "ltl_samples_sorted.csv")
 
     logging.basicConfig(level=logging.INFO,
@@ -54,6 +65,7 @@ if __name__ == "__main__":
     )
     logging.info(f"***** Modular-wise Evaluation Ablate {args.ablate}: {loc_id}\n" if args.ablate else f"***** Modular-wise Evaluation: {loc_id}\n")
     logging.info(f"{graph_dpath}\n{osm_fpath}\n{utts_fpath}\n{true_results_fpath}\n{results_dpath}\n")
+    import_legacy_embeds(data_dpath, args.loc, args.embed_backend)
 
     if args.module == "srer" or args.module == "all":
         srer_out_fpath_full = os.path.join(os.path.expanduser("~"), "ground", f"results_full_ablate_{args.ablate}" if args.ablate else "results_full", loc_id, srer_out_fname)
@@ -73,16 +85,21 @@ if __name__ == "__main__":
         eval_srer(true_results_fpath, srer_out_fpath)
 
     if args.module == "reg" or args.module == "all":
-        run_exp_reg(true_results_fpath, graph_dpath, osm_fpath, args.topk, args.ablate, reg_out_fpath, reg_in_cache_fpath)
+        run_exp_reg(true_results_fpath, graph_dpath, osm_fpath, args.topk, args.ablate, reg_out_fpath, args.embed_backend, codec, args.reg_index, res_fpath)
         eval_reg(true_results_fpath, args.topk, reg_out_fpath)
 
     if args.module == "spg" or args.module == "all":
-        run_exp_spg(true_results_fpath, graph_dpath, osm_fpath, args.topk, rel_embeds_fpath, spg_out_fpath)
+        run_exp_spg(true_results_fpath, graph_dpath, osm_fpath, args.topk, spg_out_fpath, args.embed_backend)
         eval_spg(true_results_fpath, args.topk, spg_out_fpath)
 
     if args.module == "lt" or args.module == "all":
         if args.lt == "t5":
             run_exp_lt(true_results_fpath, model_fpath, lt_out_fpath)
         elif args.lt == "rag":
-            run_exp_lt_rag(true_results_fpath, lt_out_fpath, data_dpath, ltl_fpath, args.nexamples)
+            run_exp_lt_rag(true_results_fpath, lt_out_fpath, ltl_fpath, args.nexamples, args.embed_backend)
         eval_lt(true_results_fpath, lt_out_fpath)
+
+    if get_cache():
+        logging.info(f"LLM response cache: {get_cache().stats()}")
+    if get_embed_cache():
+        logging.info(f"Embedding cache: {get_embed_cache().stats()}")
@@ -1,26 +1,29 @@
 import os
 import argparse
 
+from api_scheduler import PRIORITY_INTERACTIVE, api_priority
 from srer import srer
 from reg import reg
 from spg import load_lmks, spg
 from lt import Seq2Seq, lt
+from openai_models import import_legacy_embeds
 from utils import load_from_file, save_to_file
 
 
-def ground(graph_dpath, lmk2sym, osm_fpath, model_fpath, utt, ablate, topk, rel_embeds_fpath, reg_in_cache_fpath):
+def ground(graph_dpath, lmk2sym, osm_fpath, model_fpath, utt, ablate, topk, embed_backend="openai", reg_index="exact"):
     """
     Grounding API function
     """
-    # Spatial Referring Expression Recognition (SRER)
-    _, srer_out = srer(utt)  # subsequent module outputs also stored in this dict
+    with api_priority(PRIORITY_INTERACTIVE):  # jump ahead of bulk experiments sharing the API key
+        # Spatial Referring Expression Recognition (SRER)
+        _, srer_out = srer(utt)  # subsequent module outputs also stored in this dict
 
-    # Referring Expression Grounding (REG)
-    reg(graph_dpath, osm_fpath, [srer_out], topk, ablate, reg_in_cache_fpath)
+        # Referring Expression Grounding (REG)
+        reg(graph_dpath, osm_fpath, [srer_out], topk, ablate, embed_backend, index=reg_index)
 
-    # Spatial Predicate Grounding (SPG)
-    landmarks = load_lmks(graph_dpath, osm_fpath)
-    srer_out["grounded_sps"] = spg(landmarks, srer_out, topk, rel_embeds_fpath)
+        # Spatial Predicate Grounding (SPG)
+        landmarks = load_lmks(graph_dpath, osm_fpath)
+        srer_out["grounded_sps"] = spg(landmarks, srer_out, topk, embed_backend=embed_backend)
 
     # Lifted Translation (LT)
     lt_module = Seq2Seq(model_fpath, "t5-base")
@@ -50,6 +53,8 @@ if __name__ == "__main__":
     parser.add_argument("--loc", type=str, default="outdoor", choices=["indoor", "outdoor"], help="env name.")
     parser.add_argument("--ablate", type=str, default=None, choices=["both", "image", "text", None], help="ablate out a modality (indoor: text. outdoor: None).")
     parser.add_argument("--topk", type=int, default=10, help="top k most likely landmarks grounded by REG.")
+    parser.add_argument("--embed_backend", type=str, default="openai", choices=["openai", "local"], help="embedding backend for REG, RAG and relation matching.")
+    parser.add_argument("--reg_index", type=str, default="exact", choices=["exact", "ivf"], help="exact or approximate (IVF, probed cells set by REG_IVF_NPROBE) REG landmark search.")
     args = parser.parse_args()
 
     data_dpath = os.path.join(os.path.expanduser("~"), "ground", "data")
@@ -58,12 +63,11 @@ if __name__ == "__main__":
     lmk2sym = load_from_file(lmk2sym_fpath) if os.path.isfile(lmk2sym_fpath) else {}  # landmark ID to planner symbol used for robot demo
     osm_fpath = os.path.join(data_dpath, "osm", f"{args.loc}.json")
     model_fpath = os.path.join(os.path.expanduser("~"), "ground", "models", "checkpoint-best")
-    rel_embeds_fpath = os.path.join(data_dpath, f"known_rel_embeds.json")
-    reg_in_cache_fpath = os.path.join(data_dpath, f"reg_in_cache_{args.loc}.pkl")
     utt_fpath = os.path.join(data_dpath, f"utts_{args.loc}.txt")
     results_dpath = os.path.join(os.path.expanduser("~"), "ground", "results_spot", args.loc)
     os.makedirs(results_dpath, exist_ok=True)
     out_fpath = os.path.join(results_dpath, "srer_outs.json")
+    import_legacy_embeds(data_dpath, args.loc, args.embed_backend)
 
     utts = [
         # "go to the couch in front of the TV, the couch to the left of the kitchen counter, the kitchen counter between the couch and the refrigerator, the table next to the door, and the chair on the left of the bookshelf in any order",
@@ -73,7 +77,7 @@ if __name__ == "__main__":
 
     ground_outs = []
     for idx, utt in enumerate(utts):
-        ground_out = ground(graph_dpath, lmk2sym, osm_fpath, model_fpath, utt, args.ablate, args.topk, rel_embeds_fpath, reg_in_cache_fpath)
+        ground_out = ground(graph_dpath, lmk2sym, osm_fpath, model_fpath, utt, args.ablate, args.topk, args.embed_backend, args.reg_index)
         print(f"***** {idx}/{len(utts)}\nInput utt: {utt}\nLifted LTL: {ground_out['lifted_ltl']}\nSymbol to Grounding: {ground_out['sym2ground']}")
         if lmk2sym:
             print(f"Grounded LTL: {ground_out['grounded_ltl']}")
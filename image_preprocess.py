@@ -0,0 +1,131 @@
+"""
+Preprocess images before sending them to a vision-language model.
+Upload size and vision tokens scale with pixels, so downscale, re-encode and optionally crop images.
+"""
+import io
+import base64
+import numpy as np
+from PIL import Image
+
+
+def center_crop_box(width, height, crop_frac):
+    crop_w, crop_h = int(width * crop_frac), int(height * crop_frac)
+    left, top = (width - crop_w) // 2, (height - crop_h) // 2
+    return left, top, left + crop_w, top + crop_h
+
+
+def saliency_crop_box(img, crop_frac, work_side=128):
+    """
+    Crop window with the most gradient energy, computed on a small grayscale copy with an integral image.
+    """
+    width, height = img.size
+    scale = work_side / max(width, height)
+    gray = np.asarray(img.convert("L").resize((max(1, int(width * scale)), max(1, int(height * scale)))), dtype=np.float32)
+
+    grad_y, grad_x = np.gradient(gray)
+    energy = np.abs(grad_x) + np.abs(grad_y)
+    integral = np.pad(energy.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+
+    win_h, win_w = max(1, int(gray.shape[0] * crop_frac)), max(1, int(gray.shape[1] * crop_frac))
+    sums = integral[win_h:, win_w:] - integral[:-win_h, win_w:] - integral[win_h:, :-win_w] + integral[:-win_h, :-win_w]
+    top, left = np.unravel_index(np.argmax(sums), sums.shape)
+
+    left, top = int(left / scale), int(top / scale)
+    crop_w, crop_h = int(width * crop_frac), int(height * crop_frac)
+    left, top = min(left, width - crop_w), min(top, height - crop_h)
+    return left, top, left + crop_w, top + crop_h
+
+
+def preprocess_image(img_fpath, max_side=None, quality=85, crop=None, crop_frac=0.8):
+    """
+    Optionally crop ('center' or 'saliency'), downscale so the longer side is at most max_side,
+    then re-encode as JPEG at given quality.
+    :return: in-memory JPEG file
+    """
+    with Image.open(img_fpath) as img_file:  # close file once decoded, captioning a map opens thousands of images
+        img = img_file.convert("RGB")
+
+    if crop == "center":
+        img = img.crop(center_crop_box(*img.size, crop_frac))
+    elif crop == "saliency":
+        img = img.crop(saliency_crop_box(img, crop_frac))
+    elif crop:
+        raise ValueError(f"ERROR: crop {crop} not recognized")
+
+    if max_side and max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    buffer.seek(0)
+    return buffer
+
+
+def encode_image(image):
+    """
+    Base64 encode an image file path or in-memory file, e.g., output of preprocess_image.
+    Whole image is held in memory, as the request body carries it as one base64 string.
+    """
+    if isinstance(image, str):
+        with open(image, "rb") as image_file:
+            return base64.b64encode(image_file.read()).decode('utf-8')
+    return base64.b64encode(image.read()).decode('utf-8')
+
+
+def dct_matrix(size):
+    """
+    Orthonormal DCT-II matrix, so DCT of a 2D signal x is D @ x @ D.T.
+    """
+    freqs, samples = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+    dct = np.cos(np.pi * (2 * samples + 1) * freqs / (2 * size)) * np.sqrt(2 / size)
+    dct[0] /= np.sqrt(2)
+    return dct
+
+
+def phash(img, hash_size=8, highfreq_factor=4):
+    """
+    Perceptual hash: signs of low frequency DCT coefficients of a small grayscale copy relative to their median.
+    """
+    size = hash_size * highfreq_factor
+    gray = np.asarray(img.convert("L").resize((size, size), Image.LANCZOS), dtype=np.float32)
+    dct = dct_matrix(size)
+    low_freqs = (dct @ gray @ dct.T)[:hash_size, :hash_size].flatten()
+    bits = low_freqs > np.median(low_freqs[1:])  # exclude DC term, i.e., mean brightness
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def dhash(img, hash_size=8):
+    """
+    Difference hash: whether each pixel of a small grayscale copy is brighter than its left neighbor.
+    """
+    gray = np.asarray(img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(hash1, hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+
+def cluster_near_duplicates(img_fpaths, max_dist):
+    """
+    Greedily group images whose pHash and dHash both differ in at most max_dist bits from a cluster's first image.
+    :return: index of representative image of each image's cluster
+    """
+    img_hashes = []
+    for img_fpath in img_fpaths:
+        with Image.open(img_fpath) as img:
+            img_hashes.append((phash(img), dhash(img)))
+
+    rep_idxs = []  # representative of each image
+    reps = []  # representatives so far
+    for img_hash in img_hashes:
+        for rep_idx in reps:
+            rep_hash = img_hashes[rep_idx]
+            if hamming(img_hash[0], rep_hash[0]) <= max_dist and hamming(img_hash[1], rep_hash[1]) <= max_dist:
+                rep_idxs.append(rep_idx)
+                break
+        else:
+            rep_idxs.append(len(rep_idxs))
+            reps.append(len(rep_idxs) - 1)
+    return rep_idxs
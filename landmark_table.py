@@ -0,0 +1,60 @@
+"""
+Structure-of-arrays table of landmarks in the shared Cartesian frame.
+Landmarks are referred to by integer ids, i.e., rows of a contiguous float64 (N, 2) coordinate array,
+so geometry over many candidates is array indexing instead of string-keyed dict lookups.
+A KD-tree over the coordinates is built once per map on first use.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+SOURCES = ["robot", "graph", "osm"]  # robot start, Spot GraphNav waypoint with image, OSM landmark
+SOURCE2MODALITY = {"graph": "image", "osm": "text"}  # modality describing landmark in REG
+
+
+class LandmarkTable:
+    def __init__(self, names, coords, sources):
+        self.names = list(names)
+        self.name2id = {name: lmk_id for lmk_id, name in enumerate(self.names)}
+        self.coords = np.ascontiguousarray(coords, dtype=np.float64).reshape(len(self.names), 2)
+        self.sources = np.array([SOURCES.index(source) for source in sources], dtype=np.int8)
+        self.robot_id = self.name2id["robot"]
+        self.robot = self.coords[self.robot_id]
+        self._tree = None
+        self.relation_tables = {}  # robot pose and max range to spg.RelationTable
+
+    @classmethod
+    def from_dict(cls, landmarks, osm_names=()):
+        """
+        Build from landmark name to {"x", "y"} dict, e.g., output of spg.align_coordinates.
+        """
+        osm_names = set(osm_names)
+        sources = ["robot" if name == "robot" else "osm" if name in osm_names else "graph" for name in landmarks]
+        return cls(landmarks.keys(), [[lmk["x"], lmk["y"]] for lmk in landmarks.values()], sources)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2id
+
+    def ids(self, names):
+        """
+        Integer ids of landmark names, -1 if not a landmark, e.g., a waypoint only in the Spot space.
+        """
+        return np.array([self.name2id.get(name, -1) for name in names], dtype=np.int64)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.coords)
+        return self._tree
+
+    def source(self, lmk_id):
+        return SOURCES[self.sources[lmk_id]]
+
+    def modality(self, lmk_id):
+        return SOURCE2MODALITY.get(self.source(lmk_id))
+
+    def to_dict(self):
+        return {name: {"x": x, "y": y} for name, (x, y) in zip(self.names, self.coords.tolist())}
@@ -0,0 +1,181 @@
+"""
+Local stand-in for the OpenAI chat completions and embeddings endpoints used by openai_models.py
+for offline and repeatable throughput benchmarks.
+mode 'replay': respond with responses recorded by setting LLM_CAPTURE_FPATH when running experiments.
+mode 'synth': synthesize plausible responses, e.g., hash-seeded embeddings and canned SRER outputs.
+Point clients to it by OPENAI_BASE_URL=http://localhost:<port>/v1 OPENAI_API_KEY=stub
+"""
+import json
+import time
+import base64
+import hashlib
+import argparse
+import logging
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+from response_cache import ResponseCache
+
+
+EMBED_DIMS = {"text-embedding-3-large": 3072, "text-embedding-3-small": 1536, "text-embedding-ada-002": 1536}
+
+
+def synth_embed(model, txt, dim):
+    """
+    Deterministic unit-norm embedding seeded by hash of model and text.
+    """
+    seed = int.from_bytes(hashlib.sha256(f"{model}:{txt}".encode("utf-8")).digest()[:8], "little")
+    embed = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return embed / np.linalg.norm(embed)
+
+
+def synth_chat(messages):
+    """
+    Canned response for each type of chat request sent by openai_models.py.
+    """
+    content = messages[-1]["content"]
+    if isinstance(content, list):  # GPT4V.caption, numbered list of captions if images are batched
+        nimgs = sum(part["type"] == "image_url" for part in content)
+        if nimgs > 1:
+            return "\n".join(f"{idx}. A photo of a building next to a tree." for idx in range(1, nimgs + 1))
+        return "A photo of a building next to a tree."
+    elif content.startswith("Extract the referring expressions"):  # extract
+        command = content.split("Command:")[-1].strip()
+        return f"Referring Expressions: {[command]}\nSpatial Predicates: []\nLifted Command: 'a'"
+    elif content.startswith("Translate the following command"):  # translate
+        return "LTL formula: \"F a\""
+    return "OK"
+
+
+class StubLLM:
+    def __init__(self, mode, capture_fpath=None, latency=0.0, error_rate=0.0, seed=0):
+        self.mode = mode
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = np.random.default_rng(seed)
+        self.rng_lock = threading.Lock()
+        self.key2response = {}  # chat completions
+        self.input2embed = {}  # embeddings
+        self.endpoint2latencies = defaultdict(list)
+        self.nrequests = defaultdict(int)
+
+        if capture_fpath:
+            with open(capture_fpath, 'r') as rfile:
+                for line in rfile:
+                    record = json.loads(line)
+                    self.endpoint2latencies[record["endpoint"]].append(record["latency"])
+                    if record["endpoint"] == "embeddings":
+                        for data in record["response"]["data"]:
+                            self.input2embed[record["input"][data["index"]]] = np.array(data["embedding"], dtype=np.float32)
+                    else:
+                        self.key2response[record["key"]] = record["response"]
+            logging.info(f"Loaded {len(self.key2response)} chat completions and {len(self.input2embed)} embeddings from {capture_fpath}")
+
+    def sample_latency(self, endpoint):
+        """
+        Sample from recorded latency distribution of endpoint if available, otherwise use fixed latency.
+        """
+        with self.rng_lock:
+            if self.endpoint2latencies[endpoint]:
+                return float(self.rng.choice(self.endpoint2latencies[endpoint]))
+            return self.latency
+
+    def sample_error(self):
+        with self.rng_lock:
+            return self.rng.random() < self.error_rate
+
+    def chat(self, body):
+        key = ResponseCache.make_key("chat", body)
+        self.nrequests["chat"] += 1
+        if self.mode == "replay" and key in self.key2response:
+            return self.key2response[key]
+        if self.mode == "replay":
+            logging.info(f"Replay miss for chat completion {key}. Synthesizing response")
+
+        content = synth_chat(body["messages"])
+        prompt_tokens = len(json.dumps(body["messages"])) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": f"chatcmpl-stub-{key[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop", "logprobs": None}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def embeddings(self, body):
+        self.nrequests["embeddings"] += 1
+        inputs = [body["input"]] if isinstance(body["input"], str) else body["input"]
+        dim = body.get("dimensions", EMBED_DIMS.get(body["model"], 3072))
+        data = []
+        for idx, inp in enumerate(inputs):
+            embed = self.input2embed.get(inp) if self.mode == "replay" else None
+            if embed is None:
+                embed = synth_embed(body["model"], inp, dim)
+            embed = embed[:dim]
+            if body.get("encoding_format") == "base64":  # default of openai client
+                embed = base64.b64encode(embed.astype(np.float32).tobytes()).decode("utf-8")
+            else:
+                embed = embed.tolist()
+            data.append({"object": "embedding", "index": idx, "embedding": embed})
+        ntokens = sum(len(inp) for inp in inputs) // 4
+        return {"object": "list", "data": data, "model": body["model"], "usage": {"prompt_tokens": ntokens, "total_tokens": ntokens}}
+
+
+def make_handler(stub):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive so client connection pool is exercised as with OpenAI
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if self.path.endswith("/chat/completions"):
+                endpoint = "chat"
+            elif self.path.endswith("/embeddings"):
+                endpoint = "embeddings"
+            else:
+                return self.respond(404, {"error": {"message": f"unknown endpoint {self.path}", "type": "invalid_request_error"}})
+
+            time.sleep(stub.sample_latency(endpoint))
+            if stub.sample_error():
+                return self.respond(429, {"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_error"}})
+            return self.respond(200, stub.chat(body) if endpoint == "chat" else stub.embeddings(body))
+
+        def respond(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("x-ratelimit-limit-requests", "1000000")
+            self.send_header("x-ratelimit-remaining-requests", "1000000")
+            self.send_header("x-ratelimit-limit-tokens", "1000000000")
+            self.send_header("x-ratelimit-remaining-tokens", "1000000000")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, default="synth", choices=["replay", "synth"], help="replay recorded responses or synthesize them.")
+    parser.add_argument("--capture_fpath", type=str, default=None, help="JSONL file recorded by setting LLM_CAPTURE_FPATH. Also provides latency distribution.")
+    parser.add_argument("--latency", type=float, default=0.0, help="fixed latency in sec if no recorded latency distribution.")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests answered with 429 to exercise retries.")
+    parser.add_argument("--seed", type=int, default=0, help="seed to latency and error samplers.")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    stub = StubLLM(args.mode, args.capture_fpath, args.latency, args.error_rate, args.seed)
+    server = ThreadingHTTPServer(("localhost", args.port), make_handler(stub))
+    logging.info(f"Serving stub LLM (mode={args.mode}) at http://localhost:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info(f"Requests served: {dict(stub.nrequests)}")
@@ -1,14 +1,23 @@
 import os
 import json
+import asyncio
 import numpy as np
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 from sklearn.metrics.pairwise import cosine_similarity
 
-from openai_models import get_embed, translate
+from openai_models import get_embedder, translate, atranslate
 from utils import deserialize_props_str, load_from_file, save_to_file
 
 
-def retriever(query, embeds_fpath, raw_data, topk):
+def embed_data(raw_data, embed_backend="openai"):
+    """
+    Embed lifted commands of in-context examples in batch. Commands embedded before are read from the embedding cache.
+    """
+    return np.array(get_embedder(embed_backend).embed([utt for _, _, utt, _ in raw_data]))
+
+
+def retriever(query, raw_data, topk, embed_backend="openai", data_embeds=None, query_embed=None):
     nprops_query = len(deserialize_props_str(query[1]))
     query = query[:1]
 
@@ -23,39 +32,12 @@ def retriever(query, embeds_fpath, raw_data, topk):
     # print(f"{len(data)} templates matched query nprops")
     data = raw_data
 
-    # Embed lifted commands then save or load from cache
-    embeds = []
-    utt2embed = load_from_file(embeds_fpath) if os.path.isfile(embeds_fpath) else {}
-
-    embeds_updated = False
-    for idx, (_, _, utt, _) in enumerate(data):
-        # print(f"{idx}/{len(data)}. getting embedding:\n{utt}")
-        if utt in utt2embed:
-            embed = utt2embed[utt]
-        else:
-            embed = get_embed(utt)  # embedding
-            utt2embed[utt] = embed
-            embeds_updated = True
-            print(f"added new prompt embedding:\n{utt}")
-        embeds.append(embed)
-    if embeds_updated:
-        save_to_file(utt2embed, embeds_fpath)
-    embeds = np.array(embeds)
-
-    # Retrieve prompt in-context examples
-    embeds_updated = False
-    query_str = json.dumps(query)
-    if query_str in utt2embed:
-        embed_query = utt2embed[query_str]
-    else:
-        embed_query = get_embed(query)
-        utt2embed[query_str] = embed_query
-        embeds_updated = True
-        print(f"added new query embedding:\n{utt}")
-    if embeds_updated:
-        save_to_file(utt2embed, embeds_fpath)
-
-    query_scores = cosine_similarity(np.array(embed_query).reshape(1, -1), embeds)[0]
+    # Embed lifted commands and query, unless embedded by caller in batch for all queries
+    embeds = data_embeds if data_embeds is not None else embed_data(data, embed_backend)
+    if query_embed is None:
+        query_embed = get_embedder(embed_backend).embed([query])[0]
+
+    query_scores = cosine_similarity(np.array(query_embed).reshape(1, -1), embeds)[0]
     data_sorted = sorted(zip(query_scores, data), reverse=True)
 
     prompt_examples = []
@@ -67,8 +49,8 @@ def retriever(query, embeds_fpath, raw_data, topk):
     return prompt_examples
 
 
-def lifted_translate(query, embeds_fpath, raw_data, topk):
-    prompt_examples = retriever(query, embeds_fpath, raw_data, topk)
+def lifted_translate(query, raw_data, topk, embed_backend="openai"):
+    prompt_examples = retriever(query, raw_data, topk, embed_backend)
 
     # breakpoint()
 
@@ -93,17 +75,23 @@ def lt(data_dpath, srer_out_fname, raw_data, topk):
     return lifted_ltl, num_tokens
 
 
-def run_exp_lt_rag(spg_out_fpath, lt_out_fpath, data_dpath, ltl_fpath, topk):
+def run_exp_lt_rag(spg_out_fpath, lt_out_fpath, ltl_fpath, topk, embed_backend="openai"):
     if not os.path.isfile(lt_out_fpath):
         raw_data = load_from_file(ltl_fpath)
         spg_outs = load_from_file(spg_out_fpath)
-        embeds_fpath = os.path.join(data_dpath, f"data_embeds.pkl")
+        data_embeds = embed_data(raw_data, embed_backend)
 
-        tot_tokens = 0
+        queries = [[spg_out['lifted_utt'], json.dumps(list(spg_out["props"]))] for spg_out in spg_outs]
+        query_embeds = get_embedder(embed_backend).embed([query[:1] for query in queries])  # all queries in batch
+        prompts_examples = [retriever(query, raw_data, topk, embed_backend, data_embeds, query_embed)
+                            for query, query_embed in tqdm(zip(queries, query_embeds), total=len(queries), desc="Retrieving in-context examples")]
+        translations = asyncio.run(tqdm_asyncio.gather(
+            *[atranslate(query[0], prompt_examples) for query, prompt_examples in zip(queries, prompts_examples)],
+            desc="Running lifted translation (LT) module (method='rag')"
+        ))
 
-        for spg_out in tqdm(spg_outs, desc="Running lifted translation (LT) module (method='rag')"):
-            query = [spg_out['lifted_utt'], json.dumps(list(spg_out["props"]))]
-            lifted_ltl, num_tokens = lifted_translate(query, embeds_fpath, raw_data, topk)
+        tot_tokens = 0
+        for spg_out, (lifted_ltl, num_tokens) in zip(spg_outs, translations):
             tot_tokens += num_tokens
             # print(f"query: {query}\n{lifted_ltl}\n")
             spg_out["lifted_ltl"] = lifted_ltl
@@ -0,0 +1,93 @@
+"""
+Lexical index of landmark names and aliases for REG.
+Referring expressions that are proper names, e.g., Moon Star, are matched to a landmark by normalized exact or trigram fuzzy match.
+REG ranks an exact match first and boosts a fuzzy match among landmarks ranked by embedding similarity.
+Ambiguous or weak matches are left to embedding similarity.
+"""
+import os
+import string
+import unicodedata
+from collections import defaultdict
+
+from utils import load_from_file
+
+
+ARTICLES = {"the", "a", "an"}
+FUZZY_MIN_SIM = 0.7  # min trigram Jaccard similarity of a fuzzy match, e.g., 0.8 of "moonstar cafes" to "moonstar cafe", 0.47 of "star cafe"
+FUZZY_MIN_MARGIN = 0.15  # min similarity gap to best name of another landmark, so near ties are left to embedding similarity
+PUNCTUATION = str.maketrans({char: " " for char in string.punctuation + "’‘"})
+
+
+def normalize_name(name):
+    """
+    Case fold, strip accents, punctuation, leading article and extra whitespace, e.g., "The Moon-Star." -> "moon star".
+    """
+    name = unicodedata.normalize("NFKD", name.casefold())
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    tokens = name.replace("'s", "s").translate(PUNCTUATION).split()
+    if len(tokens) > 1 and tokens[0] in ARTICLES:
+        tokens = tokens[1:]
+    return " ".join(tokens)
+
+
+def trigrams(name):
+    """
+    Character trigrams ignoring spaces, so "moonstar" matches "moon star".
+    """
+    padded = f"  {name.replace(' ', '')} "
+    return {padded[idx: idx + 3] for idx in range(len(padded) - 2)}
+
+
+class NameIndex:
+    def __init__(self, lmk2names):
+        self.name2lmks = defaultdict(set)
+        for lmk_id, names in lmk2names.items():
+            for name in names:
+                if normalize_name(name):
+                    self.name2lmks[normalize_name(name)].add(lmk_id)
+        self.name2trigrams = {name: trigrams(name) for name in self.name2lmks}
+        self.trigram2names = defaultdict(set)
+        for name, name_trigrams in self.name2trigrams.items():
+            for trigram in name_trigrams:
+                self.trigram2names[trigram].add(name)
+
+    @classmethod
+    def from_files(cls, lmk_ids, alias_fpath=None):
+        """
+        Index landmark ids, i.e., OSM keys, and proper names of landmarks in alias file, e.g., dataset/<loc>/<loc>_res.json.
+        """
+        lmk2names = {lmk_id: [lmk_id] for lmk_id in lmk_ids}
+        if alias_fpath and os.path.isfile(alias_fpath):
+            for lmk_id, res in load_from_file(alias_fpath).items():
+                if lmk_id in lmk2names:
+                    lmk2names[lmk_id] += res.get("proper_names", [])
+        return cls(lmk2names)
+
+    def __len__(self):
+        return len(self.name2lmks)
+
+    def match(self, query):
+        """
+        Landmark id and similarity of a confident match (1.0 if exact), otherwise None.
+        """
+        name = normalize_name(query)
+        lmk_ids = self.name2lmks.get(name)
+        if lmk_ids:
+            return (next(iter(lmk_ids)), 1.0) if len(lmk_ids) == 1 else None  # alias shared by landmarks is ambiguous
+
+        query_trigrams = trigrams(name)
+        candidates = set().union(*(self.trigram2names.get(trigram, ()) for trigram in query_trigrams)) if name else set()
+        lmk2sim = {}
+        for candidate in candidates:
+            candidate_trigrams = self.name2trigrams[candidate]
+            sim = len(query_trigrams & candidate_trigrams) / len(query_trigrams | candidate_trigrams)
+            for lmk_id in self.name2lmks[candidate]:
+                lmk2sim[lmk_id] = max(sim, lmk2sim.get(lmk_id, 0.0))
+        if not lmk2sim:
+            return None
+        ranked = sorted(lmk2sim.items(), key=lambda lmk_sim: lmk_sim[1], reverse=True)
+        best_lmk, best_sim = ranked[0]
+        runner_up_sim = ranked[1][1] if len(ranked) > 1 else 0.0
+        if best_sim >= FUZZY_MIN_SIM and best_sim - runner_up_sim >= FUZZY_MIN_MARGIN:
+            return best_lmk, best_sim
+        return None
@@ -1,20 +1,196 @@
 import os
-import base64
+import re
 import json
-from time import sleep
+import base64
+import time
+import asyncio
 import logging
+import threading
+import weakref
+import numpy as np
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
+from api_scheduler import get_scheduler
+from image_preprocess import preprocess_image, encode_image
+from response_cache import ResponseCache, get_cache
+from embed_cache import get_embed_cache, normalize_text
 from utils import load_from_file
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 srer_prompt_fpath = os.path.join(os.path.expanduser("~"), "ground", "data", "srer_prompt.txt")
+EMBED_MODEL = "text-embedding-3-large"
+EMBED_DIM = 3072  # dimension of EMBED_MODEL embeddings
+EMBED_BATCH_SIZE = 2048  # max number of inputs per request accepted by the embeddings endpoint
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", 200000))  # max estimated input tokens per embeddings request, below endpoint's 300k cap since estimate is rough
+LOCAL_EMBED_MODEL = os.getenv("LOCAL_EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+IMAGE_TOKENS = 765  # estimated input tokens per image, i.e., a 1024x1024 image at high detail
+CAPTION_MAX_SIDE = int(os.getenv("GPT4V_CAPTION_MAX_SIDE", 0)) or None  # downscale longer side of images to caption to this, e.g., 768, or send originals
+CAPTION_BATCH_SIZE = int(os.getenv("GPT4V_CAPTION_BATCH_SIZE", 1))  # max images per caption request, 1 sends one image per request
+CAPTION_BATCH_TOKENS = int(os.getenv("GPT4V_CAPTION_BATCH_TOKENS", 8000))  # max estimated image tokens per batched caption request
+CAPTURE_FPATH = os.getenv("LLM_CAPTURE_FPATH")  # record responses and latencies to replay by llm_stub_server.py
 
+_client = None
+_async_states = weakref.WeakKeyDictionary()  # event loop -> shared async client and in-flight requests
+_capture_lock = threading.Lock()
+_embedders = {}
 
-def extract(command):
-    client = OpenAI()
-    raw_responses = client.chat.completions.create(
+
+def get_client():
+    """
+    Shared OpenAI client so every request reuses the same connection pool.
+    """
+    global _client
+    if _client is None:
+        _client = OpenAI(max_retries=0)  # retries are handled by the shared scheduler
+    return _client
+
+
+def set_max_concurrency(max_concurrency):
+    """
+    Set the max number of in-flight requests.
+    """
+    get_scheduler().set_max_concurrency(max_concurrency)
+
+
+def _get_async_state():
+    """
+    Shared AsyncOpenAI client, i.e., one connection pool, and requests in flight.
+    One per event loop because async clients are bound to the loop that first uses them.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_states:
+        _async_states[loop] = {
+            "client": AsyncOpenAI(max_retries=0),
+            "inflight": {},
+        }
+    return _async_states[loop]
+
+
+def estimate_tokens(endpoint, kwargs):
+    """
+    Estimate tokens of a request for rate limiting, roughly 4 characters per token plus completion budget.
+    """
+    if endpoint == "embeddings":
+        return sum(len(txt) for txt in kwargs["input"]) // 4 + 1
+    ntokens = kwargs.get("max_tokens", 0)
+    for message in kwargs["messages"]:
+        contents = message["content"] if isinstance(message["content"], list) else [{"type": "text", "text": message["content"]}]
+        for content in contents:
+            ntokens += len(content["text"]) // 4 if content["type"] == "text" else IMAGE_TOKENS
+    return ntokens
+
+
+def _capture(endpoint, kwargs, response, latency):
+    """
+    Append a request's response and server latency to the capture file if LLM_CAPTURE_FPATH is set.
+    """
+    if CAPTURE_FPATH:
+        record = {"endpoint": endpoint, "key": ResponseCache.make_key(endpoint, kwargs), "latency": latency, "response": response.model_dump()}
+        if endpoint == "embeddings":
+            record["input"] = kwargs["input"]  # embeddings are replayed per input since batching depends on cache state
+        with _capture_lock, open(CAPTURE_FPATH, "a") as wfile:
+            wfile.write(json.dumps(record) + "\n")
+
+
+def _create(endpoint, kwargs):
+    """
+    Send a request to an endpoint of the shared client through the shared scheduler.
+    """
+    client = get_client()
+    create = client.embeddings.with_raw_response.create if endpoint == "embeddings" else client.chat.completions.with_raw_response.create
+    latencies = []
+
+    def send():
+        start = time.perf_counter()
+        raw_response = create(**kwargs)
+        latencies.append(time.perf_counter() - start)
+        return raw_response
+
+    response = get_scheduler().call(send, kwargs["model"], estimate_tokens(endpoint, kwargs))
+    _capture(endpoint, kwargs, response, latencies[-1])
+    return response
+
+
+async def _acreate(endpoint, kwargs):
+    """
+    Async version of _create. Identical in-flight requests are coalesced into one.
+    """
+    state = _get_async_state()
+    key = ResponseCache.make_key(endpoint, kwargs)
+
+    client = state["client"]
+    create = client.embeddings.with_raw_response.create if endpoint == "embeddings" else client.chat.completions.with_raw_response.create
+    latencies = []
+
+    async def send():
+        start = time.perf_counter()
+        raw_response = await create(**kwargs)
+        latencies.append(time.perf_counter() - start)
+        return raw_response
+
+    async def request():
+        response = await get_scheduler().acall(send, kwargs["model"], estimate_tokens(endpoint, kwargs))
+        _capture(endpoint, kwargs, response, latencies[-1])
+        return response
+
+    task = state["inflight"].get(key)
+    if task is None:
+        task = asyncio.ensure_future(request())
+        state["inflight"][key] = task
+        task.add_done_callback(lambda _: state["inflight"].pop(key, None))
+    return await asyncio.shield(task)  # a cancelled caller must not cancel the request shared with other callers
+
+
+def _cached_chat(key, parse):
+    """
+    Parsed cached response, or None if not cached. A cached response that fails to parse is evicted so it is requested again.
+    """
+    cache = get_cache()
+    out = cache.get(key) if cache else None
+    if out is None:
+        return None
+    try:
+        return parse(out["content"]) if parse else out["content"], out["total_tokens"]
+    except ValueError as error:
+        logging.warning(f"Evicted cached chat response that failed to parse: {error}")
+        cache.delete(key)
+        return None
+
+
+def _put_chat(key, response, parse):
+    """
+    Parse response then cache it, so a malformed response raises ValueError without being cached.
+    """
+    out = {"content": response.choices[0].message.content, "total_tokens": response.usage.total_tokens}
+    content = parse(out["content"]) if parse else out["content"]
+    cache = get_cache()
+    if cache:
+        cache.put(key, out)
+    return content, out["total_tokens"]
+
+
+def _chat(kwargs, parse=None):
+    """
+    Chat completion through the response cache. Return response text, or its output by parse if given, and total number of tokens.
+    """
+    key = ResponseCache.make_key("chat", kwargs)
+    out = _cached_chat(key, parse)
+    if out is None:
+        out = _put_chat(key, _create("chat", kwargs), parse)
+    return out
+
+
+async def _achat(kwargs, parse=None):
+    key = ResponseCache.make_key("chat", kwargs)
+    out = _cached_chat(key, parse)
+    if out is None:
+        out = _put_chat(key, await _acreate("chat", kwargs), parse)
+    return out
+
+
+def _extract_kwargs(command):
+    return dict(
         model="gpt-4",
         temperature=0.1,
         max_tokens=1500,
@@ -32,126 +208,356 @@ def extract(command):
             }
         ],
     )
-    return raw_responses.choices[0].message.content
 
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def extract(command):
+    return _chat(_extract_kwargs(command))[0]
 
 
-class GPT4V:
-    def __init__(self, temp=0, max_tokens=128, n=1, stop=['\n']):
-        self.client = OpenAI()
+async def aextract(command):
+    return (await _achat(_extract_kwargs(command)))[0]
 
+
+def parse_numbered_list(content, nitems):
+    """
+    Parse items of a numbered list, e.g., "1. a chair\n2. a table", one per line.
+    :return: items in order, or None if numbers are not exactly 1 to nitems
+    """
+    items = {}
+    for line in content.strip().splitlines():
+        match = re.match(r"^\s*\**\s*(\d+)\s*[.):]\**\s*(.+)$", line)
+        if match:
+            items[int(match.group(1))] = match.group(2).strip()
+        elif line.strip() and items:
+            return None  # unnumbered line, e.g., caption spanning lines
+    if sorted(items) != list(range(1, nitems + 1)):
+        return None
+    return [items[idx] for idx in range(1, nitems + 1)]
+
+
+class GPT4V:
+    def __init__(self, temp=0, max_tokens=128, n=1, stop=['\n'], max_side=CAPTION_MAX_SIDE, quality=85, crop=None, batch_size=CAPTION_BATCH_SIZE, batch_tokens=CAPTION_BATCH_TOKENS):
         self.temp = temp
         self.max_tokens = max_tokens
         self.n = n
         self.stop = stop
 
-    def caption(self, img_fpath):
-        complete = False
-        ntries = 0
-        while not complete:
-            try:
-                raw_responses = self.client.chat.completions.create(
-                    model = "gpt-4-vision-preview",
-                    messages=[
+        # Images per caption request, limited by estimated tokens of images in a request
+        self.batch_size = max(1, min(batch_size, batch_tokens // IMAGE_TOKENS))
+
+        # Image preprocessing, set max_side=None and crop=None to send original image
+        self.max_side = max_side
+        self.quality = quality
+        self.crop = crop
+
+    def encode(self, img_fpath):
+        if not self.max_side and not self.crop:
+            return encode_image(img_fpath)
+        return encode_image(preprocess_image(img_fpath, self.max_side, self.quality, self.crop))
+
+    def caption_kwargs(self, img_fpath):
+        return dict(
+            model = "gpt-4-vision-preview",
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "What's the most obivous object in this image in one sentence."},
                         {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": "What's the most obivous object in this image in one sentence."},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {"url": f"data:image/jpeg;base64,{encode_image(img_fpath)}"},
-                                },
-                            ],
-                        }
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/jpeg;base64,{self.encode(img_fpath)}"},
+                        },
                     ],
-                    max_tokens=3000,
-                    # temperature=self.temp,
-                    # n=self.n,
-                    # stop=self.stop,
-                    # max_tokens=self.max_tokens,
-                )
-                complete = True
-            except:
-                logging.info(f"{ntries}: waiting for the server. sleep for 30 sec...")
-                sleep(30)
-                logging.info("OK continue")
-                ntries += 1
+                }
+            ],
+            max_tokens=3000,
+            # temperature=self.temp,
+            # n=self.n,
+            # stop=self.stop,
+            # max_tokens=self.max_tokens,
+        )
+
+    def caption(self, img_fpath):
         # if self.n == 1:
         #     responses = [raw_responses["choices"][0]["message"]["content"].strip()]
         # else:
         #     responses = [choice["message"]["content"].strip() for choice in raw_responses["choices"]]
 
-        return raw_responses.choices[0].message.content
+        return _chat(self.caption_kwargs(img_fpath))[0]
+
+    async def acaption(self, img_fpath):
+        return (await _achat(self.caption_kwargs(img_fpath)))[0]
+
+    def batches(self, items):
+        """
+        Split images, or their indices, into batches captioned by one request each.
+        """
+        items = list(items)
+        return [items[start: start + self.batch_size] for start in range(0, len(items), self.batch_size)]
+
+    def captions_kwargs(self, img_fpaths):
+        """
+        One request asking for a numbered list of captions of images labeled in order.
+        """
+        content = [{"type": "text", "text": f"What's the most obvious object in each of the following {len(img_fpaths)} images, in one sentence per image? "
+                                            f"Answer with a numbered list of {len(img_fpaths)} lines, e.g., 1. <sentence for image 1>, and nothing else."}]
+        for idx, img_fpath in enumerate(img_fpaths, 1):
+            content += [
+                {"type": "text", "text": f"Image {idx}:"},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{self.encode(img_fpath)}"}},
+            ]
+        return dict(model="gpt-4-vision-preview", messages=[{"role": "user", "content": content}], max_tokens=3000)
+
+    def caption_batch(self, img_fpaths):
+        """
+        Caption images in one request. Fall back to one request per image if the list of captions cannot be parsed.
+        """
+        if len(img_fpaths) == 1:
+            return [self.caption(img_fpaths[0])]
+        img_caps = parse_numbered_list(_chat(self.captions_kwargs(img_fpaths))[0], len(img_fpaths))
+        if img_caps:
+            return img_caps
+        logging.warning(f"Failed to parse captions of {len(img_fpaths)} images in one request. Captioning one image per request")
+        return [self.caption(img_fpath) for img_fpath in img_fpaths]
+
+    async def acaption_batch(self, img_fpaths):
+        if len(img_fpaths) == 1:
+            return [await self.acaption(img_fpaths[0])]
+        img_caps = parse_numbered_list((await _achat(self.captions_kwargs(img_fpaths)))[0], len(img_fpaths))
+        if img_caps:
+            return img_caps
+        logging.warning(f"Failed to parse captions of {len(img_fpaths)} images in one request. Captioning one image per request")
+        return list(await asyncio.gather(*[self.acaption(img_fpath) for img_fpath in img_fpaths]))
+
+
+def _embed_requests(txts, batch_size, batch_tokens):
+    """
+    Look up embeddings of texts in the embedding cache and build batched requests for the missing ones,
+    each with at most batch_size inputs and batch_tokens estimated tokens, e.g., long OSM descriptions.
+    Return embeddings (None if missing), normalized inputs, and requests with input indices they fill.
+    """
+    inputs = [cache_input(txt) for txt in txts]
+    embed_cache = get_embed_cache()
+    embeddings = embed_cache.get_many(EMBED_MODEL, EMBED_DIM, inputs) if embed_cache else [None] * len(inputs)
+
+    input2idxs = {}  # each missing input only embedded once
+    for idx, (inp, embedding) in enumerate(zip(inputs, embeddings)):
+        if embedding is None:
+            input2idxs.setdefault(inp, []).append(idx)
+    inputs_new = list(input2idxs.keys())
+
+    batches, batch, ntokens_batch = [], [], 0
+    for inp in inputs_new:
+        ntokens = estimate_tokens("embeddings", {"input": [inp]})
+        if batch and (len(batch) == batch_size or ntokens_batch + ntokens > batch_tokens):
+            batches.append(batch)
+            batch, ntokens_batch = [], 0
+        batch.append(inp)
+        ntokens_batch += ntokens
+    if batch:
+        batches.append(batch)
+    requests = [(dict(model=EMBED_MODEL, input=batch), [input2idxs[inp] for inp in batch]) for batch in batches]
+    return embeddings, inputs, requests
+
+
+def _fill_embeds(embeddings, inputs, raw_responses, idxs_batch):
+    inputs_new, embeddings_new = [], []
+    for data, idxs in zip(sorted(raw_responses.data, key=lambda data: data.index), idxs_batch):
+        for idx in idxs:
+            embeddings[idx] = data.embedding
+        inputs_new.append(inputs[idxs[0]])
+        embeddings_new.append(data.embedding)
+    embed_cache = get_embed_cache()
+    if embed_cache:
+        embed_cache.put_many(EMBED_MODEL, EMBED_DIM, inputs_new, embeddings_new)
+
+
+def get_embeds(txts, batch_size=EMBED_BATCH_SIZE, batch_tokens=EMBED_BATCH_TOKENS):
+    """
+    Embed a list of texts with as few requests as possible.
+    Cached inputs are skipped, the rest are chunked to the endpoint's input and token limits, and output embeddings keep the input order.
+    """
+    embeddings, inputs, requests = _embed_requests(txts, batch_size, batch_tokens)
+    for kwargs, idxs_batch in requests:
+        _fill_embeds(embeddings, inputs, _create("embeddings", kwargs), idxs_batch)
+    return embeddings
+
+
+async def aget_embeds(txts, batch_size=EMBED_BATCH_SIZE, batch_tokens=EMBED_BATCH_TOKENS):
+    """
+    Async version of get_embeds. Batches are sent concurrently.
+    """
+    embeddings, inputs, requests = _embed_requests(txts, batch_size, batch_tokens)
+    raws_responses = await asyncio.gather(*[_acreate("embeddings", kwargs) for kwargs, _ in requests])
+    for raw_responses, (_, idxs_batch) in zip(raws_responses, requests):
+        _fill_embeds(embeddings, inputs, raw_responses, idxs_batch)
+    return embeddings
 
 
 def get_embed(txt):
-    client = OpenAI()
-    txt = json.dumps(txt).replace("\n", " ")
-    complete = False
-    ntries = 0
-    while not complete:
-        try:
-            raw_responses = client.embeddings.create(
-                model = "text-embedding-3-large",
-                input=txt
-            )
-            complete = True
-        except:
-            sleep(30)
-            print(f"{ntries}: waiting for the server. sleep for 30 sec...")
-            # logging.info(f"{ntries}: waiting for the server. sleep for 30 sec...\n{query_prompt}")
-            print("OK continue")
-            ntries += 1
-
-    embedding = raw_responses.data[0].embedding
-    return embedding
+    return get_embeds([txt])[0]
 
 
-def translate(query, examples):
-    client = OpenAI()
+async def aget_embed(txt):
+    return (await aget_embeds([txt]))[0]
 
-    complete = False
-    ntries = 0
-    task = "You are an expert at translating natural language commands to linear temporal logic (LTL) formulas."
-    while not complete:
+
+class OpenAIEmbedder:
+    """
+    Embedding backend using the OpenAI embeddings endpoint.
+    """
+    name = "openai"
+
+    def embed(self, txts):
+        return get_embeds(txts)
+
+
+class LocalEmbedder:
+    """
+    Embedding backend using a local sentence embedding model run in batch on CPU. Requires sentence-transformers.
+    Embeddings are cached like those of the OpenAI backend, keyed by the local model name.
+    """
+    name = "local"
+
+    def __init__(self, model_name=LOCAL_EMBED_MODEL, batch_size=64):
+        from sentence_transformers import SentenceTransformer  # optional dependency
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.batch_size = batch_size
+
+    def encode(self, txts):
+        embeds = self.model.encode(txts, batch_size=self.batch_size, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+        return embeds.tolist()
+
+    def embed(self, txts):
+        txts = [cache_input(txt, self.name) for txt in txts]
+        embed_cache = get_embed_cache()
+        return embed_cache.get_or_embed(self.model_name, self.dim, txts, self.encode) if embed_cache else self.encode(txts)
+
+
+EMBED_BACKENDS = {"openai": OpenAIEmbedder, "local": LocalEmbedder}
+
+
+def get_embedder(backend="openai"):
+    """
+    Shared instance of an embedding backend so a local model is only loaded once.
+    """
+    if backend not in _embedders:
+        if backend not in EMBED_BACKENDS:
+            raise ValueError(f"ERROR: embedding backend {backend} not recognized")
+        _embedders[backend] = EMBED_BACKENDS[backend]()
+    return _embedders[backend]
+
+
+def backend_fpath(fpath, backend):
+    """
+    Path of an embedding cache file or directory for a backend. Embeddings from different backends are not comparable.
+    """
+    if backend == "openai":
+        return fpath  # existing caches
+    root, ext = os.path.splitext(fpath)
+    return f"{root}_{backend}{ext}"
+
+
+def cache_input(txt, backend="openai"):
+    """
+    Normalized text a backend embeds and keys the embedding cache by.
+    """
+    if backend == "openai":
+        return normalize_text(json.dumps(txt))
+    return normalize_text(txt if isinstance(txt, str) else json.dumps(txt))
+
+
+def _load_query_log(log_fpath):
+    """
+    Query to embedding dict from a REG query log: JSON lines of query and base64 encoded float16 embedding, later records override earlier ones.
+    """
+    query2embed = {}
+    with open(log_fpath, 'r') as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+                query2embed[record["query"]] = np.frombuffer(base64.b64decode(record["embed"]), dtype=np.float16).astype(np.float32)
+            except (ValueError, KeyError):  # partial record of an interrupted append
+                continue
+    return query2embed
+
+
+def import_legacy_embeds(data_dpath, loc, backend="openai"):
+    """
+    Move embeddings from cache files used before the embedding cache into it:
+    REG queries (reg_in_cache_<loc>.jsonl or .pkl), RAG commands and queries (data_embeds.pkl), and spatial relations (known_rel_embeds.json, unknown_rel_embeds.json).
+    Imported files are renamed with suffix .imported so they are only read once.
+    """
+    embed_cache = get_embed_cache()
+    if not embed_cache:
+        return
+    reg_fpath = backend_fpath(os.path.join(data_dpath, f"reg_in_cache_{loc}.jsonl"), backend)
+    fpaths = [reg_fpath, f"{os.path.splitext(reg_fpath)[0]}.pkl"] + \
+             [backend_fpath(os.path.join(data_dpath, fname), backend) for fname in ["data_embeds.pkl", "known_rel_embeds.json", "unknown_rel_embeds.json"]]
+    model = EMBED_MODEL if backend == "openai" else LOCAL_EMBED_MODEL
+    for fpath in fpaths:
         try:
-            raw_response = client.chat.completions.create(
-                model = "gpt-4",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": f"{task}\n\nHere are some examples:\n\n{examples}"
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Translate the following command to an LTL formula\n\nCommand: \"{query}\""
-                    }
-                ],
-                temperature=0.1,
-                max_tokens=100,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0
-            )
-            complete = True
-        except:
-            sleep(30)
-            print(f"{ntries}: waiting for the server. sleep for 30 sec...")
-            # logging.info(f"{ntries}: waiting for the server. sleep for 30 sec...\n{query_prompt}")
-            print("OK continue")
-            ntries += 1
-
-    response = raw_response.choices[0].message.content
+            txt2embed = _load_query_log(fpath) if fpath.endswith(".jsonl") else load_from_file(fpath)
+        except FileNotFoundError:  # no legacy cache, or already imported by another process
+            continue
+        dim2rows = {}
+        for txt, embed in txt2embed.items():
+            if txt.startswith("["):  # RAG query embedded as a list of lifted command, keyed by its JSON
+                try:
+                    txt = json.loads(txt)
+                except ValueError:
+                    pass
+            dim2rows.setdefault(len(embed), []).append((cache_input(txt, backend), embed))
+        for dim, rows in dim2rows.items():
+            if backend == "openai" and dim != EMBED_DIM:
+                continue
+            inputs, embeds = zip(*rows)
+            embed_cache.put_many(model, dim, inputs, embeds)
+        try:
+            os.replace(fpath, f"{fpath}.imported")
+        except FileNotFoundError:
+            pass
+        logging.info(f"Imported {len(txt2embed)} embeddings from {fpath} to embedding cache")
+
+
+def _translate_kwargs(query, examples):
+    task = "You are an expert at translating natural language commands to linear temporal logic (LTL) formulas."
+    return dict(
+        model = "gpt-4",
+        messages=[
+            {
+                "role": "system",
+                "content": f"{task}\n\nHere are some examples:\n\n{examples}"
+            },
+            {
+                "role": "user",
+                "content": f"Translate the following command to an LTL formula\n\nCommand: \"{query}\""
+            }
+        ],
+        temperature=0.1,
+        max_tokens=100,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0
+    )
+
+
+def _parse_translation(response):
     # print(f"GPT query: {query}\n{response}\n")
-    response = response.replace("\"", "").split(': ')[1]
-    # print(response)
-    # print(raw_response.usage)
+    parts = response.replace("\"", "").split(': ')
+    if len(parts) < 2:
+        raise ValueError(f"ERROR: no LTL formula in translation response: {response}")
+    # print(parts[1])
+    return parts[1]
+
+
+def translate(query, examples):
+    return _chat(_translate_kwargs(query, examples), _parse_translation)
+
 
-    # breakpoint()
-    return response, raw_response.usage.total_tokens
+async def atranslate(query, examples):
+    return await _achat(_translate_kwargs(query, examples), _parse_translation)
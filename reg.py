@@ -1,114 +1,406 @@
 import os
+import json
+import fcntl
+import time
+import asyncio
+import argparse
+import logging
 from pathlib import Path
+from collections import namedtuple
 from tqdm import tqdm
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
-from openai_models import GPT4V, get_embed
-from utils import load_from_file, save_to_file
+from openai_models import GPT4V, get_embedder, backend_fpath
+from image_preprocess import cluster_near_duplicates
+from embed_store import EmbedStore, l2_normalize, content_hash, file_hash
+from ann_index import IVF_NPROBE, IVFIndex
+from name_index import NameIndex
+from utils import load_from_file, save_to_file, stats_fpath
 
 
-def embed_images(img_fpaths, cap_dpath, embed_dpath):
-    img_embeds = {}
-    for img_fpath in img_fpaths:
-        img_id = Path(img_fpath).stem
-        cap_fpath = os.path.join(cap_dpath, f"{img_id}.txt")
-        embed_fpath = os.path.join(embed_dpath, f"{img_id}.pkl")
+SEARCH_BATCH_SIZE = 1024  # queries scored per matrix product
+NAME_MATCH_MARGIN = float(os.getenv("REG_NAME_MATCH_MARGIN", 0.05))  # cosine score added to landmark matched by name
+IMAGE_DEDUP_DIST = int(os.getenv("REG_IMAGE_DEDUP_DIST", 6))  # max pHash and dHash Hamming distance of near-duplicate images
 
-        if os.path.isfile(embed_fpath):
-            img_cap = load_from_file(cap_fpath)
-            img_embed = load_from_file(embed_fpath)
-        else:
-            img_cap = GPT4V().caption(img_fpath)  # image caption
-            save_to_file(img_cap, cap_fpath)
-            img_embed = get_embed(img_cap)  # embed image captioin
-            save_to_file(img_embed, embed_fpath)
+ABLATIONS = ["both", "image", "text"]  # runs on ablation dataset derived from one REG pass by ablate "all"
 
-        img_embeds[img_id] = img_embed
-    return img_embeds
-
-
-def embed_texts(txts, obj_locs, embed_dpath):
-    txt_embeds = {}
-    for lmk_name, txt in txts.items():
-        if lmk_name not in obj_locs:
-            txt_id = lmk_name.lower().replace(" ", "_")
-            embed_fpath = os.path.join(embed_dpath, f"{txt_id}.pkl")
-
-            if os.path.isfile(embed_fpath):
-                txt_emebed = load_from_file(embed_fpath)
-            else:
-                txt["name"] = lmk_name  # add landmark name into its textual description
-                txt_emebed = get_embed(txt)
-                save_to_file(txt_emebed, embed_fpath)
+Grounding = namedtuple("Grounding", ["score", "lmk_id"])  # saved to JSON as [score, lmk_id]
 
-            txt_embeds[lmk_name] = txt_emebed
 
-    return txt_embeds
-
-
-class REG():
+def ablate_modalities(ablate):
     """
-    Referring Expression Grounding (REG) module. Use semantic description of landmarks and objects in text and images.
+    Modalities of landmarks REG grounds to when ablating out a modality. "both" keeps both modalities of ablation dataset.
     """
-    def __init__(self, img_embeds, txt_embeds, query_cache_fpath):
-        self.sem_ids,sem_embeds = [], []
+    modalities = []
+    if not ablate or ablate in ["both", "text", "all"]:
+        modalities.append("image")
+    if not ablate or ablate in ["both", "image", "all"]:
+        modalities.append("text")
+    return modalities
 
-        if img_embeds:
-            self.sem_ids += list(img_embeds.keys())
-            sem_embeds += list(img_embeds.values())
 
-        if txt_embeds:
-            self.sem_ids += list(txt_embeds.keys())
-            sem_embeds += list(txt_embeds.values())
+def load_caption_manifest(manifest_fpath):
+    """
+    Load captions completed by previous runs. A partially written last line from an interrupted run is ignored.
+    :return: image id to its latest caption and content hash of the captioned image (None if not recorded),
+             and content hash to caption of recorded images
+    """
+    img_caps, hash_caps = {}, {}
+    if os.path.isfile(manifest_fpath):
+        with open(manifest_fpath, 'r') as rfile:
+            for line in rfile:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                img_caps[entry["id"]] = (entry["caption"], entry.get("hash"))
+                if entry.get("hash"):
+                    hash_caps[entry["hash"]] = entry["caption"]
+    return img_caps, hash_caps
+
+
+async def caption_images(img_fpaths, img_hashes, img_dups, cap_dpath, cap_cache_fpath, embedder, max_concurrency, embed_batch_size):
+    """
+    Caption images concurrently, several images per request if GPT4V batches them. Record each caption as it completes
+    so an interrupted run resumes per request, and embed captions in batches as they complete.
+    Near-duplicates of an image share its caption and embedding.
+    :param img_dups: ids and content hashes of near-duplicates of each image
+    :return: content hash to embedding of captioned images and their near-duplicates
+    """
+    gpt4v = GPT4V()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    img_embeds = {}
+    img_caps_new = {}  # captioned but not yet embedded
+
+    async def caption(idxs):
+        async with semaphore:
+            return idxs, await gpt4v.acaption_batch([img_fpaths[idx] for idx in idxs])
+
+    async def embed(img_caps):
+        embeds = await asyncio.to_thread(embedder.embed, list(img_caps.values()))  # do not block captioning
+        img_embeds.update(zip(img_caps.keys(), embeds))
+
+    embed_tasks = []
+    with open(cap_cache_fpath, 'a') as cap_cache, tqdm(total=len(img_fpaths), desc="Captioning images") as pbar:
+        captions = [caption(idxs) for idxs in gpt4v.batches(range(len(img_fpaths)))]
+        for next_caption in asyncio.as_completed(captions):
+            idxs, img_caps = await next_caption
+            entries = []
+            for idx, img_cap in zip(idxs, img_caps):
+                img_hash = img_hashes[idx]
+                entries += [{"id": dup_id, "hash": dup_hash, "caption": img_cap} for dup_id, dup_hash in [(Path(img_fpaths[idx]).stem, img_hash)] + img_dups[idx]]
+                img_caps_new[img_hash] = img_cap
+            for entry in entries:
+                save_to_file(entry["caption"], os.path.join(cap_dpath, f"{entry['id']}.txt"))
+            fcntl.flock(cap_cache, fcntl.LOCK_EX)  # cache shared by maps and processes
+            cap_cache.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            cap_cache.flush()
+            fcntl.flock(cap_cache, fcntl.LOCK_UN)
+            pbar.update(len(idxs))
+
+            if len(img_caps_new) >= embed_batch_size:
+                embed_tasks.append(asyncio.ensure_future(embed(img_caps_new)))
+                img_caps_new = {}
+    if img_caps_new:
+        embed_tasks.append(asyncio.ensure_future(embed(img_caps_new)))
+    await asyncio.gather(*embed_tasks)
+
+    for img_hash, dups in zip(img_hashes, img_dups):
+        img_embeds.update({dup_hash: img_embeds[img_hash] for _, dup_hash in dups})
+    return img_embeds
 
-        self.sem_embeds = np.array(sem_embeds)
 
-        if os.path.isfile(query_cache_fpath):
-            self.query_cache = load_from_file(query_cache_fpath)
+def embed_images(img_fpaths, img_hashes, cap_dpath, cap_cache_fpath, embedder, stale_ids=(), max_concurrency=8, embed_batch_size=32, dedup_dist=IMAGE_DEDUP_DIST):
+    """
+    Embed captions of images. Caption images without a caption of their current content first.
+    Captions are cached by image content hash, so identical images, e.g., of a re-recorded map, reuse them.
+    Near-duplicate images, e.g., of waypoints a meter apart, are clustered by perceptual hash within dedup_dist bits
+    and only one image per cluster is captioned. Negative dedup_dist disables clustering.
+    Captions recorded by waypoint id without content hash are only trusted for images not in stale_ids, e.g., re-captured images.
+    """
+    img_caps, hash_caps = load_caption_manifest(os.path.join(cap_dpath, "captions_manifest.jsonl"))  # per map, by previous runs
+    hash_caps.update(load_caption_manifest(cap_cache_fpath)[1])
+    img_caps_captioned = {}  # content hash to caption from previous run
+    img_fpaths_uncaptioned, img_hashes_uncaptioned = [], []  # images without caption, captioned concurrently
+    for img_fpath, img_hash in zip(img_fpaths, img_hashes):
+        img_id = Path(img_fpath).stem
+        cap_fpath = os.path.join(cap_dpath, f"{img_id}.txt")
+        img_cap, cap_hash = img_caps.get(img_id, (None, None))
+
+        if img_hash in hash_caps:
+            img_caps_captioned[img_hash] = hash_caps[img_hash]
+        elif img_cap is not None and cap_hash is None and img_id not in stale_ids:
+            img_caps_captioned[img_hash] = img_cap
+        elif img_cap is None and os.path.isfile(cap_fpath) and img_id not in stale_ids:  # captioned by a run before the manifest existed
+            with open(cap_fpath, 'r') as rfile:
+                img_caps_captioned[img_hash] = rfile.read()
         else:
-            self.query_cache = {}
-        self.query_cache_fpath = query_cache_fpath
+            img_fpaths_uncaptioned.append(img_fpath)
+            img_hashes_uncaptioned.append(img_hash)
 
-    def query(self, query, topk):
-        if query in self.query_cache:
-            query_embeds = self.query_cache[query]
-        else:
-            query_embeds = get_embed(query)
-            self.query_cache[query] = query_embeds
-            save_to_file(self.query_cache, self.query_cache_fpath)
+    img_embeds = {}
+    if img_caps_captioned:
+        caps = list(dict.fromkeys(img_caps_captioned.values()))
+        cap_embeds = dict(zip(caps, embedder.embed(caps)))
+        img_embeds.update({img_hash: cap_embeds[img_cap] for img_hash, img_cap in img_caps_captioned.items()})
+    if img_fpaths_uncaptioned:
+        rep_idxs = cluster_near_duplicates(img_fpaths_uncaptioned, dedup_dist) if dedup_dist >= 0 \
+            else [img_hashes_uncaptioned.index(img_hash) for img_hash in img_hashes_uncaptioned]  # only identical images
+        rep2dups = {}  # representative image to ids and content hashes of its near-duplicates
+        for idx, rep_idx in enumerate(rep_idxs):
+            if idx == rep_idx:
+                rep2dups[rep_idx] = []
+            else:
+                rep2dups[rep_idx].append((Path(img_fpaths_uncaptioned[idx]).stem, img_hashes_uncaptioned[idx]))
+        logging.info(f"Captioning {len(rep2dups)} of {len(img_fpaths_uncaptioned)} uncaptioned images after removing near-duplicates")
+        img_embeds.update(asyncio.run(caption_images([img_fpaths_uncaptioned[idx] for idx in rep2dups], [img_hashes_uncaptioned[idx] for idx in rep2dups],
+                                                     list(rep2dups.values()), cap_dpath, cap_cache_fpath, embedder, max_concurrency, embed_batch_size)))
 
-        query_scores = cosine_similarity(np.array(query_embeds).reshape(1, -1), self.sem_embeds)[0]
-        lmks_sorted = sorted(zip(query_scores, self.sem_ids), reverse=True)
-        return lmks_sorted[:topk]
+    return [img_embeds[img_hash] for img_hash in img_hashes]
 
 
-def reg(graph_dpath, osm_fpath, srer_outs, topk, ablate, in_cache_fpath):
-    img_embeds, txt_embeds = None, None
+def index_map(graph_dpath, osm_fpath, modalities, embed_backend="openai", compact=False):
+    """
+    Bring embedding store of a map up to date with its images and OSM descriptions by their content hashes.
+    Only added or changed images are captioned, and only added or changed landmarks are embedded, in batch.
+    :return: store, landmark names of OSM descriptions, modality to numbers of added, changed and deleted landmarks
+    """
+    embedder = get_embedder(embed_backend)
+    store = EmbedStore(backend_fpath(os.path.join(graph_dpath, "embed_store"), embed_backend))
+    lmk_names, deltas = [], {}
 
-    if not ablate or ablate == "both" or ablate == "text":
+    if "image" in modalities:
         img_cap_dpath = os.path.join(graph_dpath, "image_captions")
+        img_cap_cache_fpath = os.path.join(os.path.dirname(os.path.normpath(graph_dpath)), "image_captions.jsonl")  # shared by maps
         os.makedirs(img_cap_dpath, exist_ok=True)
-        img_embed_dpath = os.path.join(graph_dpath, "image_embeds")
-        os.makedirs(img_embed_dpath, exist_ok=True)
 
         img_dpath = os.path.join(graph_dpath, "images")  # SLAM
         img_fpaths = sorted([os.path.join(img_dpath, fname) for fname in os.listdir(img_dpath) if ".jpg" in fname or ".png" in fname])
-        img_embeds = embed_images(img_fpaths, img_cap_dpath, img_embed_dpath)
-
-    if not ablate or ablate == "both" or ablate == "image":
-        txt_embed_dpath = os.path.join(graph_dpath, "text_embeds")
-        os.makedirs(txt_embed_dpath, exist_ok=True)
-
+        img_ids = [Path(img_fpath).stem for img_fpath in img_fpaths]
+        img_hashes = [file_hash(img_fpath) for img_fpath in img_fpaths]
+        stale_ids = {lmk_id for modality, lmk_id in store.offsets if modality == "image"}  # embedded before, so changed if not matched
+        deltas["image"] = store.sync("image", img_ids, img_hashes,
+                                     lambda idxs: embed_images([img_fpaths[idx] for idx in idxs], [img_hashes[idx] for idx in idxs], img_cap_dpath, img_cap_cache_fpath, embedder, stale_ids),
+                                     compact)
+
+    if "text" in modalities:
         obj_locs_fpath = os.path.join(graph_dpath, "obj_locs.json")  # avoid lmks with visual description
         obj_locs = load_from_file(obj_locs_fpath)
 
         txts = load_from_file(osm_fpath)  # OSM
-        txt_embeds = embed_texts(txts, obj_locs, txt_embed_dpath)
+        lmk_names = [lmk_name for lmk_name in txts if lmk_name not in obj_locs]
+        for lmk_name in lmk_names:
+            txts[lmk_name]["name"] = lmk_name  # add landmark name into its textual description
+        lmk_hashes = [content_hash(txts[lmk_name]) for lmk_name in lmk_names]
+        deltas["text"] = store.sync("text", lmk_names, lmk_hashes,
+                                    lambda idxs: embedder.embed([txts[lmk_names[idx]] for idx in idxs]),
+                                    compact)
+
+    return store, lmk_names, deltas
+
+
+class REG():
+    """
+    Referring Expression Grounding (REG) module. Use semantic description of landmarks and objects in text and images.
+    """
+    def __init__(self, store, modalities, embed_backend="openai", codec=None, index="exact", nprobe=IVF_NPROBE, name_index=None):
+        self.embedder = get_embedder(embed_backend)
+        self.sem_ids, self.sem_modalities, self.sem_embeds = store.view(modalities)  # unit-norm rows mapped from disk without copy
+        self.ndeleted = self.sem_ids.count(None)  # tombstoned rows of changed and deleted landmarks until store is compacted
+
+        if index not in ["exact", "ivf"]:
+            raise ValueError(f"ERROR: REG index {index} not recognized")
+        self.codec = codec  # score on compact embeddings if provided
+        if codec:
+            codec.fit(self.sem_embeds)
+        self.ann = None  # approximate nearest neighbor index if provided
+        if index == "ivf" and len(self.sem_ids):
+            # Cells hold float32 embeddings, reduced in dimension by codec if provided but not quantized
+            ivf_dpath = os.path.join(store.store_dpath, f"ivf_{'_'.join(modalities)}_{codec.name if codec else 'float32'}")
+            self.ann = IVFIndex.load_or_build(lambda: codec.project(self.sem_embeds) if codec else self.sem_embeds,
+                                              ivf_dpath, store.fingerprint(modalities), nprobe)
+        elif codec:
+            self.codes, self.scales = codec.encode(self.sem_embeds)
+        self.nscored, self.score_secs = 0, 0.0
+        self.name_index = name_index  # rank landmarks matched by proper name first if provided
+        self.id2row = {lmk_id: row for row, lmk_id in enumerate(self.sem_ids) if lmk_id is not None} if name_index else {}
+        self.nname_exact, self.nname_fuzzy = 0, 0
+
+    def score(self, query_embeds):
+        start_time = time.perf_counter()
+        if self.codec:
+            query_scores = self.codec.score(query_embeds, self.codes, self.scales)
+        else:
+            query_scores = query_embeds @ self.sem_embeds.T
+        self.score_secs += time.perf_counter() - start_time
+        self.nscored += len(query_embeds)
+        return query_scores
+
+    def stats(self):
+        """
+        Memory and similarity compute of landmark index to publish alongside REG accuracy.
+        """
+        nlmks, full_dim = self.sem_embeds.shape
+        if self.ann:  # centroids and landmarks in probed cells
+            dim = self.ann.embeds.shape[1]
+            index_bytes = self.ann.embeds.nbytes + self.ann.centroids.nbytes + self.ann.order.nbytes
+            flops_per_query = 2 * dim * (self.ann.nlists + min(self.ann.nprobe, self.ann.nlists) * nlmks // self.ann.nlists)
+        elif self.codec:
+            dim = self.codes.shape[1]
+            index_bytes = self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+            flops_per_query = 2 * nlmks * dim
+        else:
+            dim, index_bytes = full_dim, self.sem_embeds.nbytes
+            flops_per_query = 2 * nlmks * dim
+        if self.codec and self.codec.components is not None:  # PCA projection of query
+            index_bytes += self.codec.components.nbytes + self.codec.mean.nbytes
+            flops_per_query += 2 * full_dim * dim
+        return {
+            "mode": self.codec.name if self.codec else "float32",
+            "index": f"ivf{self.ann.nlists}_nprobe{self.ann.nprobe}" if self.ann else "exact",
+            "nlmks": nlmks - self.ndeleted,
+            "dim": dim,
+            "index_mb": index_bytes / 2**20,
+            "full_float32_mb": nlmks * full_dim * 4 / 2**20,
+            "flops_per_query": flops_per_query,
+            "nqueries": self.nscored,
+            "nname_exact": self.nname_exact,
+            "nname_fuzzy": self.nname_fuzzy,
+            "score_ms_per_query": self.score_secs * 1000 / self.nscored if self.nscored else 0.0,
+        }
+
+    def modality_mask(self, modalities):
+        """
+        Landmark rows of given modalities, or None for all rows.
+        """
+        if modalities is None:
+            return None
+        return np.array([modality in modalities for modality in self.sem_modalities], dtype=bool)
+
+    def search(self, query_embeds, topk, masks=(None,)):
+        """
+        Top-k landmarks by cosine similarity to each normalized query embedding, best first.
+        Score all queries in one matrix product, select top-k by partition then sort only them.
+        Queries are scored once for all masks, e.g., of modality ablations, and top-k is selected among rows in each mask.
+        :return: top-k landmarks of each query for each mask
+        """
+        query_embeds = np.atleast_2d(query_embeds)
+        if self.ann:
+            return [list(groundings) for groundings in zip(*[self.search_ann(query_embed, topk, masks) for query_embed in query_embeds])]
+
+        mask2groundings = [[] for _ in masks]
+        for start in range(0, len(query_embeds), SEARCH_BATCH_SIZE):  # bound memory of score matrix
+            query_scores = self.score(query_embeds[start: start + SEARCH_BATCH_SIZE])
+            for mask, groundings in zip(masks, mask2groundings):
+                groundings += self.select_topk(query_scores, topk, mask)
+        return mask2groundings
+
+    def select_topk(self, query_scores, topk, mask=None):
+        nlmks = query_scores.shape[1]
+        if mask is None:
+            ntop = min(topk + self.ndeleted, nlmks)  # tombstoned rows are dropped from top rows
+        else:
+            query_scores = np.where(mask, query_scores, -np.inf)  # tombstoned rows are not in any mask
+            ntop = min(topk, int(mask.sum()))
+        if ntop == 0:
+            return [[] for _ in query_scores]
+        if ntop < nlmks:
+            top_idxs = np.argpartition(-query_scores, ntop - 1, axis=1)[:, :ntop]
+        else:
+            top_idxs = np.broadcast_to(np.arange(nlmks), query_scores.shape)
+        top_scores = np.take_along_axis(query_scores, top_idxs, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top_idxs, top_scores = np.take_along_axis(top_idxs, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+        return [[Grounding(score, self.sem_ids[idx]) for score, idx in zip(scores, idxs) if self.sem_ids[idx] is not None][:topk]
+                for idxs, scores in zip(top_idxs.tolist(), top_scores.tolist())]
+
+    def search_ann(self, query_embed, topk, masks=(None,)):
+        """
+        Approximate top-k landmarks of a normalized query embedding for each mask.
+        With masks other than None, all landmarks in probed cells are ranked then filtered by each mask.
+        """
+        start_time = time.perf_counter()
+        if self.codec:
+            query_embed = self.codec.project(query_embed)[0]
+        ncandidates = topk + self.ndeleted if all(mask is None for mask in masks) else len(self.sem_ids)
+        top_idxs, top_scores = self.ann.search(query_embed, ncandidates)
+        self.score_secs += time.perf_counter() - start_time
+        self.nscored += 1
+        return [[Grounding(score, self.sem_ids[idx]) for score, idx in zip(top_scores.tolist(), top_idxs.tolist())
+                 if self.sem_ids[idx] is not None and (mask is None or mask[idx])][:topk]
+                for mask in masks]
+
+    def query_batch(self, queries, topk, ablates=None):
+        """
+        Ground unique queries in batch.
+        If ablates are given, e.g., ABLATIONS, each query is scored once and grounded to landmarks of modalities
+        of each ablation by masking out the others.
+        :return: query to its top-k landmarks, or ablate to query to its top-k landmarks if ablates are given
+        """
+        ablate2modalities = {ablate: ablate_modalities(ablate) for ablate in ablates} if ablates else {None: None}
+        ablate2groundings = {ablate: {} for ablate in ablate2modalities}
+        queries = list(dict.fromkeys(queries))
+        query2match = {}  # landmark row and similarity of queries matching a landmark name
+        for query in queries:
+            match = self.name_index.match(query) if self.name_index else None
+            if match and match[0] in self.id2row:
+                query2match[query] = (self.id2row[match[0]], match[1])
+                if match[1] == 1.0:
+                    self.nname_exact += 1
+                else:
+                    self.nname_fuzzy += 1
+        if not queries:
+            return ablate2groundings if ablates else ablate2groundings[None]
+
+        query_embeds = l2_normalize(self.embedder.embed(queries))  # queries embedded before are read from the embedding cache
+        masks = [self.modality_mask(modalities) for modalities in ablate2modalities.values()]
+        for modalities, query2groundings, groundings in zip(ablate2modalities.values(), ablate2groundings.values(), self.search(query_embeds, topk, masks)):
+            for query, query_embed, query_groundings in zip(queries, query_embeds, groundings):
+                match = query2match.get(query)
+                if match and (modalities is None or self.sem_modalities[match[0]] in modalities):
+                    query_groundings = self.rank_name_match(query_embed, query_groundings, *match, topk)
+                query2groundings[query] = query_groundings
+        return ablate2groundings if ablates else ablate2groundings[None]
+
+    def rank_name_match(self, query_embed, groundings, row, sim, topk):
+        """
+        Rank landmark matched by name among top-k landmarks by embedding similarity, keeping scores on the cosine scale SPG multiplies.
+        Exact match goes first, scored NAME_MATCH_MARGIN above best embedding score, followed by top-k - 1 embedding groundings.
+        Fuzzy match is boosted by NAME_MATCH_MARGIN times its trigram similarity then ranked with embedding groundings.
+        """
+        lmk_id = self.sem_ids[row]
+        cosine = float(self.sem_embeds[row] @ query_embed)
+        groundings = [grounding for grounding in groundings if grounding.lmk_id != lmk_id]
+        if sim == 1.0:
+            score = max(cosine, groundings[0].score + NAME_MATCH_MARGIN) if groundings else cosine
+            return [Grounding(score, lmk_id)] + groundings[:topk - 1]
+        groundings.append(Grounding(cosine + NAME_MATCH_MARGIN * sim, lmk_id))
+        return sorted(groundings, key=lambda grounding: grounding.score, reverse=True)[:topk]
+
+    def query(self, query, topk):
+        return self.query_batch([query], topk)[query]
+
+
+def load_reg(graph_dpath, osm_fpath, ablate, embed_backend="openai", codec=None, index="exact", alias_fpath=None):
+    modalities = ablate_modalities(ablate)
+    store, lmk_names, _ = index_map(graph_dpath, osm_fpath, modalities, embed_backend)
+    name_index = NameIndex.from_files(lmk_names, alias_fpath) if "text" in modalities else None
+    return REG(store, modalities, embed_backend, codec, index, name_index=name_index)
+
+
+def sre_queries(srer_outs):
+    """
+    Referring expressions to ground of every utterance of a run.
+    """
+    queries = []
+    for srer_out in srer_outs:
+        for sre, spatial_pred in srer_out["sre_to_preds"].items():
+            queries += list(spatial_pred.values())[0] if spatial_pred else [sre]
+    return queries
 
-    reg = REG(img_embeds, txt_embeds, in_cache_fpath)
 
-    for srer_out in tqdm(srer_outs, desc="Running referring expression grounding (REG) module"):
+def scatter_groundings(srer_outs, query2groundings):
+    for srer_out in srer_outs:
         grounded_sre_to_preds = {}
 
         for sre, spatial_pred in srer_out["sre_to_preds"].items():
@@ -119,29 +411,80 @@ def reg(graph_dpath, osm_fpath, srer_outs, topk, ablate, in_cache_fpath):
                 spatial_relation = "None"  # reference expression without spatial relation
                 res = [sre]
 
-            grounded_res = []
-            for query in enumerate(res):
-                lmk_candidates = reg.query(query, topk=topk)
-                grounded_res.append(lmk_candidates)
-            grounded_sre_to_preds[sre] = {spatial_relation: grounded_res}
+            grounded_sre_to_preds[sre] = {spatial_relation: [query2groundings[query] for query in res]}
 
         srer_out["grounded_sre_to_preds"] = grounded_sre_to_preds
 
 
-def run_exp_reg(srer_out_fpath, graph_dpath, osm_fpath, topk, ablate, reg_out_fpath, in_cache_fpath):
+def reg(graph_dpath, osm_fpath, srer_outs, topk, ablate, embed_backend="openai", codec=None, index="exact", alias_fpath=None):
+    reg = load_reg(graph_dpath, osm_fpath, ablate, embed_backend, codec, index, alias_fpath)
+
+    # Ground every unique referring expression of the run in batch then scatter results to each utterance
+    query2groundings = reg.query_batch(sre_queries(srer_outs), topk=topk)
+    scatter_groundings(srer_outs, query2groundings)
+    return reg.stats()
+
+
+def reg_ablations(graph_dpath, osm_fpath, srer_outs, topk, ablates, embed_backend="openai", codec=None, index="exact", alias_fpath=None):
+    """
+    Ground referring expressions for several modality ablations in one pass: one REG over landmarks of both modalities
+    scores each query once, and each ablation selects its top-k by masking out landmarks of its ablated modality.
+    :return: ablate to its copy of SRER outputs with groundings, REG stats
+    """
+    reg = load_reg(graph_dpath, osm_fpath, "all", embed_backend, codec, index, alias_fpath)
+    ablate2groundings = reg.query_batch(sre_queries(srer_outs), topk=topk, ablates=ablates)
+
+    ablate2srer_outs = {}
+    for ablate, query2groundings in ablate2groundings.items():
+        ablate2srer_outs[ablate] = json.loads(json.dumps(srer_outs))  # deep copy
+        scatter_groundings(ablate2srer_outs[ablate], query2groundings)
+    return ablate2srer_outs, reg.stats()
+
+
+def run_exp_reg(srer_out_fpath, graph_dpath, osm_fpath, topk, ablate, reg_out_fpath, embed_backend="openai", codec=None, index="exact", alias_fpath=None):
     if not os.path.isfile(reg_out_fpath):
         srer_outs = load_from_file(srer_out_fpath)
-        reg(graph_dpath, osm_fpath, srer_outs, topk, ablate, in_cache_fpath)
+        reg_stats = reg(graph_dpath, osm_fpath, srer_outs, topk, ablate, embed_backend, codec, index, alias_fpath)
         save_to_file(srer_outs, reg_out_fpath)
+        save_to_file(reg_stats, stats_fpath(reg_out_fpath))
+
+
+def run_exp_reg_ablations(srer_out_fpath, graph_dpath, osm_fpath, topk, ablate2reg_out_fpath, embed_backend="openai", codec=None, index="exact", alias_fpath=None):
+    """
+    Run REG of every ablation without outputs in one pass.
+    """
+    ablates = [ablate for ablate, reg_out_fpath in ablate2reg_out_fpath.items() if not os.path.isfile(reg_out_fpath)]
+    if ablates:
+        srer_outs = load_from_file(srer_out_fpath)
+        ablate2srer_outs, reg_stats = reg_ablations(graph_dpath, osm_fpath, srer_outs, topk, ablates, embed_backend, codec, index, alias_fpath)
+        for ablate, srer_outs in ablate2srer_outs.items():
+            save_to_file(srer_outs, ablate2reg_out_fpath[ablate])
+            save_to_file(reg_stats, stats_fpath(ablate2reg_out_fpath[ablate]))
+
+
+def reindex(graph_dpath, osm_fpath, embed_backend="openai", compact=False):
+    """
+    Re-caption and re-embed only images and OSM landmarks added or changed since the map was last indexed,
+    and drop deleted ones, patching the map's embedding store in place.
+    """
+    modalities = ["image", "text"] if os.path.isdir(os.path.join(graph_dpath, "images")) else ["text"]
+    store, _, deltas = index_map(graph_dpath, osm_fpath, modalities, embed_backend, compact)
+    for modality, delta in deltas.items():
+        logging.info(f"{modality}: {delta['added']} added, {delta['changed']} changed, {delta['deleted']} deleted")
+    logging.info(f"{len(store.ids) - store.ndeleted} landmarks, {store.ndeleted} deleted rows in {store.store_dpath}")
+    return deltas
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--loc", type=str, default="providence", help="map name under data/maps and data/osm.")
+    parser.add_argument("--ablate", type=str, default=None, choices=["both", "image", "text", None], help="reindex map and OSM of ablation dataset.")
+    parser.add_argument("--embed_backend", type=str, default="openai", choices=["openai", "local"], help="embedding backend of store to reindex.")
+    parser.add_argument("--compact", action="store_true", help="rewrite store without rows of deleted landmarks.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     data_dpath = os.path.join(os.path.expanduser("~"), "ground", "data")
-    graph_dpath = os.path.join(data_dpath, "maps", "downloaded_graph_2024-01-27_07-48-53")
-    osm_fpath = os.path.join(data_dpath, "osm", "blackstone.json")
-    results_dpath = os.path.join(os.path.expanduser("~"), "ground", "results")
-    srer_out_fname = "srer_outs_blackstone.json"
-
-    srer_outs = load_from_file(os.path.join(results_dpath, srer_out_fname))
-    reg_outs = reg(graph_dpath, osm_fpath, srer_out_fname, topk=5, ablate=None)
-    save_to_file(reg_outs, os.path.join(results_dpath, srer_out_fname.replace("srer", "reg")))
+    graph_dpath = os.path.join(data_dpath, "maps", f"{args.loc}_ablate" if args.ablate else args.loc)
+    osm_fpath = os.path.join(data_dpath, "osm_ablate" if args.ablate else "osm", f"{args.loc}.json")
+    reindex(graph_dpath, osm_fpath, args.embed_backend, args.compact)
@@ -0,0 +1,154 @@
+"""
+Persistent content-addressed cache of OpenAI API responses shared by concurrent processes.
+Key is a hash of the full request, i.e., model, messages or input, and sampling parameters.
+Access times of hits are written in batches, so lookups by parallel workers do not contend for the write lock.
+Run this file to print cache stats or invalidate all responses, e.g., after a model behind an endpoint changed.
+"""
+import os
+import json
+import time
+import atexit
+import argparse
+import hashlib
+import sqlite3
+import threading
+
+
+CACHE_FPATH = os.getenv("LLM_CACHE_FPATH", os.path.join(os.path.expanduser("~"), "ground", "data", "llm_cache.sqlite"))
+CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", 2048))
+EVICT_EVERY = 100  # check cache size every this many insertions
+TOUCH_EVERY = 256  # write access times of this many hits at once
+
+_cache = None
+
+
+class ResponseCache:
+    def __init__(self, db_fpath, max_bytes):
+        self.max_bytes = max_bytes
+        self.nhits, self.nmisses, self.nputs = 0, 0, 0
+        self.touched = {}  # key to access time of hits not written yet
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_fpath)), exist_ok=True)
+        self.conn = sqlite3.connect(db_fpath, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # readers do not block writer from other processes
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, nbytes INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(endpoint, kwargs):
+        return hashlib.sha256(json.dumps([endpoint, kwargs], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """
+        Look up responses of keys. Missing ones are None.
+        """
+        key2value = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):  # stay below max number of SQL variables
+                keys_batch = keys[start: start + 500]
+                placeholders = ",".join("?" * len(keys_batch))
+                key2value.update(self.conn.execute(f"SELECT key, value FROM responses WHERE key IN ({placeholders})", keys_batch).fetchall())
+            self.touched.update(dict.fromkeys(key2value, time.time()))
+            if len(self.touched) >= TOUCH_EVERY:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.write_touched()
+                self.conn.execute("COMMIT")
+            nhits = sum(key in key2value for key in keys)
+            self.nhits += nhits
+            self.nmisses += len(keys) - nhits
+        return [json.loads(key2value[key]) if key in key2value else None for key in keys]
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        rows = []
+        for key, value in items:
+            value = json.dumps(value)
+            rows.append((key, value, len(value), time.time()))
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.write_touched()
+            self.conn.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", rows)
+            self.conn.execute("COMMIT")
+            if self.nputs // EVICT_EVERY != (self.nputs + len(rows)) // EVICT_EVERY:
+                self.evict()
+            self.nputs += len(rows)
+
+    def write_touched(self):
+        """
+        Write access times of hits since last write, within a transaction held by caller.
+        """
+        if self.touched:
+            self.conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(accessed, key) for key, accessed in self.touched.items()])
+            self.touched = {}
+
+    def flush(self):
+        with self.lock:
+            if self.touched:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.write_touched()
+                self.conn.execute("COMMIT")
+
+    def delete(self, key):
+        """
+        Invalidate a response, e.g., one a caller failed to parse.
+        """
+        with self.lock:
+            self.touched.pop(key, None)
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def invalidate(self):
+        """
+        Delete all responses.
+        """
+        with self.lock:
+            self.touched = {}
+            return self.conn.execute("DELETE FROM responses").rowcount
+
+    def evict(self):
+        """
+        Evict least recently used responses until cache is within 90% of its size limit.
+        """
+        nbytes = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM responses").fetchone()[0]
+        if nbytes > self.max_bytes:
+            self.conn.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (SELECT key, SUM(nbytes) OVER (ORDER BY accessed DESC) AS cum_nbytes FROM responses)
+                    WHERE cum_nbytes > ?
+                )
+            """, (int(self.max_bytes * 0.9),))
+
+    def stats(self):
+        with self.lock:
+            nentries, nbytes = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM responses").fetchone()
+        nlookups = self.nhits + self.nmisses
+        return {"hits": self.nhits, "misses": self.nmisses, "hit_rate": self.nhits / nlookups if nlookups else 0.0,
+                "entries": nentries, "mb": nbytes / 2**20}
+
+
+def get_cache():
+    """
+    Response cache shared by all API wrappers in this process. Disabled if LLM_CACHE=0.
+    """
+    global _cache
+    if _cache is None and os.getenv("LLM_CACHE", "1") != "0":
+        _cache = ResponseCache(CACHE_FPATH, CACHE_MAX_MB * 2**20)
+    return _cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--invalidate", action="store_true", help="delete all cached responses.")
+    args = parser.parse_args()
+
+    cache = ResponseCache(CACHE_FPATH, CACHE_MAX_MB * 2**20)
+    if args.invalidate:
+        print(f"Deleted {cache.invalidate()} responses from {CACHE_FPATH}")
+    print(cache.stats())
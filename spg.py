@@ -1,15 +1,17 @@
 import os
 from pathlib import Path
 from tqdm import tqdm
-from itertools import product
+import heapq
+from itertools import product, islice
 import numpy as np
 import utm
 from pyproj import Transformer
 from sklearn.metrics.pairwise import cosine_similarity
 import matplotlib.pyplot as plt
 
+from landmark_table import LandmarkTable
 from load_map import load_map, extract_waypoints
-from openai_models import get_embed
+from openai_models import get_embedder
 from utils import load_from_file, save_to_file
 
 
@@ -22,6 +24,12 @@ KNOWN_RELATIONS = [
 ]
 MAX_RANGE = 50  # target within this radius of anchor. providence: 60; auckland: 40; boston: 60; san_francisco: 80; indoor: 2; outdoor: 50
 DIST_TO_ANCHOR = 2.0  # distance to robot when compute a target location for SRE with only an anchor
+RELATIVE_ANGLES = {"in front of": 0, "opposite to": 0, "behind": 180, "left": -90, "right": 90}  # mean angle from anchor-to-robot vector
+CARDINAL_DIRECTIONS = {"north": (1, 0), "south": (-1, 0), "east": (0, 1), "west": (0, -1),
+                       "northeast": (1, 1), "northwest": (1, -1), "southeast": (-1, 1), "southwest": (-1, -1)}  # (y, x) of direction
+NEAR_RELATIONS = ["near", "next to", "adjacent to", "close to", "by"]  # 360-sweep of anchor's possible fronts
+RANGE_PRUNE_SLACK = 1e-9  # relative slack of range pruning radius so rounding never drops a candidate evaluated in range
+EVAL_BATCH_SIZE = 16  # combinations of first batch evaluated at once by spg, doubled for each further batch
 
 
 def plot_landmarks(landmarks=None, osm_fpth=None):
@@ -32,15 +40,15 @@ def plot_landmarks(landmarks=None, osm_fpth=None):
     plt.rcParams.update({'font.size': 5})
 
     if landmarks:
-        plt.scatter(x=[landmarks[L]["x"] for L in landmarks], y=[landmarks[L]["y"] for L in landmarks], c="green", label="landmarks")
-        for L in landmarks:
-            if "osm_name" not in landmarks[L] and L != "robot":
-                plt.text(landmarks[L]["x"], landmarks[L]["y"], L)
-
-    plt.scatter(x=landmarks["robot"]["x"],
-                y=landmarks["robot"]["y"], c="orange", label="robot")
-    plt.text(landmarks["robot"]["x"],
-             landmarks["robot"]["y"], "robot")
+        plt.scatter(x=landmarks.coords[:, 0], y=landmarks.coords[:, 1], c="green", label="landmarks")
+        for lmk_id, (name, coord) in enumerate(zip(landmarks.names, landmarks.coords)):
+            if lmk_id != landmarks.robot_id:
+                plt.text(coord[0], coord[1], name)
+
+    plt.scatter(x=landmarks.robot[0],
+                y=landmarks.robot[1], c="orange", label="robot")
+    plt.text(landmarks.robot[0],
+             landmarks.robot[1], "robot")
     plt.legend()
 
     if osm_fpth:
@@ -175,6 +183,7 @@ def create_waypoints(obj_fpath, crs):
 def load_lmks(graph_dpath=None, osm_fpath=None, ignore_graph=False):
     """
     Load landmarks from OSM or Spot graph or both then convert their locations to Cartesian coordinates.
+    :return: LandmarkTable of robot, Spot waypoints and OSM landmarks
     """
     # Load waypoints from Spot graph if exists
     waypoints, transformer = None, None
@@ -208,6 +217,7 @@ def load_lmks(graph_dpath=None, osm_fpath=None, ignore_graph=False):
 
     # Put Spot waypoints and OSM landmarks in Cartesian coordinates
     landmarks = align_coordinates(graph_dpath, waypoints, osm_landmarks, alignment_lmks, transformer)
+    landmarks = LandmarkTable.from_dict(landmarks, osm_landmarks)
 
     # Visualize landmarks
     plot_landmarks(landmarks, osm_fpath)
@@ -215,82 +225,91 @@ def load_lmks(graph_dpath=None, osm_fpath=None, ignore_graph=False):
     return landmarks
 
 
-def sort_combs(lmk_grounds):
+def make_comb(comb):
     """
-    Sort all combinations of target and anchor landmarks by their joint cosine similarity scores.
+    Joint cosine similarity score and target and anchor landmark names of a combination of (score, landmark) pairs.
     """
-    combs_sorted = []
-
-    for comb in list(product(*lmk_grounds)):  # Cartesian product of lists of target and anchor landmarks
-        joint_score = 1
-        target, anchor = [], []
-
-        for idx, score_lmk in enumerate(comb):
-            joint_score *= score_lmk[0]
+    joint_score = 1
+    target, anchor = [], []
 
-            # Get target or anchor landmark name of the combination
-            if idx == 0:  # target landmark is always the first in a combination
-                target.append(score_lmk[1])
-            else:  # SRE with 0, 1 or 2 anchor landmarks
-                anchor.append(score_lmk[1])
+    for idx, score_lmk in enumerate(comb):
+        joint_score *= score_lmk[0]
 
-        combs_sorted.append({"score": joint_score, "target": target, "anchor": anchor})
+        # Get target or anchor landmark name of the combination
+        if idx == 0:  # target landmark is always the first in a combination
+            target.append(score_lmk[1])
+        else:  # SRE with 0, 1 or 2 anchor landmarks
+            anchor.append(score_lmk[1])
 
-    combs_sorted.sort(key=lambda comb: comb["score"], reverse=True)
-    return combs_sorted
+    return {"score": joint_score, "target": target, "anchor": anchor}
 
 
-def find_match_rel(rel_unseen, known_rel_embeds_fpath):
+def sort_combs(lmk_grounds):
+    """
+    Generate combinations of target and anchor landmarks in descending order of their joint cosine similarity scores.
+    Joint score is a product of scores, so with non-negative scores it cannot increase along any score-sorted list.
+    Best-first search from the top of every list then only scores combinations on the frontier of those pulled so far.
+    Ties are broken in order of the Cartesian product of input lists, as in a stable full sort.
+    """
+    lmk_grounds = [sorted(score_lmks, key=lambda score_lmk: score_lmk[0], reverse=True) for score_lmks in lmk_grounds]
+    if not all(lmk_grounds):
+        return
+    if any(score_lmk[0] < 0 for score_lmks in lmk_grounds for score_lmk in score_lmks):  # product not monotone, sort all
+        yield from sorted((make_comb(comb) for comb in product(*lmk_grounds)), key=lambda comb: comb["score"], reverse=True)
+        return
+
+    start = (0,) * len(lmk_grounds)
+    frontier = [(-make_comb([score_lmks[0] for score_lmks in lmk_grounds])["score"], start)]
+    visited = {start}
+    while frontier:
+        _, idxs = heapq.heappop(frontier)
+        yield make_comb([score_lmks[idx] for score_lmks, idx in zip(lmk_grounds, idxs)])
+
+        for dim, idx in enumerate(idxs):  # successors: next landmark in one list
+            if idx + 1 < len(lmk_grounds[dim]):
+                idxs_next = idxs[:dim] + (idx + 1,) + idxs[dim + 1:]
+                if idxs_next not in visited:
+                    visited.add(idxs_next)
+                    comb_next = make_comb([score_lmks[idx_next] for score_lmks, idx_next in zip(lmk_grounds, idxs_next)])
+                    heapq.heappush(frontier, (-comb_next["score"], idxs_next))
+
+
+def find_match_rel(rel_unseen, embed_backend="openai"):
     """
     Use cosine similatiry between text embeddings to find best matching known spatial relation to unseen input.
+    Embeddings of known and unseen relations are read from the embedding cache if embedded before.
     """
-    if os.path.isfile(known_rel_embeds_fpath):
-        known_rel_embeds = load_from_file(known_rel_embeds_fpath)
-    else:
-        known_rel_embeds = {known_rel: get_embed(known_rel) for known_rel in KNOWN_RELATIONS}
-        save_to_file(known_rel_embeds, known_rel_embeds_fpath)
-
-    # unseen_rel_embed = get_embed(rel_unseen)
-    unknown_rel_embeds_fpath = known_rel_embeds_fpath.replace("known", "unknown")
-    unknown_rel_embeds = load_from_file(unknown_rel_embeds_fpath) if os.path.isfile(unknown_rel_embeds_fpath) else {}
-    if rel_unseen in unknown_rel_embeds:
-        unseen_rel_embed = unknown_rel_embeds[rel_unseen]
-    else:
-        unseen_rel_embed = get_embed(rel_unseen)
-        unknown_rel_embeds[rel_unseen] = unseen_rel_embed
-        save_to_file(unknown_rel_embeds, unknown_rel_embeds_fpath)
-        print(f"SAVED UNSEEN SPATIAL RELATION: {rel_unseen}'")
+    embeds = get_embedder(embed_backend).embed(KNOWN_RELATIONS + [rel_unseen])
+    known_rel_embeds, unseen_rel_embed = embeds[:-1], embeds[-1]
 
-    scores = cosine_similarity(np.array(unseen_rel_embed).reshape(1, -1), np.array(list(known_rel_embeds.values())))[0]
+    scores = cosine_similarity(np.array(unseen_rel_embed).reshape(1, -1), np.array(known_rel_embeds))[0]
     rel_match = sorted(zip(scores, KNOWN_RELATIONS), reverse=True)[0][1]
     return rel_match
 
 
-def get_target_loc(landmarks, spatial_rel, anchor_candidate, sre=None, plot=False):
+def get_target_loc(landmarks, spatial_rel, anchor_id, sre=None, plot=False):
     """
     Ground spatial referring expression with only an anchor landmark: left, right, cardinal directions
     by finding a location relative to the given anchor landmark.
     e.g., go to the left side of the bakery, go to the north of the bakery
     """
-    robot = landmarks["robot"]
-    try:
-        anchor = landmarks[anchor_candidate]
-    except KeyError:
-        return None
+    if anchor_id < 0:
+        return None  # anchor may instead be a waypoint in the Spot space
+    robot, anchor = landmarks.robot, landmarks.coords[anchor_id]
 
     # Compute valid the range vector(s) (potentially only one) for an anchoring landmark
     range_vecs = compute_area(spatial_rel, robot, anchor)
 
     # Compute robot location that is at given distance to the anchor
-    loc_min = {"x": (range_vecs[0]["mean"][0] * DIST_TO_ANCHOR) + anchor["x"],
-               "y": (range_vecs[0]["mean"][1] * DIST_TO_ANCHOR) + anchor["y"]}
-    dist_min = np.linalg.norm(np.array([loc_min["x"], loc_min["y"]]) - np.array([robot["x"], robot["y"]]))
+    loc_min = {"x": (range_vecs[0]["mean"][0] * DIST_TO_ANCHOR) + anchor[0],
+               "y": (range_vecs[0]["mean"][1] * DIST_TO_ANCHOR) + anchor[1]}
+    dist_min = np.linalg.norm(np.array([loc_min["x"], loc_min["y"]]) - robot)
     range_vec_closest = range_vecs[0]
 
     for range_vec in range_vecs:
-        loc_new = {"x": (range_vec["mean"][0] * DIST_TO_ANCHOR) + anchor["x"],
-                   "y": (range_vec["mean"][1] * DIST_TO_ANCHOR) + anchor["y"]}
-        dist_new = np.linalg.norm(np.array([loc_new["x"], loc_new["y"]]) - np.array([robot["x"], robot["y"]]))
+        loc_new = {"x": (range_vec["mean"][0] * DIST_TO_ANCHOR) + anchor[0],
+                   "y": (range_vec["mean"][1] * DIST_TO_ANCHOR) + anchor[1]}
+        dist_new = np.linalg.norm(np.array([loc_new["x"], loc_new["y"]]) - robot)
 
         if dist_new < dist_min:
             loc_min = loc_new
@@ -300,20 +319,20 @@ def get_target_loc(landmarks, spatial_rel, anchor_candidate, sre=None, plot=Fals
     if plot:
         plt.figure()
 
-        plt.scatter(x=[robot["x"]], y=[robot["y"]], marker="o", label="robot")
+        plt.scatter(x=[robot[0]], y=[robot[1]], marker="o", label="robot")
         plt.scatter(x=[loc_min["x"]], y=[loc_min["y"]], marker="x", c="g", s=15, label="new robot loc")
 
         # Plot all target and anchor landmarks
-        for lmk in landmarks:
-            plt.scatter(x=landmarks[lmk]["x"], y=landmarks[lmk]["y"], marker="o", c="darkorange", label=f"anchor: {lmk}")
-            plt.text(landmarks[lmk]["x"], landmarks[lmk]["y"], lmk)
+        for lmk, coord in zip(landmarks.names, landmarks.coords):
+            plt.scatter(x=coord[0], y=coord[1], marker="o", c="darkorange", label=f"anchor: {lmk}")
+            plt.text(coord[0], coord[1], lmk)
 
         # Plot the range
-        plt.plot([anchor["x"], (range_vec_closest["min"][0] * DIST_TO_ANCHOR) + anchor["x"]],
-                 [anchor["y"], (range_vec_closest["min"][1] * DIST_TO_ANCHOR) + anchor["y"]],
+        plt.plot([anchor[0], (range_vec_closest["min"][0] * DIST_TO_ANCHOR) + anchor[0]],
+                 [anchor[1], (range_vec_closest["min"][1] * DIST_TO_ANCHOR) + anchor[1]],
                  linestyle="dotted", c="r")
-        plt.plot([anchor["x"], (range_vec_closest["max"][0] * DIST_TO_ANCHOR) + anchor["x"]],
-                 [anchor["y"], (range_vec_closest["max"][1] * DIST_TO_ANCHOR) + anchor["y"]],
+        plt.plot([anchor[0], (range_vec_closest["max"][0] * DIST_TO_ANCHOR) + anchor[0]],
+                 [anchor[1], (range_vec_closest["max"][1] * DIST_TO_ANCHOR) + anchor[1]],
                  linestyle="dotted", c="b")
 
         plt.title(f"Computed Target Position: {sre}" if sre else f"Computed Target Position: {spatial_rel}")
@@ -327,11 +346,13 @@ def compute_area(spatial_rel, robot, anchor, do_360_search=False, anchor_name=No
     """
     Compute a vector from anchor to robot as a normal vector pointing outside of anchor
     and a range within which the vector from anchor to target can lie.
+    :param robot: robot coordinates
+    :param anchor: anchor coordinates
     """
     range_vecs = []
 
     # Compute unit vector from anchor to robot
-    vec_a2r = [robot["x"] - anchor["x"], robot["y"] - anchor["y"]]
+    vec_a2r = [robot[0] - anchor[0], robot[1] - anchor[1]]
     unit_vec_a2r = np.array(vec_a2r) / np.linalg.norm(vec_a2r)
     fov = 180  # robot's field-of-view
 
@@ -387,31 +408,31 @@ def compute_area(spatial_rel, robot, anchor, do_360_search=False, anchor_name=No
         plt.figure()
 
         # Plot robot and anchor location
-        plt.scatter(x=[robot["x"]], y=[robot["y"]], marker="o", color="yellow", label="robot")
-        plt.scatter(x=[anchor["x"]], y=[anchor["y"]], marker="o", color="orange", label="anchor")
-        plt.text(anchor["x"], anchor["y"], s=anchor_name)
+        plt.scatter(x=[robot[0]], y=[robot[1]], marker="o", color="yellow", label="robot")
+        plt.scatter(x=[anchor[0]], y=[anchor[1]], marker="o", color="orange", label="anchor")
+        plt.text(anchor[0], anchor[1], s=anchor_name)
 
         # Plot the normal vector from the robot to the anchor:
-        plt.plot([robot["x"], anchor["x"]], [robot["y"], anchor["y"]], color="black")
-        plt.arrow(x=robot["x"], y=robot["y"], dx=-vec_a2r[0]/2.0, dy=-vec_a2r[1]/2.0, shape="full",
+        plt.plot([robot[0], anchor[0]], [robot[1], anchor[1]], color="black")
+        plt.arrow(x=robot[0], y=robot[1], dx=-vec_a2r[0]/2.0, dy=-vec_a2r[1]/2.0, shape="full",
                   width=0.01, head_width=0.1, color="black", label="normal")
 
         for idx, range_vec in enumerate(range_vecs):
-            mean_pose = [(range_vec["mean"][0] * MAX_RANGE) + anchor["x"],
-                         (range_vec["mean"][1] * MAX_RANGE) + anchor["y"]]
+            mean_pose = [(range_vec["mean"][0] * MAX_RANGE) + anchor[0],
+                         (range_vec["mean"][1] * MAX_RANGE) + anchor[1]]
             plt.scatter(x=[mean_pose[0]], y=[mean_pose[1]], c="g", marker="o", label=f"mean_{idx}")
 
-            min_pose = [(range_vec["min"][0] * MAX_RANGE) + anchor["x"],
-                        (range_vec["min"][1] * MAX_RANGE) + anchor["y"]]
+            min_pose = [(range_vec["min"][0] * MAX_RANGE) + anchor[0],
+                        (range_vec["min"][1] * MAX_RANGE) + anchor[1]]
             plt.scatter(x=[min_pose[0]], y=[min_pose[1]], c="r", marker="x", label=f"min_{idx}")
 
-            max_pose = [(range_vec["max"][0] * MAX_RANGE) + anchor["x"],
-                        (range_vec["max"][1] * MAX_RANGE) + anchor["y"]]
+            max_pose = [(range_vec["max"][0] * MAX_RANGE) + anchor[0],
+                        (range_vec["max"][1] * MAX_RANGE) + anchor[1]]
             plt.scatter(x=[max_pose[0]], y=[max_pose[1]], c="b", marker="x", label=f"max_{idx}")
 
-            plt.plot([anchor["x"], mean_pose[0]], [anchor["y"], mean_pose[1]], linestyle="dashed", c="g")
-            plt.plot([anchor["x"], min_pose[0]], [anchor["y"], min_pose[1]], linestyle="dotted", c="r")
-            plt.plot([anchor["x"], max_pose[0]], [anchor["y"], max_pose[1]], linestyle="dotted", c="b")
+            plt.plot([anchor[0], mean_pose[0]], [anchor[1], mean_pose[1]], linestyle="dashed", c="g")
+            plt.plot([anchor[0], min_pose[0]], [anchor[1], min_pose[1]], linestyle="dotted", c="r")
+            plt.plot([anchor[0], max_pose[0]], [anchor[1], max_pose[1]], linestyle="dotted", c="b")
 
         plt.title(f"Evaluated range for spatial relation: {spatial_rel}")
         plt.legend()
@@ -421,67 +442,25 @@ def compute_area(spatial_rel, robot, anchor, do_360_search=False, anchor_name=No
     return range_vecs
 
 
-def eval_spatial_pred(landmarks, spatial_rel, target_candidate, anchor_candidates, sre=None, plot=False):
+def eval_spatial_pred(landmarks, spatial_rel, target_id, anchor_ids, sre=None, plot=False):
     """
-    Evaluate if a spatial relation is valid given candidate target landmark and anchor landmark(s).
+    Evaluate if a spatial relation is valid given ids of candidate target landmark and anchor landmark(s),
+    as a batch of one candidate of eval_spatial_preds. Plot the evaluated range if plot.
     """
-    robot, target = landmarks["robot"], landmarks[target_candidate]
-
-    # If target equals to any anchor, spatial predicate is True
-    if target_candidate in anchor_candidates:
-        return False
-    # Check if target has same location as any anchor
-    # OSM landmark name and Spot waypoint ID refer to same location
-    for lmk_id in anchor_candidates:
-        if target["x"] == landmarks[lmk_id]["x"] and target["y"] == landmarks[lmk_id]["y"]:
-            return False
-
-    if spatial_rel in ["between"]:
-        # assert len(anchor_candidates) == 2, f"between but candidate anchors less than two: {anchor_candidates}"
-        try:
-            anchor_1 = landmarks[anchor_candidates[0]]
-            anchor_2 = landmarks[anchor_candidates[1]]
-        except (KeyError, IndexError):
-            return False  # anchor may instead be a waypoint in the Spot space
-
-        # Avoid evaluating a target ''between'' the same anchor
-        if anchor_candidates[0] == anchor_candidates[1]:
-            return False
-        if anchor_1["x"] == anchor_2["x"] and anchor_1["y"] == anchor_2["y"]:
-            return False
-
-        target = np.array([target["x"], target["y"]])
-        anchor_1 = np.array([anchor_1["x"], anchor_1["y"]])
-        anchor_2 = np.array([anchor_2["x"], anchor_2["y"]])
-
-        # Find two lines perpendicular to the vector defined by two anchors and passing through them
-        vec_a1_to_a2 = anchor_2 - anchor_1
-        slope = - vec_a1_to_a2[0] / vec_a1_to_a2[1]  # line slope is negative recipical of vector slope
-        # slope = np.tan([- vec_a1_to_a2[1], vec_a1_to_a2[0]])  # line slope is negative recipical of vector slope
-        offset_1 = - slope * anchor_1[0] + anchor_1[1]  # -m.x + y = c
-        offset_2 = - slope * anchor_2[0] + anchor_2[1]  # -m.x + y = d
-
-        # Check target between two lines: a.x_tar + b.y_tar between c and d
-        offset_tar = -slope * target[0] + target[1]
-
-        is_tar_between = (offset_tar >= offset_1 and offset_tar <= offset_2) or (offset_tar >= offset_2 and offset_tar <= offset_1)
-
-        # Check target within max distance to two achors
-        dist_anchor1_to_tar = np.linalg.norm(target - anchor_1)
-        dist_anchor2_to_tar = np.linalg.norm(target - anchor_2)
-
-        is_pred_true = is_tar_between and dist_anchor1_to_tar <= MAX_RANGE and dist_anchor2_to_tar <= MAX_RANGE
-
-        # if is_pred_true:
-            # print(f'    - VALID LANDMARKS:\ttarget:{target_candidate}\tanchor:{anchor_candidates}')
-
-        if plot:
+    is_pred_true = bool(eval_spatial_preds(landmarks, spatial_rel, [target_id], [anchor_ids])[0])
+
+    if plot and target_id >= 0 and len(anchor_ids) >= (2 if spatial_rel == "between" else 1) and min(anchor_ids) >= 0:
+        robot, target = landmarks.robot, landmarks.coords[target_id]
+        target_name, anchor_names = landmarks.names[target_id], [landmarks.names[anchor_id] for anchor_id in anchor_ids]
+
+        if spatial_rel in ["between"]:
+            anchor_1, anchor_2 = landmarks.coords[anchor_ids[0]], landmarks.coords[anchor_ids[1]]
             vec_a1_to_a2 = anchor_2 - anchor_1; vec_a1_to_a2 /= np.linalg.norm(vec_a1_to_a2)
             A, B = rotate(vec_a1_to_a2 * MAX_RANGE, np.deg2rad(-90)) + anchor_1, rotate(vec_a1_to_a2 * MAX_RANGE, np.deg2rad(90)) + anchor_1
             C, D = rotate(vec_a1_to_a2 * MAX_RANGE, np.deg2rad(-90)) + anchor_2, rotate(vec_a1_to_a2 * MAX_RANGE, np.deg2rad(90)) + anchor_2
 
             plt.figure(figsize=(10,6))
-            plt.title(f"Grounding SRE: {sre}\n(Target:{target_candidate}, Anchors:{anchor_candidates})")
+            plt.title(f"Grounding SRE: {sre}\n(Target:{target_name}, Anchors:{anchor_names})")
 
             plt.scatter(x=[target[0]], y=[target[1]], marker='o', color='green', label='target')
             plt.scatter(x=[anchor_1[0]], y=[anchor_1[1]], marker='o', color='orange', label='anchor_1')
@@ -493,52 +472,28 @@ def eval_spatial_pred(landmarks, spatial_rel, target_candidate, anchor_candidate
             plt.plot([D[0], anchor_2[0]], [D[1], anchor_2[1]], linestyle='dotted', c='b')
             plt.plot([anchor_1[0], anchor_2[0]], [anchor_1[1], anchor_2[1]], linestyle='dotted', c='black')
 
-            plt.text(x=target[0], y=target[1], s=target_candidate)
-            plt.text(x=anchor_1[0], y=anchor_1[1], s=anchor_candidates[0])
-            plt.text(x=anchor_2[0], y=anchor_2[1], s=anchor_candidates[1])
+            plt.text(x=target[0], y=target[1], s=target_name)
+            plt.text(x=anchor_1[0], y=anchor_1[1], s=anchor_names[0])
+            plt.text(x=anchor_2[0], y=anchor_2[1], s=anchor_names[1])
 
             plt.axis('square')
             plt.show(block=False)
-            plt.savefig(f"eval-spatial-pred-{spatial_rel}-{target_candidate}-{'-'.join(anchor_candidates)}.png")
-        return is_pred_true
-    else:
-        try:
-            anchor = landmarks[anchor_candidates[0]]
-        except KeyError:
-            return False  # anchor may instead be a waypoint in the Spot space
-
-        is_pred_true = False
-        range_vecs = compute_area(spatial_rel, robot, anchor, anchor_name=anchor_candidates[0], plot=False)
-        target = np.array([target["x"], target["y"]])
-        anchor = np.array([anchor["x"], anchor["y"]])
-
-        for range_vec in range_vecs:
-            vec_anc2tar = target - anchor
-            vec_mean = np.array([range_vec["mean"][0], range_vec["mean"][1]])
-            vec_min = np.array([range_vec["min"][0], range_vec["min"][1]])
-            vec_max = np.array([range_vec["max"][0], range_vec["max"][1]])
-
-            is_same_dir_mean = np.dot(vec_anc2tar, vec_mean) >= 0  # angle between target and mean vectors [-90, 90]
-            is_between_min_max = np.cross(vec_min, vec_anc2tar) >= 0 and np.cross(vec_max, vec_anc2tar) <= 0  # angle between target and min vectors [0, 180], between target and max vectors [-180, 0)
-            is_within_dist = np.linalg.norm(vec_anc2tar) <= MAX_RANGE
-
-            if is_same_dir_mean and is_between_min_max and is_within_dist:
-                is_pred_true = True
-                break
-
-        if plot:
+            plt.savefig(f"eval-spatial-pred-{spatial_rel}-{target_name}-{'-'.join(anchor_names)}.png")
+        else:
+            anchor = landmarks.coords[anchor_ids[0]]
+            range_vecs = compute_area(spatial_rel, robot, anchor, anchor_name=anchor_names[0], plot=False)
             # Plot the computed vector range
             plt.figure(figsize=(10,6))
-            plt.title(f"Grounding SRE: {sre}\n(Target:{target_candidate}, Anchor:{anchor_candidates})")
+            plt.title(f"Grounding SRE: {sre}\n(Target:{target_name}, Anchor:{anchor_names})")
 
-            plt.scatter(x=[robot["x"]], y=[robot["y"]], marker="o", color="yellow", label="robot")
+            plt.scatter(x=[robot[0]], y=[robot[1]], marker="o", color="yellow", label="robot")
             plt.scatter(x=[anchor[0]], y=[anchor[1]], marker="o", color="orange", label="anchor")
             plt.scatter(x=[target[0]], y=[target[1]], marker="o", color="green", label="target")
 
-            plt.plot([robot["x"], anchor[0]], [robot["y"], anchor[1]], linestyle="dotted", c="k", label="normal")
+            plt.plot([robot[0], anchor[0]], [robot[1], anchor[1]], linestyle="dotted", c="k", label="normal")
 
-            plt.text(anchor[0], anchor[1], s=anchor_candidates[0])
-            plt.text(target[0], target[1], s=target_candidate)
+            plt.text(anchor[0], anchor[1], s=anchor_names[0])
+            plt.text(target[0], target[1], s=target_name)
 
             for vec_idx, range_vec in enumerate(range_vecs):
                 mean_pose = np.array([(range_vec["mean"][0] * MAX_RANGE) + anchor[0],
@@ -565,11 +520,187 @@ def eval_spatial_pred(landmarks, spatial_rel, target_candidate, anchor_candidate
             plt.legend()
             plt.axis("square")
             plt.show(block=False)
-            plt.savefig(f"eval-spatial-pred-{spatial_rel}-{target_candidate}-{'-'.join(anchor_candidates)}.png")
-        return is_pred_true
+            plt.savefig(f"eval-spatial-pred-{spatial_rel}-{target_name}-{'-'.join(anchor_names)}.png")
+    return is_pred_true
+
+
+def rotate_vecs(vecs, angles):
+    """
+    Rotate each row of vecs by its angle in radians.
+    Stacked matmul rounds like np.dot in rotate, so boundary cases match compute_area.
+    """
+    angles = np.broadcast_to(angles, len(vecs))
+    mats_rot = np.stack([np.stack([np.cos(angles), -np.sin(angles)], axis=-1), np.stack([np.sin(angles), np.cos(angles)], axis=-1)], axis=1)
+    return (mats_rot @ vecs[:, :, None])[:, :, 0]
+
+
+def row_dots(vecs_1, vecs_2):
+    return (vecs_1[:, None, :] @ vecs_2[:, :, None])[:, 0, 0]
+
+
+def row_norms(vecs):
+    return np.sqrt(row_dots(vecs, vecs))
+
+
+def eval_spatial_preds(landmarks, spatial_rel, target_ids, anchor_ids):
+    """
+    Evaluate a spatial relation for a batch of candidates at once.
+    :param landmarks: LandmarkTable
+    :param target_ids: (ncandidates,) landmark id of target of each candidate, -1 if not a landmark
+    :param anchor_ids: (ncandidates, nanchors) landmark ids of anchors of each candidate, -1 if not a landmark
+    :return: (ncandidates,) bool array, whether spatial relation is valid for each candidate
+    """
+    coords, robot = landmarks.coords, landmarks.robot
+    target_ids = np.asarray(target_ids, dtype=np.int64)
+    if not len(target_ids):
+        return np.zeros(0, dtype=bool)
+    anchor_ids = np.asarray(anchor_ids, dtype=np.int64).reshape(len(target_ids), -1)
+    nanchors = 2 if spatial_rel == "between" else 1
+    if anchor_ids.shape[1] < nanchors:
+        return np.zeros(len(target_ids), dtype=bool)
+
+    # Target and anchors must be distinct landmarks at distinct locations
+    is_valid = (target_ids >= 0) & (anchor_ids >= 0).all(axis=1) & (anchor_ids != target_ids[:, None]).all(axis=1)
+    targets, anchors = coords[target_ids], coords[anchor_ids]  # rows of invalid candidates are ignored
+    is_valid &= ~(anchors == targets[:, None]).all(axis=2).any(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):  # degenerate geometry, e.g., nan, fails comparisons
+        if spatial_rel == "between":
+            anchors_1, anchors_2 = anchors[:, 0], anchors[:, 1]
+            is_valid &= (anchor_ids[:, 0] != anchor_ids[:, 1]) & ~(anchors_1 == anchors_2).all(axis=1)
+
+            # Target between two lines perpendicular to vector from anchor 1 to anchor 2 and passing through them
+            vecs_a1_to_a2 = anchors_2 - anchors_1
+            slopes = - vecs_a1_to_a2[:, 0] / vecs_a1_to_a2[:, 1]
+            offsets_1 = - slopes * anchors_1[:, 0] + anchors_1[:, 1]
+            offsets_2 = - slopes * anchors_2[:, 0] + anchors_2[:, 1]
+            offsets_tar = - slopes * targets[:, 0] + targets[:, 1]
+            is_valid &= ((offsets_tar >= offsets_1) & (offsets_tar <= offsets_2)) | ((offsets_tar >= offsets_2) & (offsets_tar <= offsets_1))
+            is_valid &= (row_norms(targets - anchors_1) <= MAX_RANGE) & (row_norms(targets - anchors_2) <= MAX_RANGE)
+        else:
+            anchors = anchors[:, 0]
+            vecs_a2r = robot - anchors
+            unit_vecs_a2r = vecs_a2r / row_norms(vecs_a2r)[:, None]
+            direction = spatial_rel.removesuffix(" of")
+            fov = 90 if direction in ["northeast", "northwest", "southeast", "southwest"] else 180  # robot's field-of-view
+            rots_a2r = [0]
+            if spatial_rel in RELATIVE_ANGLES:
+                mean_angles = RELATIVE_ANGLES[spatial_rel]
+            elif direction in CARDINAL_DIRECTIONS:
+                mean_angles = np.rad2deg(np.arctan2(*CARDINAL_DIRECTIONS[direction]) - np.arctan2(unit_vecs_a2r[:, 1], unit_vecs_a2r[:, 0]))
+            elif spatial_rel in NEAR_RELATIONS:
+                mean_angles = 0
+                rots_a2r = list(range(0, 360, fov))
+            else:
+                raise ValueError(f"ERROR: spatial relation {spatial_rel} not recognized")
+
+            # Vector from anchor to target within range of any of anchor's possible fronts
+            vecs_anc2tar = targets - anchors
+            is_in_range = np.zeros(len(target_ids), dtype=bool)
+            for rot in rots_a2r:
+                vecs_mean = rotate_vecs(unit_vecs_a2r, np.deg2rad(mean_angles + rot))
+                vecs_min = rotate_vecs(vecs_mean, np.deg2rad(- fov / 2))
+                vecs_max = rotate_vecs(vecs_mean, np.deg2rad(fov / 2))
+                is_same_dir_mean = row_dots(vecs_anc2tar, vecs_mean) >= 0
+                is_between_min_max = (vecs_min[:, 0] * vecs_anc2tar[:, 1] - vecs_min[:, 1] * vecs_anc2tar[:, 0] >= 0) \
+                                     & (vecs_max[:, 0] * vecs_anc2tar[:, 1] - vecs_max[:, 1] * vecs_anc2tar[:, 0] <= 0)
+                is_in_range |= is_same_dir_mean & is_between_min_max
+            is_valid &= is_in_range & (row_norms(vecs_anc2tar) <= MAX_RANGE)
+    return is_valid
+
+
+def prune_out_of_range(landmarks, spatial_rel, lmk_grounds):
+    """
+    Drop candidate target and anchor landmarks that cannot be in any valid combination: not a landmark,
+    target not within MAX_RANGE of any candidate of each evaluated anchor, or anchor with no candidate target within MAX_RANGE.
+    Remaining combinations keep their order from sort_combs.
+    :param lmk_grounds: (score, landmark name) candidates of target then each anchor
+    """
+    lmk_ids = [landmarks.ids([lmk for _, lmk in score_lmks]) for score_lmks in lmk_grounds]
+    keeps = [ids >= 0 for ids in lmk_ids]
+
+    nanchors = 2 if spatial_rel == "between" else 1  # anchors whose range eval_spatial_preds checks
+    if len(lmk_grounds) > nanchors:
+        relations = get_relation_table(landmarks)
+        for anchor_ids in lmk_ids[1: nanchors + 1]:
+            keeps[0] &= relations.in_range(lmk_ids[0], anchor_ids)
+        for idx in range(1, nanchors + 1):
+            keeps[idx] &= relations.in_range(lmk_ids[idx], lmk_ids[0][keeps[0]])  # range is symmetric
+
+    return [[score_lmk for score_lmk, keep in zip(score_lmks, keeps_list) if keep] for score_lmks, keeps_list in zip(lmk_grounds, keeps)]
+
+
+class RelationTable:
+    """
+    Validity of spatial relations for all (target, anchor) landmark pairs of a map within MAX_RANGE at a robot pose.
+    Pairs come from the KD-tree once. Validity of a relation is computed for all pairs by eval_spatial_preds
+    the first time it is grounded, then evaluating candidates is a lookup of their pairs.
+    """
+    def __init__(self, landmarks):
+        self.landmarks = landmarks
+        pairs = landmarks.tree.query_pairs(MAX_RANGE * (1 + RANGE_PRUNE_SLACK), output_type="ndarray").astype(np.int64)
+        pairs = np.concatenate([pairs, pairs[:, ::-1]])  # (anchor, target) both ways
+        pair_keys = pairs[:, 0] * len(landmarks) + pairs[:, 1]
+        order = np.argsort(pair_keys)
+        self.pairs, self.pair_keys = pairs[order], pair_keys[order]
+        self.rel2valids = {}
+
+    def pair_idxs(self, anchor_ids, target_ids):
+        """
+        Rows of (anchor, target) pairs in table, -1 if not a pair within range.
+        """
+        anchor_ids, target_ids = np.asarray(anchor_ids, dtype=np.int64), np.asarray(target_ids, dtype=np.int64)
+        keys = np.where((anchor_ids >= 0) & (target_ids >= 0), anchor_ids * len(self.landmarks) + target_ids, -1)
+        if not len(self.pair_keys):
+            return np.full(keys.shape, -1)
+        idxs = np.minimum(np.searchsorted(self.pair_keys, keys), len(self.pair_keys) - 1)
+        return np.where((keys >= 0) & (self.pair_keys[idxs] == keys), idxs, -1)
+
+    def in_range(self, target_ids, anchor_ids):
+        """
+        Whether each target is within range of any of the anchors.
+        """
+        target_ids, anchor_ids = np.asarray(target_ids, dtype=np.int64), np.asarray(anchor_ids, dtype=np.int64)
+        return (self.pair_idxs(anchor_ids[None, :], target_ids[:, None]) >= 0).any(axis=1)
+
+    def valids(self, spatial_rel):
+        if spatial_rel not in self.rel2valids:
+            self.rel2valids[spatial_rel] = eval_spatial_preds(self.landmarks, spatial_rel, self.pairs[:, 1], self.pairs[:, :1])
+        return self.rel2valids[spatial_rel]
+
+    def eval(self, spatial_rel, target_ids, anchor_ids):
+        """
+        Same as eval_spatial_preds. Between is only evaluated for candidates whose target is in range of both anchors.
+        """
+        target_ids = np.asarray(target_ids, dtype=np.int64)
+        if not len(target_ids):
+            return np.zeros(0, dtype=bool)
+        anchor_ids = np.asarray(anchor_ids, dtype=np.int64).reshape(len(target_ids), -1)
+        if spatial_rel == "between" and anchor_ids.shape[1] == 2:
+            is_valid = (self.pair_idxs(anchor_ids[:, 0], target_ids) >= 0) & (self.pair_idxs(anchor_ids[:, 1], target_ids) >= 0)
+            idxs = np.flatnonzero(is_valid)
+            is_valid[idxs] = eval_spatial_preds(self.landmarks, spatial_rel, target_ids[idxs], anchor_ids[idxs])
+            return is_valid
+        if spatial_rel != "between" and anchor_ids.shape[1] == 1:
+            pair_idxs = self.pair_idxs(anchor_ids[:, 0], target_ids)
+            is_valid = pair_idxs >= 0
+            is_valid[is_valid] = self.valids(spatial_rel)[pair_idxs[is_valid]]  # only pairs in table, which may be empty
+            return is_valid
+        return eval_spatial_preds(self.landmarks, spatial_rel, target_ids, anchor_ids)  # anchors not used by relation only checked for distinctness
+
+
+def get_relation_table(landmarks):
+    """
+    Relation table of a map at its current robot pose and MAX_RANGE, built once and kept with the landmarks for later utterances.
+    Pairs and validities depend on MAX_RANGE, which spg may change, so it is part of the key.
+    """
+    key = (*landmarks.robot.tolist(), MAX_RANGE)
+    if key not in landmarks.relation_tables:
+        landmarks.relation_tables[key] = RelationTable(landmarks)
+    return landmarks.relation_tables[key]
 
 
-def spg(landmarks, reg_out, topk, rel_embeds_fpath, max_range=None):
+def spg(landmarks, reg_out, topk, max_range=None, embed_backend="openai"):
     # print(f"***** SPG Command: {reg_out['utt']}")
 
     if max_range:
@@ -584,37 +715,42 @@ def spg(landmarks, reg_out, topk, rel_embeds_fpath, max_range=None):
 
         rel_query, lmk_grounds = list(grounded_spatial_preds.items())[0]
 
-        # Rank all combinations of target and anchor landmarks
+        # Rank combinations of target and anchor landmarks lazily, best first
         lmk_grounds_sorted = sort_combs(lmk_grounds)
 
         if rel_query == "None":
             # Referring expression without spatial relation
-            groundings = [{"target": lmk_ground["target"][0]} for lmk_ground in lmk_grounds_sorted[:topk]]
+            groundings = [{"target": lmk_ground["target"][0]} for lmk_ground in islice(lmk_grounds_sorted, topk)]
         else:
             groundings = []
 
             rel_match = rel_query
             if rel_query not in KNOWN_RELATIONS:
                 # Find best match for unseen spatial relation in set of known spatial relations
-                rel_match = find_match_rel(rel_query, rel_embeds_fpath)
+                rel_match = find_match_rel(rel_query, embed_backend)
                 # print(f"UNSEEN SPATIAL RELATION:\t'{rel_query}' matched to '{rel_match}'")
 
             if len(lmk_grounds) == 1:
                 # Spatial referring expression contains only a anchor landmark
-                for lmk_ground in lmk_grounds_sorted[:topk]:
-                    groundings.append(get_target_loc(landmarks, rel_match, lmk_ground["target"][0], sre))
+                for lmk_ground in islice(lmk_grounds_sorted, topk):
+                    groundings.append(get_target_loc(landmarks, rel_match, landmarks.name2id.get(lmk_ground["target"][0], -1), sre))
             else:
                 # Spatial referring expression contains a target landmark and one or two anchor landmarks
                 # one anchor, e.g., <tar> left of <anc>
                 # two anchors, e.g., <tar> between <anc1> and <anc2>
-                for lmk_ground in lmk_grounds_sorted:
-                    target_name = lmk_ground["target"][0]
-                    anchor_names = lmk_ground["anchor"]
-                    is_valid = eval_spatial_pred(landmarks, rel_match, target_name, anchor_names, sre)
-                    if is_valid:
-                        groundings.append({"target": target_name,  "anchor": anchor_names})
-                    if len(groundings) == topk:
+                # Evaluate best combinations within range in batches of growing size until topk are valid
+                lmk_grounds_sorted = sort_combs(prune_out_of_range(landmarks, rel_match, lmk_grounds))
+                batch_size = EVAL_BATCH_SIZE
+                while len(groundings) < topk:
+                    combs = list(islice(lmk_grounds_sorted, batch_size))
+                    if not combs:
                         break
+                    target_ids = landmarks.ids([comb["target"][0] for comb in combs])
+                    anchor_ids = landmarks.ids([anchor_name for comb in combs for anchor_name in comb["anchor"]]).reshape(len(combs), -1)
+                    is_valids = get_relation_table(landmarks).eval(rel_match, target_ids, anchor_ids)
+                    groundings_valid = [{"target": comb["target"][0], "anchor": comb["anchor"]} for comb, is_valid in zip(combs, is_valids) if is_valid]
+                    groundings += groundings_valid[:topk - len(groundings)]
+                    batch_size *= 2
 
         spg_out[sre] = groundings
 
@@ -623,12 +759,12 @@ def spg(landmarks, reg_out, topk, rel_embeds_fpath, max_range=None):
     return spg_out
 
 
-def run_exp_spg(reg_out_fpath, graph_dpath, osm_fpath, topk, rel_embeds_fpath, spg_out_fpath):
+def run_exp_spg(reg_out_fpath, graph_dpath, osm_fpath, topk, spg_out_fpath, embed_backend="openai"):
     if not os.path.isfile(spg_out_fpath):
         reg_outs = load_from_file(reg_out_fpath)
         landmarks = load_lmks(graph_dpath, osm_fpath)
         for reg_out in tqdm(reg_outs, desc="Running spatial predicate grounding (SPG) module"):
-            reg_out["grounded_sps"] = spg(landmarks, reg_out, topk, rel_embeds_fpath)
+            reg_out["grounded_sps"] = spg(landmarks, reg_out, topk, embed_backend=embed_backend)
         save_to_file(reg_outs, spg_out_fpath)
 
 
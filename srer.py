@@ -1,8 +1,9 @@
 import os
-from tqdm import tqdm
+import asyncio
+from tqdm.asyncio import tqdm_asyncio
 import logging
 
-from openai_models import extract
+from openai_models import extract, aextract
 from utils import load_from_file, save_to_file
 
 
@@ -75,13 +76,18 @@ def srer(utt):
     return raw_out, parsed_out
 
 
+async def asrer(utt):
+    raw_out = await aextract(utt)
+    parsed_out = {"utt": utt}
+    parsed_out.update(parse_llm_output(utt, raw_out))
+    return raw_out, parsed_out
+
+
 def run_exp_srer(utts_fpath, srer_out_fpath):
 	if not os.path.isfile(srer_out_fpath):
-		srer_outs = []
 		utts = load_from_file(utts_fpath)
-		for utt in tqdm(utts, desc="Running spatial referring expression recognition (SRER) module"):
-			_, srer_out = srer(utt)
-			srer_outs.append(srer_out)
+		outs = asyncio.run(tqdm_asyncio.gather(*[asrer(utt) for utt in utts], desc="Running spatial referring expression recognition (SRER) module"))
+		srer_outs = [srer_out for _, srer_out in outs]
 		save_to_file(srer_outs, srer_out_fpath)
 
 
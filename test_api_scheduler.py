@@ -0,0 +1,45 @@
+from api_scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, APIScheduler, TokenBucket
+
+
+def test_rate_limited_model_does_not_block_other_models():
+    scheduler = APIScheduler(tpm=1000)
+    scheduler.get_buckets("gpt-4o")["tokens"].consume(1000)  # empty tokens bucket
+    ticket_limited = scheduler.enqueue(PRIORITY_BULK, "gpt-4o", 500)
+    ticket_other = scheduler.enqueue(PRIORITY_BULK, "text-embedding-3-large", 500)
+    assert scheduler.try_admit(ticket_limited) > 0
+    assert scheduler.try_admit(ticket_other) == 0
+
+
+def test_slots_go_by_priority_then_arrival_across_models():
+    scheduler = APIScheduler(max_concurrency=1)
+    ticket_bulk = scheduler.enqueue(PRIORITY_BULK, "gpt-4", 10)
+    ticket_first = scheduler.enqueue(PRIORITY_BULK, "gpt-4o", 10)
+    ticket_interactive = scheduler.enqueue(PRIORITY_INTERACTIVE, "gpt-4o", 10)
+    assert scheduler.try_admit(ticket_bulk) > 0  # interactive request of another model is ready
+    assert scheduler.try_admit(ticket_first) > 0  # not next in line for its model
+    assert scheduler.try_admit(ticket_interactive) == 0
+    assert scheduler.try_admit(ticket_bulk) > 0  # only in-flight slot taken
+    scheduler.release()
+    assert scheduler.try_admit(ticket_first) > 0  # arrived after bulk request of gpt-4
+    assert scheduler.try_admit(ticket_bulk) == 0
+
+
+def test_aimd_concurrency():
+    scheduler = APIScheduler(max_concurrency=8, min_concurrency=1)
+    scheduler.inflight = 1
+    scheduler.release(throttled=True)
+    assert scheduler.concurrency == 4
+    scheduler.inflight = 1
+    scheduler.release()
+    assert scheduler.concurrency == 4.25
+    for _ in range(10):
+        scheduler.inflight = 1
+        scheduler.release(throttled=True)
+    assert scheduler.concurrency == 1
+
+
+def test_token_bucket_request_larger_than_capacity_waits_for_full_bucket():
+    bucket = TokenBucket(100)
+    assert bucket.wait_time(500) == 0
+    bucket.consume(100)
+    assert 59 < bucket.wait_time(500) <= 60
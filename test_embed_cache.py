@@ -0,0 +1,55 @@
+import sqlite3
+import numpy as np
+
+import embed_cache
+from embed_cache import EmbedCache
+
+
+def test_evict_least_recently_used_beyond_max_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(embed_cache, "EVICT_EVERY", 1)
+    cache = EmbedCache(str(tmp_path / "cache.sqlite"), max_entries=10)
+    for idx in range(30):
+        cache.put_many("m", 4, [f"t{idx}"], [[1, 2, 3, idx]])
+        cache.get_many("m", 4, ["t0"])  # keep t0 recently used
+        cache.flush()
+    assert cache.get_many("m", 4, ["t0", "t1", "t29"]) == [[1, 2, 3, 0], None, [1, 2, 3, 29]]
+    assert cache.stats()["entries"] <= 10
+
+
+def test_evict_beyond_max_size(tmp_path):
+    cache = EmbedCache(str(tmp_path / "cache.sqlite"), max_bytes=10 * 2 * 64)
+    cache.put_many("m", 64, [f"t{idx}" for idx in range(20)], np.ones((20, 64)))
+    cache.evict()
+    assert cache.stats()["entries"] == 9
+    assert len(cache.conn.execute("SELECT embed FROM embeds LIMIT 1").fetchone()[0]) == 2 * 64  # float16
+
+
+def test_access_times_written_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(embed_cache, "TOUCH_EVERY", 3)
+    cache = EmbedCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many("m", 2, ["a", "b", "c"], [[1, 0]] * 3)
+    used = dict(cache.conn.execute("SELECT key, used FROM embeds").fetchall())
+    cache.get_many("m", 2, ["a", "b"])
+    assert dict(cache.conn.execute("SELECT key, used FROM embeds").fetchall()) == used
+    cache.get_many("m", 2, ["c"])
+    assert all(used_new > used[key] for key, used_new in cache.conn.execute("SELECT key, used FROM embeds"))
+    assert not cache.touched
+
+
+def test_invalidate_model(tmp_path):
+    cache = EmbedCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many("m1", 2, ["a", "b"], [[1, 0]] * 2)
+    cache.put_many("m2", 2, ["a"], [[0, 1]])
+    assert cache.invalidate("m1") == 2
+    assert cache.get_many("m1", 2, ["a"]) == [None] and cache.get_many("m2", 2, ["a"]) == [[0, 1]]
+    assert cache.invalidate() == 1
+
+
+def test_open_cache_created_before_eviction(tmp_path):
+    db_fpath = str(tmp_path / "cache.sqlite")
+    conn = sqlite3.connect(db_fpath)
+    conn.execute("CREATE TABLE embeds (key TEXT PRIMARY KEY, model TEXT, dim INTEGER, embed BLOB)")
+    conn.execute("INSERT INTO embeds VALUES (?, ?, ?, ?)", (EmbedCache.make_key("m", 3, "a"), "m", 3, np.array([1.5, 2, 3], dtype=np.float32).tobytes()))
+    conn.commit()
+    conn.close()
+    assert EmbedCache(db_fpath).get_many("m", 3, ["a"]) == [[1.5, 2, 3]]
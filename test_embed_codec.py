@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from embed_codec import EmbedCodec, get_codec
+from embed_store import l2_normalize
+
+
+def make_embeds(nembeds, dim=256, seed=0):
+    return l2_normalize(np.random.default_rng(seed).standard_normal((nembeds, dim)))
+
+
+@pytest.mark.parametrize("dtype, atol", [("float32", 1e-6), ("float16", 1e-3), ("int8", 2e-2)])
+def test_encode_score_matches_cosine(dtype, atol):
+    embeds, queries = make_embeds(100), make_embeds(5, seed=1)
+    codec = EmbedCodec(dtype=dtype)
+    codes, scales = codec.encode(embeds)
+    assert codes.dtype == np.dtype(dtype) and (scales is None) == (dtype != "int8")
+    assert np.allclose(codec.score(queries, codes, scales), queries @ embeds.T, atol=atol)
+
+
+def test_int8_zero_rows_stay_zero_codes():
+    embeds = make_embeds(3)
+    embeds[1] = 0
+    codec = EmbedCodec(dtype="int8")
+    codes, scales = codec.encode(embeds)
+    assert not codes[1].any()
+    assert np.all(np.isfinite(scales)) and np.all(codec.score(make_embeds(2, seed=1), codes, scales)[:, 1] == 0)
+
+
+def test_truncate_scores_normalized_prefixes():
+    embeds, queries = make_embeds(50), make_embeds(4, seed=1)
+    codec = EmbedCodec(64, "truncate", "float16")
+    codes, scales = codec.encode(embeds)
+    assert codes.shape == (50, 64)
+    assert np.allclose(codec.score(queries, codes, scales), l2_normalize(queries[:, :64]) @ l2_normalize(embeds[:, :64]).T, atol=1e-3)
+
+
+def test_pca_keeps_nearest_neighbors_of_low_rank_embeddings():
+    rng = np.random.default_rng(0)
+    basis = rng.standard_normal((16, 256))
+    embeds = l2_normalize(rng.standard_normal((500, 16)) @ basis)  # all variance in 16 directions
+    codec = EmbedCodec(16, "pca", "int8").fit(embeds)
+    codes, scales = codec.encode(embeds)
+    assert codes.shape == (500, 16)
+    queries = embeds[:20]
+    assert np.array_equal(codec.score(queries, codes, scales).argmax(axis=1), np.arange(20))
+
+
+def test_get_codec():
+    assert get_codec() is None
+    assert get_codec(256, "pca", "int8").name == "pca256_int8"
+    with pytest.raises(ValueError):
+        EmbedCodec(dtype="int4")
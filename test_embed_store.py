@@ -0,0 +1,85 @@
+import numpy as np
+
+from embed_store import EmbedStore, append_rows, content_hash, l2_normalize
+
+
+def make_embed(content, dim=8):
+    return l2_normalize(np.random.default_rng(int(content_hash(content)[:8], 16)).standard_normal(dim))
+
+
+def sync(store, modality, lmk2content, compact=False):
+    lmk_ids, contents = list(lmk2content), list(lmk2content.values())
+    return store.sync(modality, lmk_ids, contents, lambda idxs: np.array([make_embed(contents[idx]) for idx in idxs]), compact)
+
+
+def live_embeds(store, modality):
+    return {store.ids[row]: np.asarray(store.embeds[row]) for row in store.modality_rows(modality)}
+
+
+def assert_store_matches(store, modality, lmk2content):
+    lmk2embed = live_embeds(store, modality)
+    assert set(lmk2embed) == set(lmk2content)
+    for lmk_id, content in lmk2content.items():
+        assert np.allclose(lmk2embed[lmk_id], make_embed(content))
+
+
+def test_append_rows(tmp_path):
+    npy_fpath = str(tmp_path / "embeds.npy")
+    np.save(npy_fpath, np.ones((2, 3), dtype=np.float32))
+    assert append_rows(npy_fpath, np.full((2, 3), 2, dtype=np.float32))
+    assert np.array_equal(np.load(npy_fpath), np.array([[1] * 3] * 2 + [[2] * 3] * 2, dtype=np.float32))
+
+
+def test_sync_patch_and_compact(tmp_path):
+    store = EmbedStore(str(tmp_path))
+    lmk2content = {f"l{idx}": f"c{idx}" for idx in range(10)}
+    assert sync(store, "text", lmk2content) == {"added": 10, "changed": 0, "deleted": 0}
+    assert sync(store, "image", {"w0": "img0"}) == {"added": 1, "changed": 0, "deleted": 0}
+    assert sync(store, "text", lmk2content) == {"added": 0, "changed": 0, "deleted": 0}
+
+    lmk2content["l1"] = "c1 new"
+    lmk2content["l10"] = "c10"
+    del lmk2content["l2"]
+    assert sync(store, "text", lmk2content) == {"added": 1, "changed": 1, "deleted": 1}
+    assert store.ndeleted == 2  # tombstones of changed and deleted rows
+    assert_store_matches(store, "text", lmk2content)
+    assert_store_matches(store, "image", {"w0": "img0"})
+    ids, modalities, embeds = store.view(["text"])
+    assert ids.count(None) == 0 and len(ids) == len(lmk2content) and len(embeds) == len(ids)
+
+    fingerprint = store.fingerprint(["text"])
+    assert sync(store, "text", lmk2content, compact=True) == {"added": 0, "changed": 0, "deleted": 0}
+    assert store.ndeleted == 0 and len(store.ids) == len(lmk2content) + 1
+    assert store.fingerprint(["text"]) != fingerprint  # rows moved
+    assert_store_matches(store, "text", lmk2content)
+    assert_store_matches(store, "image", {"w0": "img0"})
+    assert store.view(["text"])[2].base is not None  # contiguous again, zero-copy slice
+
+
+def test_patch_copy_on_write(tmp_path):
+    store = EmbedStore(str(tmp_path))
+    lmk2content = {f"l{idx}": f"c{idx}" for idx in range(10)}
+    sync(store, "text", lmk2content)
+    worker = EmbedStore(str(tmp_path))
+    worker_ids, _, worker_embeds = worker.view(["text"])
+    worker_embeds_before = np.array(worker_embeds)
+
+    lmk2content["l3"] = "c3 new"
+    del lmk2content["l4"]
+    sync(store, "text", lmk2content)
+    assert store.ndeleted == 2
+    assert np.array_equal(worker_embeds, worker_embeds_before)  # rows mapped by worker are not modified
+
+    worker = EmbedStore(str(tmp_path))  # reload picks up the update
+    assert_store_matches(worker, "text", lmk2content)
+
+
+def test_compact_when_tombstones_exceed_ratio(tmp_path):
+    store = EmbedStore(str(tmp_path))
+    lmk2content = {f"l{idx}": f"c{idx}" for idx in range(8)}
+    sync(store, "text", lmk2content)
+    for idx in range(3):
+        lmk2content[f"l{idx}"] += " new"
+    sync(store, "text", lmk2content)
+    assert store.ndeleted == 0 and len(store.ids) == 8
+    assert_store_matches(store, "text", lmk2content)
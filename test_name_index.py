@@ -0,0 +1,58 @@
+import numpy as np
+
+from name_index import NameIndex, normalize_name
+from reg import REG, NAME_MATCH_MARGIN
+
+
+def make_reg(lmk_ids, embeds, query_embeds):
+    """
+    REG over given unit-norm landmark embeddings, without a store or embedding requests.
+    """
+    class Embedder:
+        def embed(self, queries):
+            return [query_embeds[query] for query in queries]
+
+    reg = REG.__new__(REG)
+    reg.sem_ids, reg.sem_modalities, reg.sem_embeds = list(lmk_ids), ["text"] * len(lmk_ids), np.asarray(embeds, dtype=np.float32)
+    reg.ndeleted, reg.codec, reg.ann, reg.nscored, reg.score_secs = 0, None, None, 0, 0.0
+    reg.embedder = Embedder()
+    reg.name_index = NameIndex({lmk_id: [lmk_id] for lmk_id in lmk_ids})
+    reg.id2row = {lmk_id: row for row, lmk_id in enumerate(lmk_ids)}
+    reg.nname_exact, reg.nname_fuzzy = 0, 0
+    return reg
+
+
+def test_normalize_name():
+    assert normalize_name("The Moon-Star.") == "moon star"
+    assert normalize_name("Joe's Café") == "joes cafe"
+
+
+def test_match_thresholds():
+    name_index = NameIndex({"a": ["Shop A"], "b": ["Shop B"], "m": ["Moonstar Cafe"]})
+    assert name_index.match("the shop a") == ("a", 1.0)
+    assert name_index.match("moon star cafe") == ("m", 1.0)  # trigrams ignore spaces
+    assert name_index.match("moonstar cafes") == ("m", 0.8)
+    assert name_index.match("shop") is None  # below FUZZY_MIN_SIM
+    assert name_index.match("star cafe") is None
+    assert NameIndex({"c": ["Cafe Moon"], "d": ["Cafe Moons"]}).match("cafe moonz") is None  # within FUZZY_MIN_MARGIN of another landmark
+
+
+def test_shared_alias_is_ambiguous():
+    assert NameIndex({"a": ["Moon"], "b": ["Moon"]}).match("moon") is None
+
+
+def test_exact_match_first_with_embedding_candidates():
+    embeds = np.eye(4)
+    reg = make_reg(["Shop A", "Shop B", "Cafe", "Bank"], embeds, {"the shop A": [0.0, 0.6, 0.8, 0.0]})
+    groundings = reg.query_batch(["the shop A"], 3)["the shop A"]
+    assert [grounding.lmk_id for grounding in groundings] == ["Shop A", "Cafe", "Shop B"]
+    assert np.isclose(groundings[0].score, 0.8 + NAME_MATCH_MARGIN)  # cosine scale, just above best embedding score
+    assert reg.nname_exact == 1
+
+
+def test_fuzzy_match_boosted_not_forced():
+    embeds = np.eye(3)
+    reg = make_reg(["Cafe Moon", "Bank", "Park"], embeds, {"cafe moonz": [0.1, 0.0, 0.99]})
+    lmk_ids = [grounding.lmk_id for grounding in reg.query_batch(["cafe moonz"], 2)["cafe moonz"]]
+    assert lmk_ids == ["Park", "Cafe Moon"]  # boost does not outweigh a much closer embedding
+    assert reg.nname_fuzzy == 1
@@ -0,0 +1,33 @@
+import response_cache
+from response_cache import ResponseCache
+
+
+def test_evict_least_recently_used_beyond_max_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, "EVICT_EVERY", 1)
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=10 * len('"r00"'))
+    for idx in range(30):
+        cache.put(f"k{idx}", f"r{idx:02d}")
+        cache.get("k0")  # keep k0 recently used
+        cache.flush()
+    assert cache.get_many(["k0", "k1", "k29"]) == ["r00", None, "r29"]
+    assert cache.stats()["entries"] <= 10
+
+
+def test_access_times_written_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, "TOUCH_EVERY", 2)
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=2**20)
+    cache.put_many([("a", 1), ("b", 2)])
+    accessed = dict(cache.conn.execute("SELECT key, accessed FROM responses").fetchall())
+    cache.get("a")
+    assert dict(cache.conn.execute("SELECT key, accessed FROM responses").fetchall()) == accessed
+    cache.get("b")
+    assert all(accessed_new > accessed[key] for key, accessed_new in cache.conn.execute("SELECT key, accessed FROM responses"))
+
+
+def test_delete_and_invalidate(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=2**20)
+    cache.put_many([("a", {"x": 1}), ("b", [2]), ("c", "3")])
+    cache.delete("a")
+    assert cache.get_many(["a", "b"]) == [None, [2]]
+    assert cache.invalidate() == 2
+    assert cache.stats()["entries"] == 0
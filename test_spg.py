@@ -0,0 +1,58 @@
+from itertools import product
+import numpy as np
+
+from landmark_table import LandmarkTable
+from spg import MAX_RANGE, RelationTable, eval_spatial_preds, make_comb, sort_combs
+
+
+RELATIONS = ["left", "right", "in front of", "behind", "north", "southeast", "near", "next to", "between"]
+
+
+def random_landmarks(seed, nlmks=12, extent=2 * MAX_RANGE):
+    rng = np.random.default_rng(seed)
+    coords = rng.uniform(-extent, extent, (nlmks + 1, 2))
+    return LandmarkTable.from_dict({name: {"x": x, "y": y} for name, (x, y) in zip(["robot"] + [f"l{idx}" for idx in range(nlmks)], coords)})
+
+
+def sort_combs_full(lmk_grounds):
+    """
+    Enumeration before lazy best-first search: score every combination then stable sort.
+    """
+    return sorted((make_comb(comb) for comb in product(*lmk_grounds)), key=lambda comb: comb["score"], reverse=True)
+
+
+def test_sort_combs_matches_full_enumeration():
+    rng = np.random.default_rng(0)
+    for nlists in range(1, 4):
+        for trial in range(30):
+            scores = rng.choice([0.0, 0.25, 0.5, 0.75, 1.0], (nlists, rng.integers(1, 6)))  # many ties
+            if trial % 3 == 0:
+                scores = rng.uniform(0, 1, scores.shape)
+            elif trial % 5 == 0:
+                scores = rng.uniform(-1, 1, scores.shape)  # not monotone, full sort
+            lmk_grounds = [sorted([(score, f"l{list_idx}_{idx}") for idx, score in enumerate(list_scores)], reverse=True)
+                           for list_idx, list_scores in enumerate(scores)]
+            assert list(sort_combs(lmk_grounds)) == sort_combs_full(lmk_grounds), (nlists, trial)
+    assert list(sort_combs([[(0.9, "a")], []])) == []
+
+
+def test_relation_table_matches_eval_spatial_preds():
+    for seed in range(20):
+        landmarks = random_landmarks(seed)
+        relation_table = RelationTable(landmarks)
+        ids = np.arange(len(landmarks))
+        for spatial_rel in RELATIONS:
+            nanchors = 2 if spatial_rel == "between" else 1
+            combs = np.array(np.meshgrid(*[ids] * (1 + nanchors), indexing="ij")).reshape(1 + nanchors, -1).T
+            target_ids, anchor_ids = combs[:, 0], combs[:, 1:]
+            assert np.array_equal(relation_table.eval(spatial_rel, target_ids, anchor_ids),
+                                  eval_spatial_preds(landmarks, spatial_rel, target_ids, anchor_ids)), (seed, spatial_rel)
+
+
+def test_relation_table_without_pairs_in_range():
+    landmarks = LandmarkTable.from_dict({"robot": {"x": -20 * MAX_RANGE, "y": 0.0}, "anchor": {"x": 0.0, "y": 0.0}, "target": {"x": 20 * MAX_RANGE, "y": 0.0}})
+    relation_table = RelationTable(landmarks)
+    assert len(relation_table.pairs) == 0
+    assert not relation_table.eval("behind", [2], [[1]]).any()
+    assert not relation_table.eval("between", [2], [[0, 1]]).any()
+    assert len(relation_table.eval("left", [], [])) == 0
@@ -63,6 +63,14 @@ def save_to_file(data, fpth, mode=None):
         raise ValueError(f"ERROR: file type {ftype} not recognized")
 
 
+def stats_fpath(out_fpath):
+    """
+    Sidecar file of a module output file for its compute and memory statistics.
+    """
+    root, ext = os.path.splitext(out_fpath)
+    return f"{root}_stats{ext}"
+
+
 def copy_lt_outs(lt_out_fpath_from, lt_out_fpath_to, spg_out_fpath):
     """
     Optimization.